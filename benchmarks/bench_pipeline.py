@@ -0,0 +1,171 @@
+"""
+Throughput benchmark of each stage of a harvest, run against a synthetic library and the fake APIs.
+
+Each stage reports how many items it handled per second and how many API calls it made. With --trace-memory it also
+reports the most memory that it allocated on top of what was already in use when it started, which tracemalloc
+follows in every thread. Tracing slows every allocation down, so the throughputs of such a run are not comparable
+with those of a run without it. The results are saved as JSON so that runs can be compared.
+
+Run from the project's root with:
+    python -m benchmarks.bench_pipeline --count 2000 --latency 0.02
+    python -m benchmarks.bench_pipeline --count 2000 --trace-memory
+    python -m benchmarks.bench_pipeline --count 2000 --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import ntpath
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeOpenAI, FakeSpotify
+from benchmarks.library import generate_library
+from src import metrics
+from src.ai_filename_process import invoke_prompt_to_ai, process_response
+from src.fileIO import media_file_finder, metadata_harvester
+from src.rate_limit import TokenBucket
+from src.spotify_api_handler import add_songs_to_playlist, get_or_create_playlist, search_songs_not_in_playlist
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def measure(stages, name, items, run, *fakes):
+    """
+    Time a stage and record its throughput, API calls and, when tracemalloc is tracing, its peak memory.
+
+    :param stages: a dictionary that the stage's results are added to under its name
+    :param name: a string representing the name of the stage
+    :param items: an integer representing the number of items the stage handles
+    :param run: a function without parameters that runs the stage
+    :param fakes: the fake API clients whose calls are counted
+    :return: the value returned by run
+    """
+    calls_before = [fake.total_calls() for fake in fakes]
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        memory_before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    # The stages print a line per failed song, which would drown out the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run()
+    seconds = time.perf_counter() - start
+    peak_memory_mb = None
+    if tracing:
+        peak_memory_mb = round((tracemalloc.get_traced_memory()[1] - memory_before) / (1024 * 1024), 2)
+    stages[name] = {'items': items, 'seconds': round(seconds, 4),
+                    'items_per_second': round(items / seconds, 1) if seconds else None,
+                    'api_calls': sum(fake.total_calls() - before for fake, before in zip(fakes, calls_before)),
+                    'peak_memory_mb': peak_memory_mb}
+    return result
+
+
+def run(count, untagged_ratio=0.3, duplicate_ratio=0.1, latency=0.0, rate_limit=None, error_rate=0.0,
+        workers=8, ai_batch_size=20, library_directory=None):
+    """
+    Run every stage of a harvest of a synthetic library against the fake APIs.
+
+    :param count: an integer representing the number of song files in the library
+    :param untagged_ratio: a float between 0 and 1 representing the share of files without tags
+    :param duplicate_ratio: a float between 0 and 1 representing the share of files repeating another song
+    :param latency: a number representing how many seconds each fake API call takes
+    :param rate_limit: a number representing how many calls per second the fake APIs allow, or None for no limit
+    :param error_rate: a float between 0 and 1 representing the share of fake API calls that fail
+    :param workers: an integer representing how many files are read and songs searched at the same time
+    :param ai_batch_size: an integer representing how many filenames are sent in each AI request
+    :param library_directory: an optional string representing the folder of an existing synthetic library
+    :return: a dictionary of the run's configuration and the results of each stage
+    """
+    config = {'count': count, 'untagged_ratio': untagged_ratio, 'duplicate_ratio': duplicate_ratio,
+              'latency': latency, 'rate_limit': rate_limit, 'error_rate': error_rate, 'workers': workers,
+              'ai_batch_size': ai_batch_size}
+    stages = {}
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = library_directory or temporary_directory
+        library = generate_library(directory, count, untagged_ratio, duplicate_ratio=duplicate_ratio)
+        catalog = [song for _, song, _ in library]
+        answers = {ntpath.basename(path): song for path, song, tagged in library if not tagged}
+        backend_options = {'latency': latency, 'rate_limit': rate_limit, 'error_rate': error_rate}
+        sp = FakeSpotify(catalog, **backend_options)
+        client = FakeOpenAI(answers, **backend_options)
+        limiter_rate = rate_limit or 1000
+
+        files = measure(stages, 'media_file_finder', count, lambda: list(media_file_finder(directory)))
+        metadata, untagged = measure(stages, 'metadata_harvester', len(files),
+                                     lambda: metadata_harvester(files, workers=workers))
+        responses = measure(stages, 'invoke_prompt_to_ai', len(untagged),
+                            lambda: invoke_prompt_to_ai(untagged, batch_size=ai_batch_size, client=client,
+                                                        max_in_flight=4, limiter=TokenBucket(limiter_rate)),
+                            client)
+        metadata.extend(process_response(responses))
+        playlist_id = get_or_create_playlist(sp, sp.current_user()['id'], "Benchmark")
+        new_songs, failed_tracks = measure(stages, 'search_songs_not_in_playlist', len(metadata),
+                                           lambda: search_songs_not_in_playlist(
+                                               sp, playlist_id, metadata, workers=workers,
+                                               limiter=TokenBucket(limiter_rate)), sp)
+        added_tracks = measure(stages, 'add_songs_to_playlist', len(new_songs),
+                               lambda: add_songs_to_playlist(sp, playlist_id, new_songs), sp)
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'python': platform.python_version(),
+            'platform': platform.platform(), 'config': config, 'stages': stages,
+            'outcome': {'found': len(new_songs), 'failed': len(failed_tracks), 'added': len(added_tracks)}}
+
+
+def compare(results, baseline):
+    """
+    Compare the throughput of each stage with an earlier run.
+
+    :param results: a dictionary returned by run
+    :param baseline: a dictionary returned by an earlier run
+    :return: a dictionary mapping each stage in both runs to its throughput relative to the earlier run
+    """
+    ratios = {}
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name, {}).get('items_per_second')
+        if before and stage['items_per_second']:
+            ratios[name] = round(stage['items_per_second'] / before, 2)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000, help="number of song files in the library")
+    parser.add_argument('--untagged-ratio', type=float, default=0.3, help="share of files without tags")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help="share of files repeating another song")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each fake API call takes")
+    parser.add_argument('--rate-limit', type=float, default=None, help="calls per second the fake APIs allow")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of fake API calls that fail")
+    parser.add_argument('--workers', type=int, default=8, help="files read and songs searched at the same time")
+    parser.add_argument('--ai-batch-size', type=int, default=20, help="filenames sent in each AI request")
+    parser.add_argument('--library', default=None, help="folder to write the library into instead of a temporary one")
+    parser.add_argument('--metrics', action='store_true', help="collect the metrics and add their report")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="trace the memory each stage allocates, which slows every stage down")
+    parser.add_argument('--output', default=None, help="JSON file to save the results in")
+    parser.add_argument('--compare', default=None, help="JSON file of an earlier run to compare against")
+    arguments = parser.parse_args()
+
+    metrics.enable(arguments.metrics)
+    if arguments.trace_memory:
+        tracemalloc.start()
+    results = run(arguments.count, arguments.untagged_ratio, arguments.duplicate_ratio, arguments.latency,
+                  arguments.rate_limit, arguments.error_rate, arguments.workers, arguments.ai_batch_size,
+                  arguments.library)
+    if arguments.metrics:
+        results['metrics'] = metrics.report()
+    if arguments.compare:
+        with open(arguments.compare, 'r', encoding='utf-8') as file:
+            results['compared_to'] = {'file': arguments.compare, 'speedup': compare(results, json.load(file))}
+    output = arguments.output or os.path.join(RESULTS_DIRECTORY, f"pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved the results to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Startup time benchmark of the command line entry point.
+
+Each command is run in a fresh interpreter several times and its median wall time is compared with its target,
+next to the time of an interpreter that does nothing. The heavy modules that --help and --scan-only must not load
+are checked too.
+
+Run from the project's root with:
+    python -m benchmarks.bench_startup --count 1000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.library import generate_library
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('tkinter', 'spotipy', 'openai', 'requests', 'fuzzywuzzy', 'rapidfuzz')
+# The most seconds each command may take on top of the interpreter's own startup
+TARGETS = {'--help': 0.15, '--scan-only': 0.5}
+
+
+def time_command(command, repeat):
+    """
+    Run a command in a fresh interpreter several times.
+
+    :param command: a list of strings representing the arguments after the python executable
+    :param repeat: an integer representing how many times the command is run
+    :return: a float representing the median wall time in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=PROJECT_DIRECTORY, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def heavy_modules_loaded(arguments):
+    """
+    Find which heavy modules a run of the entry point loads.
+
+    :param arguments: a list of strings representing the entry point's arguments
+    :return: a list of the names of the heavy modules that were imported
+    """
+    script = ("import sys, contextlib, io\n"
+              "from src import main\n"
+              "with contextlib.redirect_stdout(io.StringIO()):\n"
+              "    try:\n"
+              f"        main.main({arguments!r})\n"
+              "    except SystemExit:\n"
+              "        pass\n"
+              f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n")
+    output = subprocess.run([sys.executable, '-c', script], cwd=PROJECT_DIRECTORY, check=True, capture_output=True,
+                            text=True).stdout.strip()
+    return [module for module in output.split(',') if module]
+
+
+def run(count, repeat):
+    """
+    Time --help and a --scan-only run of a synthetic library against their targets.
+
+    :param count: an integer representing the number of song files in the library
+    :param repeat: an integer representing how many times each command is run
+    :return: a dictionary of the interpreter's startup time and the time, target and loaded heavy modules of each
+             command
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        library = os.path.join(directory, 'library')
+        generate_library(library, count)
+        cache_directory = os.path.join(directory, 'cache')
+        commands = {'--help': ['--help'], '--scan-only': [library, '--scan-only', '--cache-dir', cache_directory]}
+        interpreter = time_command(['-c', 'pass'], repeat)
+        results = {'files': count, 'interpreter_seconds': round(interpreter, 4), 'commands': {}}
+        for name, arguments in commands.items():
+            seconds = time_command(['-m', 'src.main'] + arguments, repeat)
+            results['commands'][name] = {
+                'seconds': round(seconds, 4), 'over_interpreter': round(seconds - interpreter, 4),
+                'target': TARGETS[name], 'met': seconds - interpreter <= TARGETS[name],
+                'heavy_modules': heavy_modules_loaded(arguments)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=1000, help="number of song files for the --scan-only run")
+    parser.add_argument('--repeat', type=int, default=5, help="number of times each command is run")
+    arguments = parser.parse_args()
+    results = run(arguments.count, arguments.repeat)
+    print(json.dumps(results, indent=2))
+    commands = results['commands'].values()
+    if not all(command['met'] and not command['heavy_modules'] for command in commands):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+Local stand-ins for the Spotify and OpenAI clients, for benchmarking and testing without network access.
+
+Both fakes answer from the catalog of a synthetic library, and can be slowed down, rate limited and made to fail
+at random so that the retry and rate limiting paths are measured too. Every call is counted by method.
+
+FakeSpotifyServer is a local HTTP server instead, for tests that drive a real spotipy client and need the errors
+exactly as spotipy and requests raise them.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from src.filename_parser import parse_filename
+from src.normalizer import normalize_song
+from src.rate_limit import TokenBucket
+
+BATCH_LINE = re.compile(r'^(\d+)\. (.+)$', flags=re.M)
+SINGLE_NAME = re.compile(r"Given the filename '(.+)', provide")
+SEARCH_QUERY = re.compile(r'^track:(?P<title>.+?)(?: artist:(?P<artist>.+))?$')
+ISRC_QUERY = re.compile(r'^isrc:(?P<isrc>\S+)$', flags=re.I)
+
+
+class FakeAPIError(Exception):
+    """
+    An error response from a fake API, shaped like the errors raised by spotipy and openai.
+    """
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"http status: {status}, {message}")
+        self.http_status = status
+        self.status_code = status
+        self.headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+
+
+class _FakeBackend:
+    """
+    The latency, rate limit, errors and call counts shared by the fakes.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=None, error_rate=0.0, seed=0):
+        """
+        :param latency: a number representing how many seconds each call takes
+        :param rate_limit: a number representing how many calls are allowed per second before the fake answers
+                           429 Too Many Requests, or None for no limit
+        :param error_rate: a float between 0 and 1 representing the share of calls that fail with a 500 error
+        :param seed: an integer seeding the random generator that picks the failing calls
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._bucket = None if rate_limit is None else TokenBucket(rate_limit)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            failing = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if self._bucket is not None and not self._bucket.try_acquire():
+            with self._lock:
+                self.calls['rate limited'] += 1
+            raise FakeAPIError(429, "too many requests", retry_after=1 / self._bucket.rate)
+        if failing:
+            with self._lock:
+                self.calls['errors'] += 1
+            raise FakeAPIError(500, "internal server error")
+
+    def total_calls(self):
+        """
+        Count the calls made to the fake, not counting the rate limited and failed ones twice.
+
+        :return: an integer representing the number of calls
+        """
+        with self._lock:
+            return sum(count for method, count in self.calls.items() if method not in ('rate limited', 'errors'))
+
+
+class FakeSpotify(_FakeBackend):
+    """
+    A stand-in for spotipy.Spotify that searches a catalog and keeps playlists in memory.
+    """
+
+    def __init__(self, catalog=(), coverage=1.0, user_id='benchmark-user', **backend_options):
+        """
+        :param catalog: an iterable of dictionaries of songs' metadata that the searches find
+        :param coverage: a float between 0 and 1 representing the share of the catalog that Spotify has
+        :param user_id: a string representing the id of the user the fake is signed in as
+        :param backend_options: the latency, rate_limit, error_rate and seed of the fake, see _FakeBackend
+        """
+        super().__init__(**backend_options)
+        self.user_id = user_id
+        self.tracks = {}
+        self._by_title = {}
+        self._by_isrc = {}
+        self.playlists = {}
+        self._snapshots = Counter()
+        for song in catalog:
+            normalized = normalize_song(song['Title'], song['Artist'])
+            if normalized.key in self._by_title.get(normalized.key.split("|")[0], {}):
+                continue
+            if self._random.random() >= coverage:
+                continue
+            track_id = f"track{len(self.tracks):07d}"
+            track = {'id': track_id, 'name': song['Title'], 'artists': [{'name': song['Artist']}],
+                     'album': {'name': song.get('Album') or ""},
+                     'duration_ms': int(song['Duration'] * 1000) if song.get('Duration') else None,
+                     'external_ids': {'isrc': song['ISRC']} if song.get('ISRC') else {}}
+            self.tracks[track_id] = track
+            if song.get('ISRC'):
+                self._by_isrc[song['ISRC'].upper()] = track
+            self._by_title.setdefault(normalized.key.split("|")[0], {})[normalized.key] = track
+
+    def current_user(self):
+        self._call('current_user')
+        return {'id': self.user_id}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._call('current_user_playlists')
+        return {'items': [{'id': playlist_id, 'name': playlist['name']}
+                          for playlist_id, playlist in self.playlists.items()]}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=""):
+        self._call('user_playlist_create')
+        playlist_id = f"playlist{len(self.playlists):04d}"
+        self.playlists[playlist_id] = {'name': name, 'tracks': []}
+        return {'id': playlist_id, 'name': name}
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',)):
+        self._call('playlist')
+        playlist = self.playlists[playlist_id]
+        return {'id': playlist_id, 'name': playlist['name'], 'snapshot_id': self._snapshot(playlist_id),
+                'tracks': {'total': len(playlist['tracks'])}}
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, market=None,
+                       additional_types=('track', 'episode')):
+        self._call('playlist_items')
+        track_ids = self.playlists[playlist_id]['tracks']
+        page = track_ids[offset:offset + limit]
+        more = offset + limit < len(track_ids)
+        return {'items': [{'track': {'id': track_id}} for track_id in page], 'total': len(track_ids),
+                'next': f"offset={offset + limit}" if more else None}
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self._call('playlist_add_items')
+        if len(items) > 100:
+            raise FakeAPIError(400, "too many items, the most is 100")
+        unknown = [track_id for track_id in items if track_id not in self.tracks]
+        if unknown:
+            raise FakeAPIError(400, f"invalid track id {unknown[0]}")
+        tracks = self.playlists[playlist_id]['tracks']
+        if position is None:
+            tracks.extend(items)
+        else:
+            tracks[position:position] = items
+        self._snapshots[playlist_id] += 1
+        return {'snapshot_id': self._snapshot(playlist_id)}
+
+    def playlist_remove_all_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
+        self._call('playlist_remove_all_occurrences_of_items')
+        if len(items) > 100:
+            raise FakeAPIError(400, "too many items, the most is 100")
+        removed = set(items)
+        playlist = self.playlists[playlist_id]
+        playlist['tracks'] = [track_id for track_id in playlist['tracks'] if track_id not in removed]
+        self._snapshots[playlist_id] += 1
+        return {'snapshot_id': self._snapshot(playlist_id)}
+
+    def search(self, q, limit=10, offset=0, type='track', market=None):
+        self._call('search')
+        isrc = ISRC_QUERY.match(q)
+        if isrc:
+            track = self._by_isrc.get(isrc.group('isrc').upper())
+            return {'tracks': {'items': [track][offset:offset + limit] if track else []}}
+        match = SEARCH_QUERY.match(q)
+        title, artist = (match.group('title'), match.group('artist') or "") if match else (q, "")
+        normalized = normalize_song(title, artist)
+        candidates = self._by_title.get(normalized.key.split("|")[0], {})
+        exact = candidates.get(normalized.key)
+        items = [exact] if exact else list(candidates.values())
+        return {'tracks': {'items': items[offset:offset + limit]}}
+
+    def _snapshot(self, playlist_id):
+        return f"{playlist_id}-{self._snapshots[playlist_id]}"
+
+
+class FakeOpenAI(_FakeBackend):
+    """
+    A stand-in for the OpenAI client that answers the filename prompts from a catalog.
+    """
+
+    def __init__(self, answers=None, malformed_rate=0.0, **backend_options):
+        """
+        :param answers: an optional dictionary mapping filenames to the dictionaries of metadata to reply with,
+                        the other filenames are answered by the local filename parser
+        :param malformed_rate: a float between 0 and 1 representing the share of batched replies that are not
+                               valid JSON
+        :param backend_options: the latency, rate_limit, error_rate and seed of the fake, see _FakeBackend
+        """
+        super().__init__(**backend_options)
+        self.answers = answers or {}
+        self.malformed_rate = malformed_rate
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _answer(self, name):
+        song = self.answers.get(name)
+        if song is None:
+            song, _ = parse_filename(name)
+        return {key: song.get(key) or "" for key in ('Title', 'Artist', 'Album')}
+
+    def _create(self, model, messages, max_tokens=None, response_format=None, **options):
+        self._call('chat.completions.create')
+        prompt = messages[-1]['content']
+        if response_format is not None:
+            with self._lock:
+                malformed = self._random.random() < self.malformed_rate
+            if malformed:
+                content = '{"songs": ['
+            else:
+                songs = [dict(self._answer(name), index=int(index)) for index, name in BATCH_LINE.findall(prompt)]
+                content = json.dumps({'songs': songs})
+        else:
+            match = SINGLE_NAME.search(prompt)
+            song = self._answer(match.group(1)) if match else {'Title': "", 'Artist': "", 'Album': ""}
+            content = f"{song['Title']},{song['Artist']},{song['Album']}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeSpotifyServer:
+    """
+    A local HTTP server that answers the requests of a real spotipy client with queued responses.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self._responses = deque()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b""
+                with server._lock:
+                    server.requests.append((self.command, self.path.split('?')[0], body))
+                    status, headers, payload = server._responses.popleft() if server._responses else (200, {}, {})
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _answer
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        """
+        The prefix to give a spotipy client instead of the Spotify Web API's.
+        """
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1/"
+
+    def respond(self, status, payload=None, headers=None):
+        """
+        Queue the response to the next request, requests without a queued response get an empty 200 OK.
+
+        :param status: an integer representing the HTTP status code
+        :param payload: an optional JSON-serializable body
+        :param headers: an optional dictionary of response headers
+        """
+        with self._lock:
+            self._responses.append((status, headers or {}, payload if payload is not None else {}))
@@ -0,0 +1,201 @@
+"""
+Generator of synthetic music libraries for the benchmarks.
+
+Tagged songs are written as MP3 files with an ID3v2.4 tag or WAV files with a RIFF INFO list, some of them with
+the song's ISRC, and untagged songs get the kind of noisy filenames found in downloaded libraries, so that every
+stage of a harvest has real work to do. The audio itself is silence, only a few frames long, but the headers give
+each file the length of its song: MP3 files start with an Info frame counting the song's frames and WAV files hold
+MPEG audio with a fact chunk counting its samples.
+
+Run from the project's root with:
+    python -m benchmarks.library /tmp/library --count 1000
+"""
+import argparse
+import os
+import random
+import struct
+
+FIRST_WORDS = ["Midnight", "Golden", "Broken", "Electric", "Silent", "Neon", "Wild", "Paper", "Crystal", "Velvet",
+               "Summer", "Lonely", "Burning", "Frozen", "Little", "Shadow", "Ocean", "Northern", "Fading", "Café"]
+SECOND_WORDS = ["Heart", "Highway", "Dreams", "River", "Lights", "Sky", "Love", "Fire", "City", "Rain", "Echo",
+                "Garden", "Train", "Mirror", "Stone", "Parade", "Waves", "Machine", "Letters", "Señorita"]
+ARTIST_WORDS = ["The Velvet", "Blue", "Arctic", "Young", "Black", "Royal", "Crimson", "Sonic", "Cosmic", "Lunar",
+                "Beyoncé", "AC/DC", "50 Cent", "Blink-182", "Sigur Rós", "DJ Snake", "Mø", "alt-J"]
+ARTIST_SUFFIXES = ["", " Band", " Kids", " Brothers", " Collective", " Orchestra", " & The Echoes", " Trio"]
+# Templates for the filenames of untagged songs, from tidy to barely parsable
+NOISY_NAMES = [
+    "{artist} - {title}",
+    "{track:02d} - {artist} - {title}",
+    "{artist} - {title} (Official Video)",
+    "{artist} - {title} (Official Music Video) [{video_id}]",
+    "{title} by {artist}",
+    "{artist}_-_{title}_320kbps",
+    "{artist} - {title} [HD] - Copy",
+    "{title} - {artist} (Lyrics)",
+    "{track:02d}. {title}",
+    "{artist} {title} lyric video hq",
+    "{title}-{video_id}",
+]
+VIDEO_ID_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+# One silent mono MPEG-1 Layer III frame at 128 kbps and 44.1 kHz, which is 417 bytes long
+MP3_HEADER = b"\xff\xfb\x90\xc0"
+MP3_FRAME = MP3_HEADER + bytes(413)
+MP3_FRAMES = 40
+MP3_SAMPLE_RATE = 44100
+MP3_SAMPLES_PER_FRAME = 1152
+# The side information of a mono MPEG-1 frame, which the Info header follows
+MP3_SIDE_INFO = 17
+WAVE_FORMAT_MPEGLAYER3 = 0x55
+ISRC_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+def make_catalog(count, duplicate_ratio=0.1, seed=0):
+    """
+    Generate the metadata of a library's songs, repeating a share of them as duplicate files.
+
+    :param count: an integer representing the number of songs
+    :param duplicate_ratio: a float between 0 and 1 representing the share of songs that repeat another song
+    :param seed: an integer seeding the random generator
+    :return: a list of dictionaries with Title, Artist, Album, Duration and ISRC keys
+    """
+    rng = random.Random(seed)
+    songs = []
+    for number in range(count):
+        if songs and rng.random() < duplicate_ratio:
+            songs.append(dict(rng.choice(songs)))
+            continue
+        artist = rng.choice(ARTIST_WORDS) + rng.choice(ARTIST_SUFFIXES)
+        title = f"{rng.choice(FIRST_WORDS)} {rng.choice(SECOND_WORDS)}"
+        # The number keeps the songs distinct however big the library is
+        if number >= len(FIRST_WORDS) * len(SECOND_WORDS) // 4:
+            title += f" {number}"
+        album = f"{rng.choice(FIRST_WORDS)} {rng.choice(['Sessions', 'Tapes', 'EP', 'Live', 'Deluxe'])}"
+        registrant = "".join(rng.choice(ISRC_CHARACTERS) for _ in range(3))
+        isrc = f"QZ{registrant}{rng.randint(0, 99):02d}{number:05d}"
+        songs.append({'Title': title, 'Artist': artist, 'Album': album, 'Duration': rng.randint(120, 360),
+                      'ISRC': isrc})
+    return songs
+
+
+def generate_library(directory, count, untagged_ratio=0.3, wav_ratio=0.2, duplicate_ratio=0.1, isrc_ratio=0.5,
+                     seed=0):
+    """
+    Write a synthetic library of tagged and untagged song files.
+
+    :param directory: a string representing the path of the folder to write the library into
+    :param count: an integer representing the number of song files
+    :param untagged_ratio: a float between 0 and 1 representing the share of files without tags
+    :param wav_ratio: a float between 0 and 1 representing the share of files that are WAV instead of MP3
+    :param duplicate_ratio: a float between 0 and 1 representing the share of files that repeat another song
+    :param isrc_ratio: a float between 0 and 1 representing the share of tagged files whose tags hold the ISRC
+    :param seed: an integer seeding the random generator
+    :postcondition: the files are written in artist and album folders, with untagged files in a 'Downloads' folder
+    :return: a list of tuples of each file's path, its song's metadata and whether it is tagged, the ISRC is in
+             the song's metadata whether or not the file's tags hold it
+    """
+    rng = random.Random(seed + 1)
+    library = []
+    for number, song in enumerate(make_catalog(count, duplicate_ratio, seed)):
+        tagged = rng.random() >= untagged_ratio
+        extension = ".wav" if rng.random() < wav_ratio else ".mp3"
+        if tagged:
+            folder = os.path.join(directory, _safe_name(song['Artist']), _safe_name(song['Album']))
+            name = f"{number % 20 + 1:02d} {song['Title']}"
+        else:
+            folder = os.path.join(directory, 'Downloads')
+            video_id = "".join(rng.choice(VIDEO_ID_CHARACTERS) for _ in range(11))
+            name = rng.choice(NOISY_NAMES).format(artist=song['Artist'], title=song['Title'], track=number % 20 + 1,
+                                                  video_id=video_id)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{_safe_name(name)} {number}{extension}" if tagged
+                            else f"{_safe_name(name)}{extension}")
+        if os.path.exists(path):
+            path = os.path.join(folder, f"{_safe_name(name)} ({number}){extension}")
+        writer = _write_wav if extension == ".wav" else _write_mp3
+        tags = None
+        if tagged:
+            tags = dict(song) if rng.random() < isrc_ratio else {key: song[key] for key in ('Title', 'Artist', 'Album')}
+        writer(path, tags, song['Duration'])
+        library.append((path, song, tagged))
+    return library
+
+
+def _safe_name(name):
+    return "".join("_" if character in '<>:"/\\|?*' else character for character in name).strip()
+
+
+def _syncsafe(size):
+    return bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+
+
+def _id3_tag(song):
+    """
+    Build an ID3v2.4 tag with the title, artist, album and the ISRC if there is one of a song as UTF-8 text frames.
+    """
+    frames = b""
+    for frame_id, key in (("TIT2", 'Title'), ("TPE1", 'Artist'), ("TALB", 'Album'), ("TSRC", 'ISRC')):
+        if key not in song:
+            continue
+        text = b"\x03" + song[key].encode('utf-8')
+        frames += frame_id.encode('ascii') + _syncsafe(len(text)) + b"\x00\x00" + text
+    return b"ID3\x04\x00\x00" + _syncsafe(len(frames)) + frames
+
+
+def _info_frame(duration):
+    """
+    Build the Info frame that encoders put before the audio, counting the frames of a song of the given length.
+    """
+    frames = round(duration * MP3_SAMPLE_RATE / MP3_SAMPLES_PER_FRAME)
+    # The flags say that the number of frames and the number of bytes follow
+    info = b"Info" + struct.pack('>III', 3, frames, (frames + 1) * len(MP3_FRAME))
+    body = bytes(MP3_SIDE_INFO) + info
+    return MP3_HEADER + body + bytes(len(MP3_FRAME) - len(MP3_HEADER) - len(body))
+
+
+def _write_mp3(path, song, duration):
+    with open(path, 'wb') as file:
+        if song is not None:
+            file.write(_id3_tag(song))
+        file.write(_info_frame(duration) + MP3_FRAME * MP3_FRAMES)
+
+
+def _riff_chunk(chunk_id, data):
+    # Chunks are padded to an even length
+    return chunk_id + struct.pack('<I', len(data)) + data + (b"\x00" if len(data) % 2 else b"")
+
+
+def _write_wav(path, song, duration):
+    # MPEGLAYERWAVEFORMAT: mono 128 kbps MPEG audio, followed by its ID, flags, block size, frames per block and delay
+    fmt = struct.pack('<HHIIHHHHIHHH', WAVE_FORMAT_MPEGLAYER3, 1, MP3_SAMPLE_RATE, 128000 // 8, 1, 0, 12,
+                      1, 2, len(MP3_FRAME), 1, 1393)
+    chunks = _riff_chunk(b"fmt ", fmt) + _riff_chunk(b"fact", struct.pack('<I', duration * MP3_SAMPLE_RATE))
+    if song is not None:
+        info = b"INFO"
+        for chunk_id, key in ((b"INAM", 'Title'), (b"IART", 'Artist'), (b"IPRD", 'Album'), (b"ISRC", 'ISRC')):
+            if key in song:
+                info += _riff_chunk(chunk_id, song[key].encode('utf-8') + b"\x00")
+        chunks += _riff_chunk(b"LIST", info)
+    chunks += _riff_chunk(b"data", MP3_FRAME * MP3_FRAMES)
+    with open(path, 'wb') as file:
+        file.write(b"RIFF" + struct.pack('<I', 4 + len(chunks)) + b"WAVE" + chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help="folder to write the library into")
+    parser.add_argument('--count', type=int, default=1000, help="number of song files")
+    parser.add_argument('--untagged-ratio', type=float, default=0.3, help="share of files without tags")
+    parser.add_argument('--wav-ratio', type=float, default=0.2, help="share of WAV files")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help="share of files repeating another song")
+    parser.add_argument('--isrc-ratio', type=float, default=0.5, help="share of tagged files holding the ISRC")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    arguments = parser.parse_args()
+    library = generate_library(arguments.directory, arguments.count, arguments.untagged_ratio, arguments.wav_ratio,
+                               arguments.duplicate_ratio, arguments.isrc_ratio, arguments.seed)
+    tagged = sum(1 for _, _, is_tagged in library if is_tagged)
+    print(f"Wrote {len(library)} files ({tagged} tagged) to {arguments.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,50 +5,261 @@ info from the file name and then search for it on Spotify.
 
 """
 import os
-
-from dotenv import load_dotenv
-from openai import OpenAI
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import json
 
-# this authenticates by auto retrieving the API key
-load_dotenv()
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY'),
-)
+from src import metrics
+from src.cache import MISSING, make_key, normalize_text
+from src.filename_parser import split_by_confidence
+from src.rate_limit import call_with_retries, is_rate_limited
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+MODEL = "gpt-4-0125-preview"
+# Bump this whenever the prompts change so that cached responses to the old prompts are not reused
+PROMPT_VERSION = 1
+SYSTEM_PROMPT = "You are a metadata extractor assistant."
+BATCH_PROMPT = ("For each numbered filename below, provide the song's metadata such that it returns a match when"
+                " searched on Spotify, leave a field blank if not specified and remove excess words. Reply with a"
+                " JSON object with a \"songs\" list holding one object per filename, each with the keys \"index\","
+                " \"Title\", \"Artist\" and \"Album\".\n")
+
+
+def get_client():
+    """
+    Get the default OpenAI client, creating it the first time it is needed.
+
+    The client authenticates by auto retrieving the API key, and the OPENAI_BASE_URL environment variable can point
+    it at a local stand-in server.
+
+    :return: an OpenAI client
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            from dotenv import load_dotenv
+            from openai import OpenAI
+            load_dotenv()
+            _default_client = OpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+            )
+    return _default_client
 
 
-def invoke_prompt_to_ai(file_names):
+@metrics.timed_stage('ai_extraction')
+def invoke_prompt_to_ai(file_names, batch_size=1, client=None, max_in_flight=1, limiter=None, timeout=None,
+                        max_retries=3, cache=None):
     """
         This function will invoke a prompt to the AI to extract the song's metadata from the filenames.
 
         :param: file_names: a list of strings representing the filenames of songs
+        :param: batch_size: an integer representing how many filenames are sent in each request, when more than 1
+                the filenames are sent together and the AI replies in JSON
+        :param: client: an object with the OpenAI client's chat.completions.create method, such as a fake backend
+                for testing, defaults to get_client()
+        :param: max_in_flight: an integer representing the most requests waiting for a reply at the same time
+        :param: limiter: an optional TokenBucket that every request takes a token from before it is sent
+        :param: timeout: the most seconds the whole extraction may take, filenames that were not prompted by then
+                get an empty response
+        :param: max_retries: an integer representing how many times a request is retried after a 429 response
+        :param: cache: an optional SqliteCache of earlier responses, filenames found in it are not prompted again
+                and new responses are added to it
         :precondition: file_names is a valid none-empty list of strings
-        :return: a list of strings containing the extracted metadata
+        :postcondition: there is exactly one response per filename, in the same order, a filename that failed
+                        gets an empty response
+        :return: a list containing the extracted metadata, as strings or as dictionaries for batched requests
         """
+    if not file_names:
+        return []
+    if cache is None:
+        return _prompt_filenames(file_names, batch_size, client, max_in_flight, limiter, timeout, max_retries)
+
+    keys = [extraction_cache_key(name) for name in file_names]
+    responses = {}
+    to_prompt = []
+    for name, key in zip(file_names, keys):
+        if key in responses:
+            continue
+        responses[key] = cache.get(key)
+        if responses[key] is MISSING:
+            to_prompt.append((name, key))
+        metrics.increment('cache_requests_total', cache='ai_extraction',
+                          result='miss' if responses[key] is MISSING else 'hit')
+    prompted = _prompt_filenames([name for name, _ in to_prompt], batch_size, client, max_in_flight, limiter,
+                                 timeout, max_retries)
+    for (_, key), response in zip(to_prompt, prompted):
+        responses[key] = response
+        # Failed requests are not cached so that they are prompted again next time
+        if response:
+            cache.set(key, response)
+    return [responses[key] for key in keys]
+
+
+def extraction_cache_key(name):
+    """
+    Build the cache key of a filename's AI response.
+
+    :param name: a string representing the filename of a song
+    :return: a string representing the cache key, which changes whenever the prompt or model does
+    """
+    return make_key(normalize_text(name), PROMPT_VERSION, MODEL)
+
+
+def _prompt_filenames(file_names, batch_size, client, max_in_flight, limiter, timeout, max_retries):
+    """
+    Prompt the AI for the metadata of every filename, see invoke_prompt_to_ai for the parameters.
+
+    :return: a list containing the extracted metadata, one for each filename
+    """
+    if not file_names:
+        return []
+    deadline = None if timeout is None else time.monotonic() + timeout
+    request = partial(_create_completion, client or get_client(), limiter, deadline, max_retries)
+    # A chunk of a single filename is prompted in plain text rather than JSON
+    batch_size = max(batch_size, 1)
+    chunks = [file_names[i:i + batch_size] for i in range(0, len(file_names), batch_size)]
+    invoke = partial(_invoke_batch, request)
+
     ai_responses = []
-    if len(file_names) > 0:
-        for name in file_names:
-            prompt = (f"Given the filename '{name}', provide the metadata in plain text, separating Title, Artist,"
-                      " and Album with commas, such that they return match when searched on Spotify, and leave blank"
-                      " if not specified, remove excess words. Don't label fields and Say nothing else.")
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4-0125-preview",
-                    messages=[
-                        {"role": "system", "content": "You are a metadata extractor assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=60,
-                )
-            except Exception as e:
-                print(f"An error with OpenAI API occurred {e}")
-                continue
-            response_text = response.choices[0].message.content.strip()
-            ai_responses.append(response_text)
-            # print(response_text)
+    if max_in_flight > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for responses in executor.map(invoke, chunks):
+                ai_responses.extend(responses)
+    else:
+        for chunk in chunks:
+            ai_responses.extend(invoke(chunk))
     return ai_responses
 
 
+def _create_completion(client, limiter, deadline, max_retries, **kwargs):
+    """
+    Send a chat completion request, waiting for the rate limiter and backing off when the API answers 429.
+
+    :param client: an object with the OpenAI client's chat.completions.create method
+    :param limiter: an optional TokenBucket that the request takes a token from before it is sent
+    :param deadline: the time.monotonic() value after which no more requests are sent, or None
+    :param max_retries: an integer representing how many times the request is retried after a 429 response
+    :param kwargs: the arguments of the chat completion request
+    :raise DeadlineExceeded: if the deadline passes before the request could be sent
+    :return: the chat completion response
+    """
+    return call_with_retries(partial(client.chat.completions.create, **kwargs), limiter, max_retries, deadline,
+                             should_retry=is_rate_limited, endpoint='openai.chat')
+
+
+def _invoke_single(request, name):
+    """
+    Prompt the AI for the metadata of a single filename.
+
+    :param request: a function that sends a chat completion request, see _create_completion
+    :param name: a string representing the filename of a song
+    :return: a string with the Title, Artist and Album separated by commas, or an empty string if the request failed
+    """
+    prompt = (f"Given the filename '{name}', provide the metadata in plain text, separating Title, Artist,"
+              " and Album with commas, such that they return match when searched on Spotify, and leave blank"
+              " if not specified, remove excess words. Don't label fields and Say nothing else.")
+    try:
+        response = request(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=60,
+        )
+    except Exception as e:
+        print(f"An error with OpenAI API occurred {e}")
+        metrics.increment('failures_total', stage='ai_extraction', reason='api_error')
+        return ""
+    return response.choices[0].message.content.strip()
+
+
+def _invoke_batch(request, names, retries=1):
+    """
+    Prompt the AI for the metadata of several filenames in one request.
+
+    A batch whose reply is malformed is retried, then split in half until the filenames that the AI struggles
+    with are prompted on their own.
+
+    :param request: a function that sends a chat completion request, see _create_completion
+    :param names: a list of strings representing the filenames of songs
+    :param retries: an integer representing how many times a malformed batch is retried before it is split
+    :return: a list of dictionaries, or strings for filenames prompted on their own, one for each filename,
+             a filename whose request failed gets an empty string
+    """
+    if len(names) == 1:
+        return [_invoke_single(request, names[0])]
+    numbered_names = "\n".join(f"{index}. {name}" for index, name in enumerate(names))
+    for _ in range(retries + 1):
+        try:
+            response = request(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": BATCH_PROMPT + numbered_names}
+                ],
+                max_tokens=60 * len(names),
+                response_format={"type": "json_object"},
+            )
+            return _parse_batch_response(response.choices[0].message.content, len(names))
+        except ValueError as e:
+            print(f"Malformed reply from OpenAI API for a batch of {len(names)} filenames: {e}")
+            metrics.increment('ai_malformed_replies_total')
+        except Exception as e:
+            print(f"An error with OpenAI API occurred {e}")
+            metrics.increment('failures_total', len(names), stage='ai_extraction', reason='api_error')
+            return [""] * len(names)
+    metrics.increment('ai_batch_splits_total')
+    middle = len(names) // 2
+    return _invoke_batch(request, names[:middle], retries) + _invoke_batch(request, names[middle:], retries)
+
+
+def _parse_batch_response(content, expected_count):
+    """
+    Parse the JSON reply to a batched prompt and put its songs in the order of the filenames.
+
+    :param content: a string containing the AI's reply
+    :param expected_count: an integer representing the number of filenames in the batch
+    :raise ValueError: if the reply is not valid JSON or does not have exactly one song for each filename
+    :return: a list of dictionaries containing the Title, Artist and Album of each filename
+    """
+    try:
+        songs = json.loads(content)["songs"]
+        by_index = {int(song["index"]): song for song in songs}
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f"could not read songs from reply: {e}") from e
+    if sorted(by_index) != list(range(expected_count)):
+        raise ValueError(f"expected indexes 0 to {expected_count - 1}, got {sorted(by_index)}")
+    return [{key: str(by_index[index].get(key) or "") for key in ("Title", "Artist", "Album")}
+            for index in range(expected_count)]
+
+
+def extract_filename_metadata(file_names, threshold=0.8, include_paths=False, **ai_options):
+    """
+    Extract the songs' metadata from their filenames, parsing them locally and only prompting the AI for the
+    filenames the parser is not confident about.
+
+    :param file_names: a list of strings representing the filenames of songs
+    :param threshold: a float between 0 and 1 representing the lowest confidence a parsed filename is accepted
+                      with, 1.1 sends every filename to the AI
+    :param include_paths: a boolean, whether to add each filename to its dictionary under the 'File' key
+    :param ai_options: keyword arguments passed on to invoke_prompt_to_ai
+    :return: a list of dictionaries containing track metadata, one for each filename in the same order
+    """
+    parsed, unsure = split_by_confidence(file_names, threshold)
+    metrics.increment('filenames_total', len(parsed), extracted_by='parser')
+    metrics.increment('filenames_total', len(unsure), extracted_by='ai')
+    ai_metadata = process_response(invoke_prompt_to_ai([file_names[index] for index in unsure], **ai_options))
+    parsed.update(zip(unsure, ai_metadata))
+    if include_paths:
+        return [dict(parsed[index], File=file_name) for index, file_name in enumerate(file_names)]
+    return [parsed[index] for index in range(len(file_names))]
+
+
 def process_response(response):
     """
         Process the result from the prompt and format the result and return the metadata.
@@ -57,6 +268,9 @@ def process_response(response):
         """
     metadata = []
     for res in response:
+        if isinstance(res, dict):
+            metadata.append({key: res.get(key, "").strip() for key in ("Title", "Artist", "Album")})
+            continue
         segmented_text = res.split(",")
         if len(segmented_text) < 3:
             # Fill the rest with empty strings
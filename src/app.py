@@ -0,0 +1,103 @@
+"""
+This file contains the Flask app that the AudioReaper web app submits harvest jobs to.
+
+    POST /jobs          queue a job, from a JSON body with 'playlist' and either 'filenames' or 'manifest', or a form
+                        with a 'playlist' field and an uploaded 'manifest' file
+    GET  /jobs          list the user's jobs
+    GET  /jobs/<id>     poll the status and progress of one of the user's jobs
+
+Every request is made for a Spotify user, whose OAuth access token is sent as 'Authorization: Bearer <token>'.
+"""
+import json
+
+from flask import Flask, jsonify, request
+
+from src.cache import AI_CACHE_TTL, SEARCH_CACHE_TTL, SqliteCache, default_cache_path
+from src.job_service import InvalidToken, JobService, QueueFull, parse_manifest
+
+
+def create_job_service():
+    """
+    Create the job service with the AI extraction and Spotify search caches shared by every user.
+
+    :return: a JobService
+    """
+    ai_cache = SqliteCache(default_cache_path('ai_extraction.sqlite3'), max_entries=100000, ttl=AI_CACHE_TTL)
+    search_cache = SqliteCache(default_cache_path('spotify_search.sqlite3'), max_entries=200000,
+                               ttl=SEARCH_CACHE_TTL)
+    return JobService(ai_options={'cache': ai_cache}, search_options={'cache': search_cache})
+
+
+def create_app(service=None):
+    """
+    Create the Flask app.
+
+    :param service: an optional JobService that runs the jobs, one is created with the default caches if not given
+    :return: a Flask object
+    """
+    app = Flask(__name__)
+    app.config['JOB_SERVICE'] = service = service or create_job_service()
+
+    def error(status, message):
+        return jsonify({'error': message}), status
+
+    def current_user():
+        header = request.headers.get('Authorization', "")
+        scheme, _, token = header.partition(" ")
+        if scheme.lower() != 'bearer' or not token.strip():
+            return None, None
+        try:
+            return token.strip(), service.identify(token.strip())
+        except InvalidToken:
+            return None, None
+
+    @app.post('/jobs')
+    def submit_job():
+        token, user_id = current_user()
+        if user_id is None:
+            return error(401, "a valid Spotify access token is required")
+        file_names, songs = None, None
+        try:
+            if 'manifest' in request.files:
+                playlist_name = request.form.get('playlist')
+                songs = parse_manifest(request.files['manifest'].read().decode('utf-8-sig'))
+            else:
+                body = request.get_json(silent=True)
+                if not isinstance(body, dict):
+                    return error(400, "the request body must be a JSON object or a form with a manifest file")
+                playlist_name = body.get('playlist')
+                file_names = body.get('filenames')
+                manifest = body.get('manifest')
+                if file_names is not None and not isinstance(file_names, list):
+                    return error(400, "'filenames' must be a list")
+                if isinstance(manifest, str):
+                    songs = parse_manifest(manifest)
+                elif manifest is not None:
+                    songs = parse_manifest(json.dumps(manifest))
+            job = service.submit(token, playlist_name, file_names=file_names, songs=songs)
+        except UnicodeDecodeError:
+            return error(400, "the manifest must be UTF-8 text")
+        except ValueError as e:
+            return error(400, str(e))
+        except QueueFull as e:
+            return error(429, str(e))
+        return jsonify(service.get(job.id)), 202, {'Location': f"/jobs/{job.id}"}
+
+    @app.get('/jobs')
+    def list_jobs():
+        _, user_id = current_user()
+        if user_id is None:
+            return error(401, "a valid Spotify access token is required")
+        return jsonify({'jobs': service.list_jobs(user_id)})
+
+    @app.get('/jobs/<job_id>')
+    def get_job(job_id):
+        _, user_id = current_user()
+        if user_id is None:
+            return error(401, "a valid Spotify access token is required")
+        job = service.get(job_id, user_id)
+        if job is None:
+            return error(404, f"there is no job {job_id}")
+        return jsonify(job)
+
+    return app
@@ -0,0 +1,198 @@
+"""
+This file contains the persistent key-value cache used in front of the external APIs.
+
+Values are stored as JSON in a single SQLite file, each entry can expire after a time to live and the least
+recently used entries are evicted once the cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+MISSING = object()
+# How long the command line and the web app keep the results of the AI extraction and of Spotify searches
+AI_CACHE_TTL = 90 * 24 * 60 * 60
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+
+
+def default_cache_path(file_name):
+    """
+    Get the default location of a cache file, inside the 'cache' directory at the project's root.
+
+    :param file_name: a string representing the name of the cache file
+    :return: a string representing the path of the cache file
+    """
+    current_directory_path = os.path.dirname(os.path.abspath(__file__))
+    parent_directory_path = os.path.dirname(current_directory_path)
+    return os.path.join(parent_directory_path, 'cache', file_name)
+
+
+def make_key(*parts):
+    """
+    Build a content-addressed cache key from its parts.
+
+    :param parts: strings that together identify the cached value, such as a normalized input and a version
+    :return: a string representing the SHA-256 hex digest of the parts
+    """
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def normalize_text(text):
+    """
+    Normalize a string so that cosmetic differences in case, Unicode form and spacing share a cache key.
+
+    :param text: a string
+    :return: a string that is NFKC normalized, case-folded and has single spaces only
+    """
+    return " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+class SqliteCache:
+    """
+    A thread-safe, size limited key-value cache stored in a SQLite file.
+    """
+
+    def __init__(self, cache_path, max_entries=None, ttl=None, commit_every=100):
+        """
+        Open the cache, creating it if it does not exist.
+
+        :param cache_path: a string representing the path of the cache file, or ":memory:"
+        :param max_entries: an integer representing the most entries kept, or None for no limit
+        :param ttl: the default number of seconds an entry lives for, or None for entries that never expire
+        :param commit_every: an integer representing how many writes are grouped in one transaction
+        """
+        if cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending_writes = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                 "key TEXT PRIMARY KEY, value TEXT, expires REAL, last_used REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._size = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, key, default=MISSING):
+        """
+        Get a value from the cache.
+
+        :param key: a string representing the entry's key
+        :param default: the value returned when the key is not cached or has expired, defaults to MISSING
+        :return: the cached value, or default
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+            self._wrote()
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=MISSING):
+        """
+        Store a value in the cache, evicting the least recently used entries if the cache is full.
+
+        :param key: a string representing the entry's key
+        :param value: a JSON serializable value, None can be cached too
+        :param ttl: the number of seconds the entry lives for, None for an entry that never expires, defaults to
+                    the cache's ttl
+        """
+        ttl = self.ttl if ttl is MISSING else ttl
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with self._lock:
+            existed = self._connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                     (key, json.dumps(value), expires, now))
+            if existed is None:
+                self._size += 1
+            self._wrote()
+            if self.max_entries is not None and self._size > self.max_entries:
+                self._evict()
+
+    def _wrote(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def _evict(self):
+        """
+        Remove expired entries, then the least recently used ones until the cache is a tenth below its limit.
+        """
+        self._connection.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+        self._size = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        excess = self._size - self.max_entries + self.max_entries // 10
+        if excess > 0:
+            removed = self._connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                                               "ORDER BY last_used, rowid LIMIT ?)", (excess,)).rowcount
+            self._size -= removed
+            self.evictions += removed
+        self._connection.commit()
+        self._pending_writes = 0
+
+    def delete(self, key):
+        """
+        Remove an entry from the cache.
+
+        :param key: a string representing the entry's key
+        """
+        with self._lock:
+            self._size -= self._connection.execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount
+            self._wrote()
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+            self._connection.commit()
+            self._size = 0
+            self._pending_writes = 0
+
+    def stats(self):
+        """
+        Get the cache's counters.
+
+        :return: a dictionary with the number of hits, misses, evictions and entries
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': self._size}
+
+    def commit(self):
+        """
+        Save the pending writes to disk.
+        """
+        with self._lock:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def close(self):
+        """
+        Save the pending writes and close the cache.
+        """
+        self.commit()
+        self._connection.close()
+
+    def __len__(self):
+        return self._size
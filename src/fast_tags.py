@@ -0,0 +1,326 @@
+"""
+This file contains the fast path for reading song tags, which memory-maps each file and only parses the few bytes
+that hold the title, artist, album, ISRC and length, instead of the reads and seeks of a full TinyTag parse.
+
+    1. MP3 files: the ID3v2 tag at the start (versions 2.2 to 2.4), the ID3v1 trailer in the last 128 bytes for
+       the fields the ID3v2 tag does not have, and the Xing, Info or VBRI header of the first audio frame, or the
+       first frames of a constant bitrate file, for the length
+    2. WAV files: the fmt, fact and data chunk headers for the length and the LIST/INFO chunk for the tags
+
+Other formats, and files that do not look the way these parsers expect (such as compressed or unsynchronised ID3
+frames, or an MP3 without a frame right after its tag), are left for TinyTag, which reads everything.
+"""
+import mmap
+import os
+import struct
+from struct import unpack_from
+
+from src import metrics
+
+ID3V1_SIZE = 128
+ID3V2_HEADER_SIZE = 10
+# The ID3v2 frames that are read, with the three letter frame ids of ID3v2.2
+ID3_FRAMES = {b'TIT2': 'title', b'TT2': 'title', b'TPE1': 'artist', b'TP1': 'artist', b'TALB': 'album',
+              b'TAL': 'album', b'TSRC': 'isrc', b'TRC': 'isrc'}
+# The frame format flags meaning that a frame is compressed, encrypted, grouped or unsynchronised, by ID3v2 version
+ID3_FRAME_FORMAT_FLAGS = {3: 0xe0, 4: 0x4f}
+RIFF_FIELDS = {b'INAM': 'title', b'TITL': 'title', b'IART': 'artist', b'IPRD': 'album', b'ISRC': 'isrc'}
+# WAV formats whose length comes from the size of their data rather than the fact chunk, as TinyTag works it out
+LOSSLESS_WAVE_FORMATS = {0x01, 0x03, 0x163, 0x8ae, 0x1971, 0xf1ac}
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+# MPEG audio frame header tables, indexed by the version bits (2.5, reserved, 2, 1) and the layer bits (reserved,
+# III, II, I)
+MPEG_SAMPLE_RATES = ((11025, 12000, 8000), (0, 0, 0), (22050, 24000, 16000), (44100, 48000, 32000))
+_V1L1 = (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448, 0)
+_V1L2 = (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 0)
+_V1L3 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0)
+_V2L1 = (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256, 0)
+_V2L2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0)
+_NONE = (0,) * 16
+MPEG_BITRATES = ((_NONE, _V2L2, _V2L2, _V2L1), (_NONE, _NONE, _NONE, _NONE), (_NONE, _V2L2, _V2L2, _V2L1),
+                 (_NONE, _V1L3, _V1L2, _V1L1))
+MPEG_SAMPLES_PER_FRAME = ((0, 576, 1152, 384), (0, 0, 0, 0), (0, 576, 1152, 384), (0, 1152, 1152, 384))
+MPEG_SLOT_SIZES = (0, 1, 1, 4)
+# How many frames of an MP3 without a Xing, Info or VBRI header must share a bitrate for it to count as constant
+CBR_DETECTION_FRAMES = 5
+
+
+class FastTag:
+    """
+    The tags of a song file read by read_fast_tags, with the attributes of a TinyTag object that the harvest uses.
+    """
+
+    def __init__(self):
+        self.title = None
+        self.artist = None
+        self.album = None
+        self.duration = None
+        self.other = {}
+
+    def _set(self, field, value):
+        """
+        Set a field unless it is already set, such as by an earlier frame or the ID3v2 tag, as TinyTag does.
+        """
+        if not value:
+            return
+        if field == 'isrc':
+            self.other.setdefault('isrc', []).append(value)
+        elif getattr(self, field) is None:
+            setattr(self, field, value)
+
+
+class _Unsupported(Exception):
+    """
+    Raised when a file has to be read by TinyTag instead.
+    """
+
+
+def read_fast_tags(file):
+    """
+    Read the tags of an MP3 or WAV file from its memory-mapped headers.
+
+    :param file: a string representing the path of a song file
+    :raise OSError: if the file cannot be opened
+    :return: a FastTag, or None if the file has to be read by TinyTag
+    """
+    parser = _PARSERS.get(os.path.splitext(file)[1].lower())
+    if parser is None:
+        metrics.increment('fast_tag_reads_total', result='fallback')
+        return None
+    with open(file, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            metrics.increment('fast_tag_reads_total', result='fallback')
+            return None
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                tag = parser(data)
+            except (_Unsupported, struct.error, IndexError):
+                metrics.increment('fast_tag_reads_total', result='fallback')
+                return None
+    metrics.increment('fast_tag_reads_total', result='parsed')
+    return tag
+
+
+def _parse_mp3(data):
+    """
+    Read the tags and length of a memory-mapped MP3 file.
+
+    :param data: an mmap of the file
+    :raise _Unsupported: if the file has to be read by TinyTag
+    :return: a FastTag
+    """
+    tag = FastTag()
+    audio_offset = _parse_id3v2(data, tag) if data[:3] == b'ID3' else 0
+    end_padding = 0
+    if len(data) >= ID3V1_SIZE and data[-ID3V1_SIZE:-ID3V1_SIZE + 3] == b'TAG':
+        _parse_id3v1(data[-ID3V1_SIZE:], tag)
+        end_padding = ID3V1_SIZE
+    tag.duration = _mpeg_duration(data, audio_offset, end_padding)
+    return tag
+
+
+def _parse_id3v2(data, tag):
+    """
+    Read the wanted text frames of an ID3v2 tag.
+
+    :return: an integer representing the offset of the audio after the tag
+    """
+    major, flags = data[3], data[5]
+    # An unsynchronised tag or one with an extended header is rare enough to leave to TinyTag
+    if major not in (2, 3, 4) or flags & 0xc0:
+        raise _Unsupported
+    end = ID3V2_HEADER_SIZE + _syncsafe(data, 6)
+    header_size, id_size = (6, 3) if major == 2 else (10, 4)
+    offset = ID3V2_HEADER_SIZE
+    while offset + header_size <= end:
+        frame_id = data[offset:offset + id_size]
+        if frame_id[0] == 0:
+            # The padding after the last frame
+            break
+        if major == 2:
+            frame_size = int.from_bytes(data[offset + 3:offset + 6], 'big')
+        elif major == 3:
+            frame_size = unpack_from('>I', data, offset + 4)[0]
+        else:
+            frame_size = _syncsafe(data, offset + 4)
+        body = offset + header_size
+        if body + frame_size > end:
+            break
+        field = ID3_FRAMES.get(frame_id)
+        if field is not None:
+            if major > 2 and data[offset + 9] & ID3_FRAME_FORMAT_FLAGS[major]:
+                raise _Unsupported
+            tag._set(field, _decode_text(data[body:body + frame_size]))
+        offset = body + frame_size
+    return end
+
+
+def _parse_id3v1(trailer, tag):
+    """
+    Read the title, artist and album of an ID3v1 tag, for the fields the ID3v2 tag did not set.
+
+    :param trailer: the last 128 bytes of the file
+    :param tag: the FastTag the fields are set on
+    """
+    for field, start in (('title', 3), ('artist', 33), ('album', 63)):
+        tag._set(field, trailer[start:start + 30].decode('latin-1').rstrip('\x00'))
+
+
+def _decode_text(body):
+    """
+    Decode the first string of an ID3v2 text frame.
+    """
+    if not body:
+        return ""
+    encoding, content = body[0], body[1:]
+    if encoding in (1, 2):
+        end = 0
+        while True:
+            end = content.find(b'\x00\x00', end)
+            if end == -1 or end % 2 == 0:
+                break
+            end += 1
+        content = content if end == -1 else content[:end]
+        if encoding == 2:
+            name = 'utf-16-be'
+        else:
+            name = 'utf-16-be' if content.startswith(b'\xfe\xff') else 'utf-16-le'
+            if content[:2] in (b'\xfe\xff', b'\xff\xfe'):
+                content = content[2:]
+        content = content[:len(content) - len(content) % 2]
+    else:
+        name = 'utf-8' if encoding == 3 else 'latin-1'
+        end = content.find(b'\x00')
+        content = content if end == -1 else content[:end]
+    return content.decode(name, 'replace').rstrip('\x00')
+
+
+def _mpeg_frame(data, offset):
+    """
+    Read the MPEG audio frame header at an offset.
+
+    :return: a tuple of the frame's bitrate in kbps, sample rate, samples per frame and length in bytes
+    """
+    header = data[offset:offset + 4]
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        raise _Unsupported
+    version, layer = (header[1] >> 3) & 3, (header[1] >> 1) & 3
+    bitrate_index, sample_rate_index, padding = header[2] >> 4, (header[2] >> 2) & 3, (header[2] >> 1) & 1
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        raise _Unsupported
+    bitrate = MPEG_BITRATES[version][layer][bitrate_index]
+    sample_rate = MPEG_SAMPLE_RATES[version][sample_rate_index]
+    samples = MPEG_SAMPLES_PER_FRAME[version][layer]
+    slot_size = MPEG_SLOT_SIZES[layer]
+    frame_length = ((samples // 8 // slot_size) * 1000 * bitrate // sample_rate + padding) * slot_size
+    return bitrate, sample_rate, samples, frame_length
+
+
+def _mpeg_duration(data, offset, end_padding):
+    """
+    Work out the length of an MP3 from the frames at the start of its audio, the way TinyTag does.
+
+    :return: a float representing the length in seconds
+    """
+    bitrate, sample_rate, samples, frame_length = _mpeg_frame(data, offset)
+    first_frame = data[offset + 4:offset + 4 + min(50, frame_length)]
+    frames = byte_count = 0
+    position = first_frame.find(b'Xing')
+    if position == -1:
+        position = first_frame.find(b'Info')
+    if position != -1:
+        flags = unpack_from('>i', first_frame, position + 4)[0]
+        field = position + 8
+        if flags & 1:
+            frames = unpack_from('>i', first_frame, field)[0]
+            field += 4
+        if flags & 2:
+            byte_count = unpack_from('>i', first_frame, field)[0] - frame_length
+    else:
+        position = first_frame.find(b'VBRI')
+        if position != -1:
+            byte_count, frames = unpack_from('>II', first_frame, position + 10)
+    if frames > 0 and byte_count > 0:
+        return frames * samples / sample_rate
+
+    # Without a header counting the frames, a file whose first frames share one bitrate is taken as constant bitrate
+    frame_lengths = 0
+    frame_offset = offset
+    for _ in range(CBR_DETECTION_FRAMES):
+        frame_bitrate, _, _, length = _mpeg_frame(data, frame_offset)
+        if frame_bitrate != bitrate:
+            raise _Unsupported
+        frame_lengths += length
+        frame_offset += length
+    stream_size = len(data) - offset - end_padding
+    return int(stream_size / (frame_lengths / CBR_DETECTION_FRAMES) + 0.5) * samples / sample_rate
+
+
+def _parse_wav(data):
+    """
+    Read the tags and length of a memory-mapped WAV file from its chunk headers.
+
+    :param data: an mmap of the file
+    :raise _Unsupported: if the file has to be read by TinyTag
+    :return: a FastTag
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise _Unsupported
+    tag = FastTag()
+    format_tag = sample_rate = block_align = audio_size = sample_count = 0
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        size = unpack_from('<I', data, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            format_tag, _, sample_rate = unpack_from('<HHI', data, body)
+            block_align = unpack_from('<H', data, body + 12)[0]
+            if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                format_tag = unpack_from('<H', data, body + 24)[0]
+        elif chunk_id == b'data':
+            audio_size = size
+        elif chunk_id == b'fact':
+            sample_count = unpack_from('<I', data, body)[0]
+        elif chunk_id == b'LIST' and data[body:body + 4] == b'INFO':
+            _parse_riff_info(data, body + 4, min(body + size, len(data)), tag)
+        elif chunk_id in (b'id3 ', b'ID3 '):
+            # An ID3 tag inside the WAV file
+            raise _Unsupported
+        # Chunks are padded to an even length
+        offset = body + size + size % 2
+
+    if sample_rate and format_tag not in LOSSLESS_WAVE_FORMATS:
+        tag.duration = sample_count / sample_rate if audio_size else 0
+    elif sample_rate and block_align:
+        tag.duration = audio_size / (block_align * sample_rate)
+    return tag
+
+
+def _parse_riff_info(data, offset, end, tag):
+    """
+    Read the wanted fields of a LIST/INFO chunk.
+
+    :param data: an mmap of the file
+    :param offset: an integer representing the offset of the first field, after the INFO list type
+    :param end: an integer representing the offset of the end of the chunk
+    :param tag: the FastTag the fields are set on
+    """
+    while offset + 8 <= end:
+        field_id = data[offset:offset + 4]
+        size = unpack_from('<I', data, offset + 4)[0]
+        field = RIFF_FIELDS.get(field_id)
+        if field is not None:
+            tag._set(field, data[offset + 8:offset + 8 + size].rstrip(b'\x00').decode('utf-8', 'replace'))
+        offset += 8 + size + size % 2
+
+
+def _syncsafe(data, offset):
+    """
+    Read a 28 bit syncsafe integer of an ID3v2 tag, stored in the low 7 bits of 4 bytes.
+    """
+    return (data[offset] << 21) | (data[offset + 1] << 14) | (data[offset + 2] << 7) | data[offset + 3]
+
+
+_PARSERS = {'.mp3': _parse_mp3, '.wav': _parse_wav}
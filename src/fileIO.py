@@ -3,20 +3,29 @@ This file contains the functions for reading and writing to files.
 
     Functions:
     1. Grab folder from user using the popup
-    2. Parse the folder for all relevant files (mp3 and wav)
+    2. Walk the folder tree for all relevant audio files (mp3, wav, flac, m4a and ogg)
     3. Collect metadata from the files
     4. Write the names of filenames with not metadata to a text file
     5. Clean the metadata of any unwanted characters
     6. Write metadata to a csv file
 """
 import csv
+import fnmatch
 import ntpath
 import os
 import re
-import tkinter as tk
-from tkinter import filedialog
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from tinytag import tinytag
 
+from src import metrics
+from src.fast_tags import read_fast_tags
+from src.normalizer import normalize_song
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".m4a", ".ogg")
+# A country code, a registrant code, the year and a designation code, such as USUM71703861
+ISRC_PATTERN = re.compile(r'^[A-Z]{2}[A-Z0-9]{3}\d{7}$')
+
 
 def select_folder():
     """
@@ -24,6 +33,10 @@ def select_folder():
 
     :return: a string representing the path of the selected folder
     """
+    # Imported here so that headless runs never load tkinter
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()
     folder_path = filedialog.askdirectory()
@@ -32,47 +45,268 @@ def select_folder():
     return folder_path
 
 
-def media_file_finder(target_directory):
+def media_file_finder(target_directory, extensions=AUDIO_EXTENSIONS, include=None, exclude=None,
+                      follow_symlinks=True):
     """
-    Find all the MP3 and WAV files in a directory.
+    Recursively find the audio files in a directory tree, yielding each path as soon as it is found.
 
     :param target_directory: a string representing the path for the target folder
+    :param extensions: an iterable of file extensions (including the dot) to match, case-insensitively
+    :param include: an optional list of glob patterns, when given a file must match at least one of them
+    :param exclude: an optional list of glob patterns, files and folders matching any of them are skipped
+    :param follow_symlinks: a boolean, whether to descend into symlinked folders
     :precondition: target_directory must be a valid path string
-    :return: a list of strings, each being the path to a mp3 or wav file
+    :postcondition: every folder is visited at most once, even when symlinks form a loop
+    :return: a generator of strings, each being the path to an audio file
+    """
+    extensions = {extension.lower() for extension in extensions}
+    include = include or []
+    exclude = exclude or []
+    visited = set()
+    pending = [target_directory]
+    while pending:
+        directory = pending.pop()
+        try:
+            directory_stat = os.stat(directory)
+        except OSError as e:
+            print(f"Could not access folder {directory}: {e}")
+            continue
+        directory_key = (directory_stat.st_dev, directory_stat.st_ino)
+        if directory_key in visited:
+            continue
+        visited.add(directory_key)
+
+        try:
+            with os.scandir(directory) as entries:
+                sub_directories = []
+                for entry in entries:
+                    if _matches_any(entry.path, entry.name, exclude):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            sub_directories.append(entry.path)
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                            if not include or _matches_any(entry.path, entry.name, include):
+                                metrics.increment('files_found_total')
+                                yield entry.path
+                    except OSError as e:
+                        print(f"Could not access {entry.path}: {e}")
+        except OSError as e:
+            print(f"Could not read folder {directory}: {e}")
+            continue
+        # Reversed so that folders are walked in the order they were listed
+        pending.extend(reversed(sub_directories))
+
+
+def _matches_any(path, name, patterns):
     """
-    audio_files = []
-    for file in os.listdir(target_directory):
-        if file.endswith(".mp3") or file.endswith(".wav"):
-            full_path = os.path.join(target_directory, file)  # Add this line
-            audio_files.append(full_path)
-    return audio_files
+    Check if a file matches any of the glob patterns, either by its name or by its full path.
+
+    :param path: a string representing the file's path
+    :param name: a string representing the file's name
+    :param patterns: a list of glob pattern strings
+    :return: a boolean value, True if any of the patterns match, False otherwise
+    """
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern) for pattern in patterns)
 
 
-def metadata_harvester(song_files):
+@metrics.timed_stage('harvest')
+def metadata_harvester(song_files, workers=1, use_processes=False, index=None, include_paths=False,
+                       fast_tags=False):
     """
-    Extract metadata (title, artist, & album) from song files.
+    Extract metadata (title, artist, album, and the duration and ISRC when known) from song files.
 
-    :param song_files: a list of MP3 and WAV files in the user specified directory
-    :precondition: list must be non-empty and contain strings representing file paths
-    :postcondition: extract necessary metadata from each file
+    :param song_files: an iterable of audio file paths, such as the generator returned by media_file_finder
+    :param workers: an integer representing how many files are read at the same time, 1 reads them one by one
+    :param use_processes: a boolean, whether to read the files in a process pool instead of a thread pool,
+                          which suits local disks where parsing rather than I/O is the bottleneck
+    :param index: an optional TagIndex, when given only the files that are new or changed since they were
+                  indexed are opened, and the tags read from them are added to the index
+    :param include_paths: a boolean, whether to add each song's file path to its dictionary under the 'File' key
+    :param fast_tags: a boolean, whether to read MP3 and WAV files with the memory-mapped header parser of
+                      read_fast_tags, falling back to TinyTag for the files it cannot handle
+    :precondition: song_files must contain strings representing file paths
+    :postcondition: extract necessary metadata from each file, in the same order as song_files
     :return: a list of dictionaries of the songs' metadata, each song has a dictionary containing title, artist,
-             and album keys and their respective values
+             and album keys and their respective values, plus Duration in seconds and ISRC keys for the files that
+             have them, and a list of the names of files without metadata
+             or whose tags could not be read
     """
     metadata = []
     file_names = []
-    if not song_files:
-        print("No audio files found in directory.")
+    read_tags = partial(_read_tags, fast_tags=fast_tags)
+    if index is None:
+        to_read = song_files
+        indexed = None
     else:
-        for file in song_files:
-            audio_file = tinytag.TinyTag.get(file)
-            if audio_file.title and audio_file.artist:
-                metadata.append({'Title': audio_file.title, 'Artist': audio_file.artist, 'Album': audio_file.album})
-            else:
-                file_names.append(ntpath.basename(file))
+        indexed = [_lookup_index(index, file) for file in song_files]
+        to_read = [file for file, _, cached in indexed if cached is None]
+
+    if workers > 1:
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            # map() keeps the results in the same order as the files, the tag read timings of worker processes
+            # are not collected in the metrics
+            harvested = executor.map(read_tags, to_read, chunksize=64 if use_processes else 1)
+            _collect_tags(_merge_indexed(indexed, harvested, index), metadata, file_names, include_paths)
+    else:
+        _collect_tags(_merge_indexed(indexed, map(read_tags, to_read), index), metadata, file_names,
+                      include_paths)
+    if index is not None:
+        index.commit()
+    if not metadata and not file_names:
+        print("No audio files found in directory.")
 
     return metadata, file_names
 
 
+def read_song_tags(file, index=None, fast_tags=False):
+    """
+    Read the metadata of a single song file, using the tag index when it is given.
+
+    :param file: a string representing the path of a song file
+    :param index: an optional TagIndex, the file is only opened if it is new or changed since it was indexed
+    :param fast_tags: a boolean, whether to try the memory-mapped header parser before TinyTag, see
+                      metadata_harvester
+    :return: a tuple of a dictionary of the song's metadata or None if it has no usable metadata, and the error
+             raised while reading it or None
+    """
+    if index is None:
+        _, tags, error = _read_tags(file, fast_tags)
+        return tags, error
+    _, key, cached = _lookup_index(index, file)
+    if cached is not None:
+        return cached[1], None
+    _, tags, error = _read_tags(file, fast_tags)
+    if key is not None and error is None:
+        index.store(file, key[0], key[1], tags)
+    return tags, error
+
+
+def _lookup_index(index, file):
+    """
+    Look up a song file in the tag index.
+
+    :param index: a TagIndex
+    :param file: a string representing the path of a song file
+    :return: a tuple of the file's path, its (size, mtime) key or None if it can't be accessed, and a
+             tuple in the format returned by _read_tags if the file is indexed and unchanged, otherwise None
+    """
+    try:
+        file_stat = os.stat(file)
+    except OSError:
+        return file, None, None
+    key = (file_stat.st_size, file_stat.st_mtime_ns)
+    found, tags = index.lookup(file, *key)
+    metrics.increment('cache_requests_total', cache='tag_index', result='hit' if found else 'miss')
+    return file, key, (file, tags, None) if found else None
+
+
+def _merge_indexed(indexed, harvested, index):
+    """
+    Merge the tags found in the index with the tags read from the files, keeping the order of the files.
+
+    :param indexed: a list of tuples returned by _lookup_index, or None if no index is used
+    :param harvested: an iterator of tuples returned by _read_tags for the files that were not indexed
+    :param index: a TagIndex that the newly read tags are stored in, or None
+    :return: a generator of tuples in the format returned by _read_tags
+    """
+    if indexed is None:
+        yield from harvested
+        return
+    for file, key, cached in indexed:
+        if cached is not None:
+            yield cached
+            continue
+        result = next(harvested)
+        _, tags, error = result
+        if key is not None and error is None:
+            index.store(file, key[0], key[1], tags)
+        yield result
+
+
+def _read_tags(file, fast_tags=False):
+    """
+    Read the metadata tags of a single song file.
+
+    :param file: a string representing the path of a song file
+    :param fast_tags: a boolean, whether to try read_fast_tags before TinyTag
+    :return: a tuple of the file's path, a dictionary of its metadata or None if it has no usable metadata, and
+             the error raised while reading it or None
+    """
+    try:
+        with metrics.timer('tag_read_seconds'):
+            audio_file = read_fast_tags(file) if fast_tags else None
+            if audio_file is None:
+                audio_file = tinytag.TinyTag.get(file)
+    except Exception as e:
+        metrics.increment('tag_read_errors_total')
+        return file, None, e
+    if audio_file.title and audio_file.artist:
+        tags = {'Title': audio_file.title, 'Artist': audio_file.artist, 'Album': audio_file.album}
+        duration = _read_duration(audio_file)
+        if duration is not None:
+            tags['Duration'] = duration
+        isrc = _read_isrc(audio_file)
+        if isrc is not None:
+            tags['ISRC'] = isrc
+        return file, tags, None
+    return file, None, None
+
+
+def _read_duration(audio_file):
+    """
+    Get the length of a song file read by TinyTag.
+
+    :param audio_file: a TinyTag or FastTag object
+    :return: a float representing the song's length in seconds, or None if it is unknown
+    """
+    duration = audio_file.duration
+    if isinstance(duration, (int, float)) and duration > 0:
+        return round(duration, 2)
+    return None
+
+
+def _read_isrc(audio_file):
+    """
+    Get the ISRC (International Standard Recording Code) of a song file read by TinyTag.
+
+    :param audio_file: a TinyTag or FastTag object
+    :return: a string representing the song's ISRC in upper case without hyphens, or None if it has no valid one
+    """
+    # TinyTag 2 keeps the fields it has no attribute for in 'other' as lists, TinyTag 1 kept them in 'extra'
+    fields = getattr(audio_file, 'other', None)
+    if not isinstance(fields, dict):
+        fields = getattr(audio_file, 'extra', None)
+    if not isinstance(fields, dict):
+        return None
+    isrc = fields.get('isrc')
+    if isinstance(isrc, list):
+        isrc = isrc[0] if isrc else None
+    if not isinstance(isrc, str):
+        return None
+    isrc = isrc.replace("-", "").replace(" ", "").upper()
+    return isrc if ISRC_PATTERN.match(isrc) else None
+
+
+def _collect_tags(harvested, metadata, file_names, include_paths=False):
+    """
+    Sort the results of _read_tags into the metadata list and the no metadata list.
+
+    :param harvested: an iterable of tuples returned by _read_tags
+    :param metadata: a list that songs with metadata are appended to
+    :param file_names: a list that the names of songs without metadata are appended to
+    :param include_paths: a boolean, whether to add each song's file path to its dictionary under the 'File' key
+    """
+    for file, tags, error in harvested:
+        if tags:
+            metadata.append(dict(tags, File=file) if include_paths else tags)
+        else:
+            if error:
+                print(f"Could not read tags from {file}: {error}")
+            file_names.append(ntpath.basename(file))
+
+
 def clean_metadata(title, artist):
     """
     Remove excess unwanted characters from a song's metadata.
@@ -80,24 +314,10 @@ def clean_metadata(title, artist):
     :param title: a string representing the song's title
     :param artist: a string representing the song's artist
     :precondition: title and artist are valid strings
-    :return: a tuple of strings representing the cleaned title and artist
+    :return: a tuple of strings representing the cleaned title and the first of the artists
     """
-    # Remove common extraneous information from titles
-    title = title.replace(" - Copy", "").replace(" (HD)", "").replace(" (Official Video)", "").strip()
-
-    # Handle case where artist and title are combined in 'Title' field
-    if " - " in title and not artist:
-        artist, title = title.split(" - ", 1)
-
-    title = re.sub(r'\(.*\)|\[.*]|{.*}|-.*|ft\..*|feat\..*|official.*|video.*|\d+kbps.*', '', title,
-                   flags=re.I).strip()
-    if artist is None:
-        artist = ""
-    else:
-        artist = artist.split(',')[0]  # Take the first artist if there are multiple
-    artist = re.sub(r'\(.*\)|\[.*]|{.*}|official.*|video.*', '', artist, flags=re.I).strip()
-
-    return title, artist
+    song = normalize_song(title or "", artist or "")
+    return song.title, song.artist
 
 
 def failed_csv_writer(items):
@@ -131,15 +351,20 @@ def read_failed_tracks():
     """
     current_directory_path = os.path.dirname(os.path.abspath(__file__))
     root_directory_path = os.path.dirname(current_directory_path)
-    file_path = os.path.join(root_directory_path, 'failures', 'failures.CSV')
+    file_path = os.path.join(root_directory_path, 'failures', 'failures.csv')
 
     failed_metadata = []
     try:
-        with open(file_path, 'r') as file:
-            failed_tracks = file.readlines()
-        for track in failed_tracks:
-            title, artist = track.split(", ")
-            failed_metadata.append({'Title': title.replace('\\', ''), 'Artist': artist.replace('\n', '')})
+        with open(file_path, 'r', newline='', encoding='utf-8') as file:
+            # The same dialect failed_csv_writer writes with, so escaped commas are read back as part of the value
+            reader = csv.reader(file, delimiter=',', quotechar='|', quoting=csv.QUOTE_NONE, escapechar='\\')
+            for row in reader:
+                if not row:
+                    continue
+                title, _, artist = ",".join(row).rpartition(", ")
+                if not title:
+                    title, artist = artist, ""
+                failed_metadata.append({'Title': title, 'Artist': artist})
     except FileNotFoundError:
         print("No failures.csv file found.")
     return failed_metadata
@@ -0,0 +1,99 @@
+"""
+This file contains a rule-based parser that extracts a song's metadata from its filename.
+
+Most untagged files follow a handful of naming patterns, such as 'Artist - Title.mp3' or
+'01 - Artist - Title (Official Video).mp3', which can be parsed locally. Each result comes with a confidence
+score so that only the names the patterns don't fit well need to be sent to the AI.
+"""
+import os
+import re
+
+from src.fileIO import clean_metadata
+
+SEPARATOR = r'\s+[-–—~|]+\s+'
+# A part between separators, which may still contain unspaced hyphens such as in 'Blink-182'
+PART = r'(?:(?!\s[-–—~|]+\s).)+?'
+NOISE = re.compile(r'[(\[{][^)\]}]*(official|video|audio|lyric|visuali[sz]er|hd|hq|\d+\s*kbps|remaster\w*|explicit|'
+                   r'clean|full song|music video|mv)[^)\]}]*[)\]}]'
+                   r'|\s-\sCopy(\s\(\d+\))?$|\s\(\d+\)$', flags=re.I)
+VIDEO_ID = re.compile(r'[-_\s]*\[[A-Za-z0-9_-]{11}\]$')
+TRAILING_VIDEO_ID = re.compile(r'-(?=[A-Za-z0-9_-]*[0-9_-])(?=[A-Za-z0-9_-]*[A-Za-z])[A-Za-z0-9_-]{11}$')
+# '01 - ', '01. ', '1-03 ' and '07 ' but not the '50 ' of '50 Cent'
+TRACK_NUMBER = re.compile(r'^(\d{1,2}[-.]\d{1,3}\s+|\d{1,3}\s*[-._)]\s*(?=[^\d\s])|0\d\s+)')
+SPACED_UNDERSCORES = re.compile(r'_+-_+')
+
+# Each pattern comes with how confident a match is that the fields are right, the first match wins
+PATTERNS = [
+    (re.compile(rf'^(?P<artist>{PART}){SEPARATOR}(?P<title>{PART})$'), 0.9),
+    (re.compile(rf'^(?P<title>{PART})\s+by\s+(?P<artist>{PART})$', flags=re.I), 0.8),
+    (re.compile(rf'^(?P<artist>{PART}){SEPARATOR}(?P<title>{PART}){SEPARATOR}(?P<album>{PART})$'), 0.6),
+    (re.compile(r'^(?P<artist>[^-]+?)-(?P<title>[^-]+?)$'), 0.65),
+    (re.compile(r'^(?P<title>.+)$'), 0.3),
+]
+
+
+def normalize_filename(file_name):
+    """
+    Remove the extension and the usual noise from a song's filename.
+
+    :param file_name: a string representing the filename of a song
+    :return: a string containing only the parts of the filename that describe the song
+    """
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    name = SPACED_UNDERSCORES.sub(' - ', name)
+    name = name.replace('_', ' ')
+    name = VIDEO_ID.sub('', name)
+    name = TRAILING_VIDEO_ID.sub('', name)
+    name = NOISE.sub('', name)
+    name = TRACK_NUMBER.sub('', name.strip())
+    return " ".join(name.split())
+
+
+def parse_filename(file_name):
+    """
+    Extract a song's metadata from its filename using the pattern library.
+
+    :param file_name: a string representing the filename of a song
+    :return: a tuple of a dictionary containing the Title, Artist and Album, and a float between 0 and 1
+             representing how confident the parser is that the metadata is right
+    """
+    name = normalize_filename(file_name)
+    for pattern, confidence in PATTERNS:
+        match = pattern.match(name)
+        if match:
+            break
+    else:
+        return {'Title': '', 'Artist': '', 'Album': ''}, 0.0
+
+    fields = match.groupdict()
+    title, artist = clean_metadata(fields.get('title') or '', fields.get('artist') or '')
+    album = (fields.get('album') or '').strip()
+    if not title:
+        return {'Title': '', 'Artist': artist, 'Album': album}, 0.0
+    if fields.get('artist') and not artist:
+        confidence = min(confidence, 0.3)
+    # Parts made of digits only or very long parts are usually leftovers the patterns did not expect
+    for part in (title, artist):
+        if part.isdigit() or len(part.split()) > 8:
+            confidence -= 0.3
+    return {'Title': title, 'Artist': artist, 'Album': album}, max(0.0, round(confidence, 2))
+
+
+def split_by_confidence(file_names, threshold=0.8):
+    """
+    Parse every filename and separate the confident results from the names that need the AI.
+
+    :param file_names: a list of strings representing the filenames of songs
+    :param threshold: a float representing the lowest confidence a result is accepted with
+    :return: a tuple of a dictionary mapping the index of each confidently parsed filename to its metadata, and
+             a list of the indexes of the filenames that need the AI
+    """
+    parsed = {}
+    unsure = []
+    for index, file_name in enumerate(file_names):
+        metadata, confidence = parse_filename(file_name)
+        if confidence >= threshold:
+            parsed[index] = metadata
+        else:
+            unsure.append(index)
+    return parsed, unsure
@@ -0,0 +1,437 @@
+"""
+This file contains the job queue that runs harvests for many users of the web app in one process.
+
+    1. Jobs are a list of filenames or an uploaded manifest of tags, and the name of the playlist to add them to
+    2. A bounded pool of workers runs every user's jobs, a slice of songs at a time, taking turns between the users
+       so that a big job does not hold up everybody else's
+    3. Each user's Spotify requests are rate limited on their own, within the limit of the whole app
+    4. The AI extraction and Spotify search caches are shared by every user
+    5. The status and progress of each job can be polled while it runs
+"""
+import csv
+import io
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from src import metrics
+from src.ai_filename_process import extract_filename_metadata
+from src.normalizer import normalize_song
+from src.rate_limit import LimiterChain, TokenBucket, call_with_retries
+from src.playlist_writer import write_tracks
+from src.spotify_api_handler import get_or_create_playlist, get_playlist_track_ids, search_song
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+MANIFEST_FIELDS = ('Title', 'Artist', 'Album', 'Duration', 'ISRC')
+BATCH_SIZE = 100
+
+
+class QueueFull(Exception):
+    """
+    Raised when a user already has as many unfinished jobs as they are allowed.
+    """
+
+
+class InvalidToken(Exception):
+    """
+    Raised when Spotify does not accept a user's token.
+    """
+
+
+def create_spotify_client(token):
+    """
+    Create a Spotify client acting for a user of the web app.
+
+    :param token: a string representing the user's OAuth access token
+    :return: a Spotify object
+    """
+    import requests
+    import spotipy
+
+    # Failed requests are retried by the job service, which shares the rate limits across threads. A plain session
+    # keeps spotipy's own retries out of the way, which would report every 5xx as a 429 without its headers
+    return spotipy.Spotify(auth=token, requests_session=requests.Session())
+
+
+def parse_manifest(text):
+    """
+    Read the songs of an uploaded manifest of tags.
+
+    :param text: a string holding either a JSON list of objects or a CSV file with a header row, with Title, Artist,
+                 Album, Duration and ISRC fields of which only Title is required
+    :raise ValueError: if the manifest cannot be read or a song has no title
+    :return: a list of dictionaries of the songs' metadata
+    """
+    text = text.strip()
+    if text.startswith('['):
+        try:
+            rows = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"the manifest is not valid JSON: {e}") from e
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    songs = []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict) or not isinstance(row.get('Title'), str) or not row['Title'].strip():
+            raise ValueError(f"song {number} of the manifest has no Title")
+        song = {'Title': row['Title'], 'Artist': row.get('Artist') or "", 'Album': row.get('Album') or ""}
+        try:
+            if row.get('Duration'):
+                song['Duration'] = float(row['Duration'])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"song {number} of the manifest has an invalid Duration") from e
+        if row.get('ISRC'):
+            song['ISRC'] = str(row['ISRC']).replace("-", "").upper()
+        songs.append(song)
+    return songs
+
+
+class Job:
+    """
+    A harvest of a list of filenames or songs into one of a user's playlists.
+    """
+
+    def __init__(self, job_id, user_id, token, playlist_name, file_names=None, songs=None):
+        """
+        :param job_id: a string representing the job's id
+        :param user_id: a string representing the Spotify id of the user who submitted the job
+        :param token: a string representing the user's OAuth access token
+        :param playlist_name: a string representing the name of the playlist, created if the user has none by it
+        :param file_names: an optional list of strings representing filenames whose metadata is extracted
+        :param songs: an optional list of dictionaries of songs' metadata, such as read from a manifest
+        """
+        self.id = job_id
+        self.user_id = user_id
+        self.token = token
+        self.playlist_name = playlist_name
+        self.file_names = list(file_names or [])
+        self.songs = list(songs or [])
+        self.status = QUEUED
+        self.error = None
+        self.playlist_id = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.processed = 0
+        self.matched = 0
+        self.duplicates = 0
+        self.added = []
+        self.failed = []
+        self.sp = None
+        self.existing_track_ids = set()
+        self.seen_keys = set()
+        self.pending_track_ids = []
+
+    @property
+    def total(self):
+        return len(self.file_names) + len(self.songs)
+
+    def to_dict(self):
+        """
+        Describe the job for the polling endpoints, leaving out the user's token.
+
+        :return: a dictionary of the job's id, status, playlist, progress and outcome
+        """
+        return {'id': self.id, 'status': self.status, 'error': self.error, 'playlist': self.playlist_name,
+                'playlist_id': self.playlist_id, 'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished,
+                'progress': {'total': self.total, 'processed': self.processed, 'matched': self.matched,
+                             'duplicates': self.duplicates, 'added': len(self.added), 'failed': len(self.failed)},
+                'added': list(self.added), 'failed': list(self.failed)}
+
+
+class JobService:
+    """
+    A bounded pool of workers that runs every user's harvest jobs in turns.
+    """
+
+    def __init__(self, workers=4, spotify_client=create_spotify_client, user_rate=2, app_rate=10,
+                 slice_size=50, max_jobs_per_user=10, max_finished_jobs=1000, max_tokens=10000, token_ttl=600,
+                 ai_options=None, search_options=None):
+        """
+        Start the workers.
+
+        :param workers: an integer representing how many slices of jobs run at the same time
+        :param spotify_client: a function that takes a user's token and returns a Spotify object acting for them
+        :param user_rate: a number representing how many Spotify requests per second each user may send
+        :param app_rate: a number representing how many Spotify requests per second every user together may send
+        :param slice_size: an integer representing how many songs of a job are handled before the next user's
+                           turn
+        :param max_jobs_per_user: an integer representing the most unfinished jobs a user may have
+        :param max_finished_jobs: an integer representing how many finished jobs are kept for polling
+        :param max_tokens: an integer representing how many tokens are remembered with the user they belong to,
+                           the least recently used are forgotten first
+        :param token_ttl: the number of seconds a token is trusted before Spotify is asked about it again, which
+                          also stops a revoked token from working for longer than that
+        :param ai_options: an optional dictionary of keyword arguments for extract_filename_metadata, such as the
+                           shared cache and limiter
+        :param search_options: an optional dictionary of keyword arguments for search_song, such as the shared
+                               cache
+        """
+        self.spotify_client = spotify_client
+        self.user_rate = user_rate
+        self.slice_size = slice_size
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_finished_jobs = max_finished_jobs
+        self.max_tokens = max_tokens
+        self.token_ttl = token_ttl
+        self.ai_options = ai_options or {}
+        self.search_options = search_options or {}
+        self._app_limiter = TokenBucket(app_rate)
+        self._user_limiters = {}
+        # The user id each recently seen token belongs to and when it has to be checked again, least recently
+        # used first
+        self._users_by_token = OrderedDict()
+        self._jobs = OrderedDict()
+        # Each user's jobs waiting for their next slice, and the users with a job waiting, in the order of their turns
+        self._waiting = {}
+        self._turns = deque()
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._workers = [threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+                         for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def identify(self, token):
+        """
+        Find the Spotify user a token belongs to, asking Spotify only when the token was not seen recently.
+
+        :param token: a string representing the user's OAuth access token
+        :raise InvalidToken: if Spotify does not accept the token
+        :return: a string representing the user's Spotify id
+        """
+        with self._condition:
+            entry = self._users_by_token.get(token)
+            if entry is not None:
+                user_id, expires = entry
+                if time.monotonic() < expires:
+                    self._users_by_token.move_to_end(token)
+                    return user_id
+                del self._users_by_token[token]
+        try:
+            user = call_with_retries(self.spotify_client(token).current_user, self._app_limiter,
+                                     endpoint='spotify.current_user')
+        except Exception as e:
+            raise InvalidToken(str(e)) from e
+        with self._condition:
+            self._users_by_token[token] = (user['id'], time.monotonic() + self.token_ttl)
+            self._users_by_token.move_to_end(token)
+            while len(self._users_by_token) > self.max_tokens:
+                self._users_by_token.popitem(last=False)
+        return user['id']
+
+    def submit(self, token, playlist_name, file_names=None, songs=None):
+        """
+        Queue a harvest job.
+
+        :param token: a string representing the user's OAuth access token
+        :param playlist_name: a string representing the name of the playlist
+        :param file_names: an optional list of strings representing filenames whose metadata is extracted
+        :param songs: an optional list of dictionaries of songs' metadata, such as returned by parse_manifest
+        :raise ValueError: if the playlist name is missing or there are no filenames or songs
+        :raise InvalidToken: if Spotify does not accept the token
+        :raise QueueFull: if the user already has max_jobs_per_user unfinished jobs
+        :return: a Job
+        """
+        if not isinstance(playlist_name, str) or not playlist_name.strip():
+            raise ValueError("a playlist name is required")
+        if not file_names and not songs:
+            raise ValueError("a list of filenames or a manifest of songs is required")
+        if file_names and not all(isinstance(name, str) and name for name in file_names):
+            raise ValueError("every filename must be a non-empty string")
+        user_id = self.identify(token)
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError("the job service is shutting down")
+            unfinished = sum(1 for job in self._jobs.values()
+                             if job.user_id == user_id and job.status in (QUEUED, RUNNING))
+            if unfinished >= self.max_jobs_per_user:
+                raise QueueFull(f"there are already {unfinished} unfinished jobs, the most is "
+                                f"{self.max_jobs_per_user}")
+            job = Job(str(next(self._ids)), user_id, token, playlist_name.strip(), file_names, songs)
+            self._jobs[job.id] = job
+            self._forget_finished()
+            self._queue(job)
+        metrics.increment('jobs_total', status='submitted')
+        return job
+
+    def get(self, job_id, user_id=None):
+        """
+        Look up a job.
+
+        :param job_id: a string representing the job's id
+        :param user_id: an optional string, when given only a job of this user is returned
+        :return: a dictionary describing the job, see Job.to_dict, or None if there is no such job
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or (user_id is not None and job.user_id != user_id):
+                return None
+            return job.to_dict()
+
+    def list_jobs(self, user_id):
+        """
+        List a user's jobs, the newest last.
+
+        :param user_id: a string representing the user's Spotify id
+        :return: a list of dictionaries describing the jobs, see Job.to_dict
+        """
+        with self._condition:
+            return [job.to_dict() for job in self._jobs.values() if job.user_id == user_id]
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once they finish their current slices, the queued jobs are left unfinished.
+
+        :param wait: a boolean, whether to wait for the workers to stop
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _queue(self, job):
+        """
+        Put a job at the back of its user's line, and the user at the back of the turns if they were not waiting.
+        """
+        waiting = self._waiting.setdefault(job.user_id, deque())
+        if not waiting:
+            self._turns.append(job.user_id)
+        waiting.append(job)
+        self._condition.notify()
+
+    def _next_job(self):
+        """
+        Wait for the next user's turn and take their first waiting job.
+
+        :return: a Job, or None if the service is stopping
+        """
+        with self._condition:
+            while not self._turns and not self._stopping:
+                self._condition.wait()
+            if self._stopping:
+                return None
+            user_id = self._turns.popleft()
+            waiting = self._waiting[user_id]
+            job = waiting.popleft()
+            if waiting:
+                self._turns.append(user_id)
+            else:
+                del self._waiting[user_id]
+            return job
+
+    def _forget_finished(self):
+        """
+        Drop the oldest finished jobs beyond max_finished_jobs.
+        """
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (FINISHED, FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def _limiter(self, user_id):
+        with self._condition:
+            limiter = self._user_limiters.get(user_id)
+            if limiter is None:
+                limiter = self._user_limiters[user_id] = LimiterChain(TokenBucket(self.user_rate), self._app_limiter)
+            return limiter
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                done = self._run_slice(job)
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                with self._condition:
+                    job.status, job.error, job.finished = FAILED, str(e), time.time()
+                    job.sp = None
+                metrics.increment('jobs_total', status=FAILED)
+                continue
+            with self._condition:
+                if done:
+                    job.status, job.finished = FINISHED, time.time()
+                    job.sp = None
+                    metrics.increment('jobs_total', status=FINISHED)
+                else:
+                    self._queue(job)
+
+    def _run_slice(self, job):
+        """
+        Handle the next slice of a job's songs.
+
+        :param job: a Job
+        :return: a boolean value, True if the job is done, False if it has songs left
+        """
+        limiter = self._limiter(job.user_id)
+        if job.sp is None:
+            with self._condition:
+                job.status, job.started = RUNNING, job.started or time.time()
+            metrics.observe('job_queue_wait_seconds', job.started - job.submitted)
+            job.sp = self.spotify_client(job.token)
+            limiter.acquire()
+            playlist_id = get_or_create_playlist(job.sp, job.user_id, job.playlist_name)
+            if playlist_id is None:
+                raise RuntimeError(f"could not get or create the playlist {job.playlist_name}")
+            job.existing_track_ids = get_playlist_track_ids(job.sp, playlist_id, limiter=limiter)
+            with self._condition:
+                job.playlist_id = playlist_id
+
+        start = job.processed
+        end = min(start + self.slice_size, job.total)
+        songs = job.songs[start:end] if start < len(job.songs) else []
+        names = job.file_names[max(0, start - len(job.songs)):max(0, end - len(job.songs))]
+        if names:
+            try:
+                songs += extract_filename_metadata(names, **self.ai_options)
+            except Exception as e:
+                print(f"Could not extract the metadata of {len(names)} filename(s): {e}")
+                songs += [None] * len(names)
+                with self._condition:
+                    job.failed.extend(names)
+
+        for song in songs:
+            if song is not None:
+                self._search(job, song, limiter)
+            with self._condition:
+                job.processed += 1
+        done = job.processed >= job.total
+        if job.pending_track_ids and (done or len(job.pending_track_ids) >= BATCH_SIZE):
+            batch, job.pending_track_ids = job.pending_track_ids, []
+            written = write_tracks(job.sp, job.playlist_id, batch, limiter=limiter)
+            with self._condition:
+                job.added.extend(written['added'])
+                job.failed.extend(written['failed'])
+        return done
+
+    def _search(self, job, song, limiter):
+        """
+        Search Spotify for one of a job's songs and queue its track to be added if it is new to the playlist.
+        """
+        normalized_song = normalize_song(song.get('Title') or "", song.get('Artist') or "")
+        # Songs without a title have nothing to tell them apart, so none of them is the duplicate of another
+        if normalized_song.title:
+            if normalized_song.key in job.seen_keys:
+                with self._condition:
+                    job.duplicates += 1
+                return
+            job.seen_keys.add(normalized_song.key)
+        track_id, failure = search_song(job.sp, song, **dict(self.search_options, limiter=limiter))
+        with self._condition:
+            if failure is not None:
+                job.failed.append(failure)
+                return
+            job.matched += 1
+            if track_id not in job.existing_track_ids:
+                job.existing_track_ids.add(track_id)
+                job.pending_track_ids.append(track_id)
@@ -1,55 +1,348 @@
+"""
+The command line entry point of AudioReaper.
+
+Run from the project's root with:
+    python -m src.main "D:/Music" --playlist "My Library"
+
+Without a folder or a playlist name, and when run from a terminal, the folder is picked in a dialog and the name
+is asked for, as before. The heavy modules (spotipy, openai, tkinter) are only imported once a run needs them, so
+that --help and --scan-only start quickly on headless servers.
+"""
+import argparse
+import json
 import os
-from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from src.ai_filename_process import process_response, invoke_prompt_to_ai
-from src.fileIO import select_folder, media_file_finder, metadata_harvester, failed_csv_writer, read_failed_tracks
-from src.spotify_api_handler import get_or_create_playlist, search_songs_not_in_playlist, add_songs_to_playlist
+from src import metrics
+from src.cache import AI_CACHE_TTL, SEARCH_CACHE_TTL, SqliteCache, default_cache_path
+from src.fileIO import media_file_finder, read_song_tags, select_folder
+from src.filename_parser import parse_filename
+from src.pipeline import PipelineError, run_pipeline
+from src.playlist_sync import SyncState, default_state_path, sync_playlist
+from src.rate_limit import TokenBucket
+from src.run_journal import RunJournal, default_journal_path, is_finished, read_journal, summarize
+from src.spotify_api_handler import find_playlist, get_or_create_playlist
+from src.tag_index import TagIndex
 
+REDIRECT_URI = 'http://localhost:8888'
 
-def main():
-    load_dotenv()
-    client_id = os.getenv('SPOTIFY_CLIENT_ID')
-    client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
-    redirect_uri = 'http://localhost:8888'
 
-    # Authenticate with Spotify API and instantiate a Spotify object
-    sp = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(client_id, client_secret, redirect_uri,
-                                  scope='playlist-modify-public playlist-modify-private playlist-read-private',
-                                  open_browser=True))
+def parse_arguments(arguments=None):
+    """
+    Parse the command line arguments.
+
+    :param arguments: a list of strings representing the arguments, defaults to sys.argv[1:]
+    :return: an argparse.Namespace of the parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog="audioreaper",
+                                     description="Harvest a folder of audio files into a Spotify playlist.")
+    parser.add_argument('directory', nargs='?', help="folder to harvest, picked in a dialog when left out")
+    parser.add_argument('-p', '--playlist', help="name of the playlist to add the songs to, created if needed")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="files read and songs searched at the same time (default: %(default)s)")
+    parser.add_argument('--ai-workers', type=int, default=2,
+                        help="batches of filenames sent to the AI at the same time (default: %(default)s)")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="search for the songs without creating or changing the playlist")
+    parser.add_argument('--sync', action='store_true',
+                        help="keep the playlist in line with the folder, only handling the files added, changed or "
+                             "removed since the last sync")
+    parser.add_argument('--fast-tags', action='store_true',
+                        help="read MP3 and WAV tags from their headers only, falling back to the full parser for "
+                             "the files it cannot handle")
+    parser.add_argument('--scan-only', action='store_true',
+                        help="only read the tags and parse the filenames, without calling any API")
+    parser.add_argument('-o', '--report', help="JSON file to write the outcome of every file to")
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=None,
+                        help="pick up the last unfinished harvest of the folder, asked when left out")
+    parser.add_argument('--cache-dir', help="folder to keep the tag index and the API caches in "
+                                            "(default: the 'cache' folder of the project)")
+    parser.add_argument('--metrics', action='store_true', default=bool(os.getenv('AUDIOREAPER_METRICS')),
+                        help="print a report of the run's metrics at the end")
+    parser.add_argument('--metrics-file', default=os.getenv('AUDIOREAPER_METRICS_FILE'),
+                        help="file to write the run's metrics to in the Prometheus text format")
+    return parser.parse_args(arguments)
+
+
+def cache_path(arguments, file_name):
+    """
+    Get the path of a cache file, inside the folder given with --cache-dir if there is one.
+
+    :param arguments: an argparse.Namespace returned by parse_arguments
+    :param file_name: a string representing the name of the cache file
+    :return: a string representing the path of the cache file
+    """
+    if arguments.cache_dir:
+        return os.path.join(arguments.cache_dir, file_name)
+    return default_cache_path(file_name)
+
+
+def interactive():
+    """
+    Check if the program can ask the user for input.
+
+    :return: a boolean value, True if it runs in a terminal, False otherwise
+    """
+    return sys.stdin is not None and sys.stdin.isatty()
+
+
+def choose_directory():
+    """
+    Let the user pick the folder to harvest in a dialog.
+
+    :return: a string representing the path of the selected folder
+    """
     target_directory = ""
     while not target_directory:
         try:
             target_directory = select_folder()
         except FileNotFoundError:
             print("No folder selected")
-        else:
-            print("Harvesting audio files from " + target_directory + "...")
-    playlist_name = input("Please enter the name of the playlist you would like to create:")
-    library_size = len(os.listdir(target_directory))
-    print(f"Harvesting %i audio files..." % library_size)
-
-    audio_files = media_file_finder(target_directory)
-    metadata, files_without_metadata = metadata_harvester(audio_files)
-    print("The following files have no metadata:", files_without_metadata)
-    filename_data = process_response(invoke_prompt_to_ai(files_without_metadata))
-    # print(filename_data)
-    metadata.extend(filename_data)
-    playlist_id = get_or_create_playlist(sp, sp.current_user()['id'], playlist_name)
-
-    new_songs, failed_tracks = search_songs_not_in_playlist(sp, playlist_id, metadata)
-    failed_csv_writer(failed_tracks)
-    added_tracks = add_songs_to_playlist(sp, playlist_id, new_songs)
+    return target_directory
+
+
+def create_spotify_client():
+    """
+    Authenticate with the Spotify API using the credentials in the environment.
+
+    :return: an authenticated Spotify object
+    """
+    from dotenv import load_dotenv
+    import requests
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
+    load_dotenv()
+    return spotipy.Spotify(
+        auth_manager=SpotifyOAuth(os.getenv('SPOTIFY_CLIENT_ID'), os.getenv('SPOTIFY_CLIENT_SECRET'), REDIRECT_URI,
+                                  scope='playlist-modify-public playlist-modify-private playlist-read-private',
+                                  open_browser=interactive()),
+        # Failed requests are retried by the pipeline, which shares the rate limit across threads. A plain session
+        # keeps spotipy's own retries out of the way, which would report every 5xx as a 429 without its headers
+        requests_session=requests.Session())
+
+
+def scan_library(target_directory, workers, index, fast_tags=False):
+    """
+    Read the tags of every file in a folder and parse the filenames of the untagged ones, without calling any API.
+
+    :param target_directory: a string representing the path of the folder to scan
+    :param workers: an integer representing how many files are read at the same time
+    :param index: a TagIndex used to skip the files that did not change
+    :param fast_tags: a boolean, whether to read the tags with the header-only parser, see metadata_harvester
+    :return: a list with a dictionary for each file holding its 'File', 'Status' and 'Song' metadata, the status
+             is 'tagged', 'parsed' for filenames the parser is confident about or 'needs ai'
+    """
+    files = list(media_file_finder(target_directory))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        harvested = list(executor.map(partial(read_song_tags, index=index, fast_tags=fast_tags), files))
+    report = []
+    for file, (tags, _) in zip(files, harvested):
+        if tags:
+            report.append({'File': file, 'Status': 'tagged', 'Song': tags})
+            continue
+        song, confidence = parse_filename(file)
+        report.append({'File': file, 'Status': 'parsed' if confidence >= 0.8 else 'needs ai', 'Song': song})
+    index.prune(files, root=target_directory)
+    return report
+
+
+def harvest(sp, playlist_id, target_directory, arguments, journal=None, resume=False):
+    """
+    Run the pipeline that harvests a folder into a playlist, with the caches of earlier runs.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id, or None for a dry run without the playlist
+    :param target_directory: a string representing the path of the folder to harvest
+    :param arguments: an argparse.Namespace returned by parse_arguments
+    :param journal: an optional RunJournal
+    :param resume: a boolean, whether to pick up the journal's unfinished files
+    :return: a tuple returned by run_pipeline
+    """
+    # Every stage runs at the same time, so the first tracks reach the playlist while the library is still scanned
+    with TagIndex(cache_path(arguments, 'tag_index.sqlite3')) as index, \
+            SqliteCache(cache_path(arguments, 'ai_extraction.sqlite3'), max_entries=100000,
+                        ttl=AI_CACHE_TTL) as ai_cache, \
+            SqliteCache(cache_path(arguments, 'spotify_search.sqlite3'), max_entries=200000,
+                        ttl=SEARCH_CACHE_TTL) as search_cache, \
+            SqliteCache(cache_path(arguments, 'playlist_snapshots.sqlite3'), max_entries=1000) as playlist_cache:
+        results = run_pipeline(
+            sp, playlist_id, target_directory, index=index, harvest_workers=arguments.workers,
+            extract_workers=arguments.ai_workers, search_workers=arguments.workers,
+            ai_options={'batch_size': 20, 'max_in_flight': 4, 'limiter': TokenBucket(rate=2), 'cache': ai_cache},
+            search_options={'latency_budget': 60, 'cache': search_cache}, playlist_cache=playlist_cache,
+            spotify_limiter=TokenBucket(rate=10, capacity=20), dry_run=arguments.dry_run, journal=journal,
+            resume=resume, fast_tags=arguments.fast_tags)
+        index.prune((entry['File'] for entry in results[2]), root=target_directory)
+        print(f"AI extraction cache: {ai_cache.stats()}")
+        print(f"Spotify search cache: {search_cache.stats()}")
+    return results
+
+
+def run_harvest(sp, playlist_name, target_directory, arguments):
+    """
+    Harvest a folder into a playlist, creating the playlist if needed, and print a summary.
+
+    :param sp: authenticated Spotify object
+    :param playlist_name: a string representing the name of the playlist
+    :param target_directory: a string representing the path of the folder to harvest
+    :param arguments: an argparse.Namespace returned by parse_arguments
+    :return: a dictionary of the run's outcome, or None if the playlist could not be created
+    """
+    if arguments.dry_run:
+        # A dry run does not change anything on Spotify, including creating the playlist
+        playlist_id = find_playlist(sp, playlist_name)
+        added_tracks, failed_tracks, files = harvest(sp, playlist_id, target_directory, arguments)
+        journal_summary = None
+    else:
+        playlist_id = get_or_create_playlist(sp, sp.current_user()['id'], playlist_name)
+        if playlist_id is None:
+            return None
+        journal_path = default_journal_path(playlist_id, target_directory)
+        resume = arguments.resume
+        states = read_journal(journal_path)
+        unfinished = sum(1 for state in states.values() if not is_finished(state, states))
+        if resume is None:
+            resume = False
+            if unfinished and interactive():
+                answer = input(f"The last harvest of this folder left {unfinished} file(s) unfinished. "
+                               f"Resume it? (y/n):")
+                resume = answer.strip().lower().startswith('y')
+        with RunJournal(journal_path) as journal:
+            added_tracks, failed_tracks, files = harvest(sp, playlist_id, target_directory, arguments, journal,
+                                                         resume)
+            journal_summary = summarize(journal.load())
     # print("Second chance! Retrying failed tracks...")
     # round_two = [search_songs_not_in_playlist(sp, playlist_id, track) for track in failed_tracks]
     # add_songs_to_playlist(sp, playlist_id, round_two)
     print("========================================")
-    print(f"Added {len(added_tracks)} song(s) to the playlist.")
+    verb = "Would add" if arguments.dry_run else "Added"
+    print(f"{verb} {len(added_tracks)} song(s) to the playlist.")
+    duplicates = sum(1 for entry in files if entry['Status'] == 'duplicate')
+    print(f"Skipped {duplicates} duplicate file(s) of songs already searched for.")
+    print(f"{len(failed_tracks)} song(s) failed.")
+    if journal_summary is not None:
+        print(f"Files by their latest stage: {journal_summary}, see the run journal at {journal_path}")
+    return {'directory': target_directory, 'playlist': playlist_name, 'playlist_id': playlist_id,
+            'dry_run': arguments.dry_run, 'added': added_tracks, 'failed': failed_tracks, 'files': files}
+
+
+def run_sync(sp, playlist_name, target_directory, arguments):
+    """
+    Sync a folder into a playlist, creating the playlist if needed, and print a summary.
+
+    :param sp: authenticated Spotify object
+    :param playlist_name: a string representing the name of the playlist
+    :param target_directory: a string representing the path of the folder to sync
+    :param arguments: an argparse.Namespace returned by parse_arguments
+    :return: a dictionary of the sync's outcome, or None if there is no playlist to sync with
+    """
+    if arguments.dry_run:
+        playlist_id = find_playlist(sp, playlist_name)
+    else:
+        playlist_id = get_or_create_playlist(sp, sp.current_user()['id'], playlist_name)
+    if playlist_id is None:
+        print(f"No playlist named {playlist_name} to sync the folder with.", file=sys.stderr)
+        return None
+    state_path = default_state_path(playlist_id, target_directory)
+    if arguments.cache_dir:
+        state_path = cache_path(arguments, os.path.basename(state_path))
+    with TagIndex(cache_path(arguments, 'tag_index.sqlite3')) as index, \
+            SqliteCache(cache_path(arguments, 'ai_extraction.sqlite3'), max_entries=100000,
+                        ttl=AI_CACHE_TTL) as ai_cache, \
+            SqliteCache(cache_path(arguments, 'spotify_search.sqlite3'), max_entries=200000,
+                        ttl=SEARCH_CACHE_TTL) as search_cache, \
+            SqliteCache(cache_path(arguments, 'playlist_snapshots.sqlite3'), max_entries=1000) as playlist_cache, \
+            SyncState(state_path) as state:
+        summary = sync_playlist(
+            sp, playlist_id, target_directory, state, index=index, workers=arguments.workers,
+            ai_options={'batch_size': 20, 'max_in_flight': 4, 'limiter': TokenBucket(rate=2), 'cache': ai_cache},
+            search_options={'latency_budget': 60, 'cache': search_cache}, playlist_cache=playlist_cache,
+            limiter=TokenBucket(rate=10, capacity=20), dry_run=arguments.dry_run, fast_tags=arguments.fast_tags)
+    print("========================================")
+    if arguments.dry_run:
+        print(f"Would add {len(summary['added'])} and remove {len(summary['removed'])} song(s).")
+    else:
+        print(f"Added {len(summary['added'])} and removed {len(summary['removed'])} song(s).")
+    print(f"{summary['unchanged_files']} file(s) did not change since the last sync.")
+    print(f"{len(summary['failed'])} song(s) failed.")
+    return dict(summary, directory=target_directory, playlist=playlist_name, playlist_id=playlist_id,
+                dry_run=arguments.dry_run)
+
+
+def write_report(path, report):
+    """
+    Write the report of a run to a JSON file.
+
+    :param path: a string representing the path of the report file
+    :param report: a dictionary of the run's outcome
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print(f"Wrote the report to {path}")
+
+
+def main(arguments=None):
+    """
+    Harvest a folder into a Spotify playlist from the command line.
+
+    :param arguments: a list of strings representing the arguments, defaults to sys.argv[1:]
+    :return: an integer representing the exit status
+    """
+    arguments = parse_arguments(arguments)
+    metrics.enable(arguments.metrics or bool(arguments.metrics_file))
+    target_directory = arguments.directory
+    if not target_directory:
+        if not interactive():
+            print("No folder given, pass the folder to harvest as an argument.", file=sys.stderr)
+            return 2
+        target_directory = choose_directory()
+    if not os.path.isdir(target_directory):
+        print(f"Folder not found: {target_directory}", file=sys.stderr)
+        return 2
+    print("Harvesting audio files from " + target_directory + "...")
+
+    if arguments.scan_only:
+        with TagIndex(cache_path(arguments, 'tag_index.sqlite3')) as index:
+            files = scan_library(target_directory, arguments.workers, index, arguments.fast_tags)
+        statuses = {}
+        for entry in files:
+            statuses[entry['Status']] = statuses.get(entry['Status'], 0) + 1
+        print(f"Scanned {len(files)} file(s): {statuses}")
+        report = {'directory': target_directory, 'files': files}
+    else:
+        playlist_name = arguments.playlist
+        if not playlist_name:
+            if not interactive():
+                print("No playlist given, pass its name with --playlist.", file=sys.stderr)
+                return 2
+            playlist_name = input("Please enter the name of the playlist you would like to create:")
+        sp = create_spotify_client()
+        run = run_sync if arguments.sync else run_harvest
+        try:
+            report = run(sp, playlist_name, target_directory, arguments)
+        except PipelineError as e:
+            print(f"The harvest was aborted: {e}", file=sys.stderr)
+            return 1
+        if report is None:
+            return 1
+
+    if metrics.is_enabled():
+        print("========================================")
+        print(metrics.format_report())
+        report['metrics'] = metrics.report()
+        if arguments.metrics_file:
+            metrics.write_prometheus(arguments.metrics_file)
+            print(f"Wrote the metrics to {arguments.metrics_file}")
+    if arguments.report:
+        write_report(arguments.report, report)
     print("========================================")
     print("AudioReaper has finished harvesting your audio files.")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+This file contains the scoring engine that picks the Spotify track matching a song.
+
+Candidates whose length is far from the song's are dropped before any scoring. Each remaining candidate's title,
+artist, album and duration are scored separately and combined with weights, a whole list of candidates is scored
+per call of the C-backed scorer, and the best candidate is only accepted when its score reaches a threshold.
+"""
+from collections import namedtuple
+
+from src.normalizer import normalize_song
+
+SongQuery = namedtuple('SongQuery', ['title', 'artist', 'album', 'duration'])
+
+WEIGHTS = {'title': 0.55, 'artist': 0.3, 'album': 0.05, 'duration': 0.1}
+DEFAULT_THRESHOLD = 70
+# A candidate whose length differs by this many seconds or more gets no duration score
+DURATION_TOLERANCE = 10
+# A candidate whose length differs by more than this many seconds is a different recording, such as a live or
+# extended version, and is not scored at all
+MAX_DURATION_DIFFERENCE = 30
+
+_ratio_scores = None
+
+
+def _get_ratio_scores():
+    """
+    Get the function scoring one string against a list of strings, using rapidfuzz when it is installed and
+    falling back to fuzzywuzzy otherwise.
+
+    :return: a function that takes a string and a list of strings and returns a list of scores from 0 to 100
+    """
+    global _ratio_scores
+    if _ratio_scores is None:
+        try:
+            from rapidfuzz import fuzz, process
+
+            def rapidfuzz_scores(query, choices):
+                scores = [0.0] * len(choices)
+                for _, score, index in process.extract(query, choices, scorer=fuzz.ratio, limit=None):
+                    scores[index] = score
+                return scores
+            _ratio_scores = rapidfuzz_scores
+        except ImportError:
+            from fuzzywuzzy import fuzz
+
+            def fuzzywuzzy_scores(query, choices):
+                return [fuzz.ratio(query, choice) for choice in choices]
+            _ratio_scores = fuzzywuzzy_scores
+    return _ratio_scores
+
+
+def make_query(title, artist, album="", duration=None):
+    """
+    Build the query a song's candidates are scored against.
+
+    :param title: a string representing the song's title
+    :param artist: a string representing the song's artist
+    :param album: a string representing the song's album
+    :param duration: a number representing the song's length in seconds, or None if unknown
+    :return: a SongQuery tuple of the folded title, artist and album and the duration
+    """
+    title_key, artist_key = normalize_song(title or "", artist or "").key.split("|")
+    album_key = normalize_song(album or "", "").key.split("|")[0]
+    return SongQuery(title_key, artist_key, album_key, duration)
+
+
+def _candidate_fields(track):
+    """
+    Get the folded title, artists, album and duration of a Spotify track.
+
+    :param track: a dictionary representing a track returned by the Spotify API
+    :return: a tuple of the title, a list of every artist, the album and the duration in seconds or None
+    """
+    artists = [artist['name'] for artist in track.get('artists') or []]
+    title = normalize_song(track.get('name') or "", "").key.split("|")[0]
+    artist_keys = [normalize_song("", name).key.split("|")[1] for name in artists] or [""]
+    album = normalize_song((track.get('album') or {}).get('name') or "", "").key.split("|")[0]
+    duration_ms = track.get('duration_ms')
+    return title, artist_keys, album, duration_ms / 1000 if duration_ms else None
+
+
+def score_candidates(query, tracks):
+    """
+    Score every candidate track against a song.
+
+    :param query: a SongQuery tuple, see make_query
+    :param tracks: a list of dictionaries representing tracks returned by the Spotify API
+    :return: a list of scores from 0 to 100, one for each track in the same order
+    """
+    return _score_fields(query, [_candidate_fields(track) for track in tracks])
+
+
+def _score_fields(query, fields):
+    """
+    Score the fields of every candidate track against a song.
+
+    :param query: a SongQuery tuple, see make_query
+    :param fields: a list of tuples returned by _candidate_fields
+    :return: a list of scores from 0 to 100, one for each candidate in the same order
+    """
+    if not fields:
+        return []
+    ratio_scores = _get_ratio_scores()
+    title_scores = ratio_scores(query.title, [title for title, _, _, _ in fields])
+    if query.artist:
+        # Every artist of every candidate is scored in one call, then each candidate keeps its best artist
+        all_artists = [artist for _, artists, _, _ in fields for artist in artists]
+        all_scores = iter(ratio_scores(query.artist, all_artists))
+        artist_scores = [max(next(all_scores) for _ in artists) for _, artists, _, _ in fields]
+    if query.album:
+        album_scores = ratio_scores(query.album, [album for _, _, album, _ in fields])
+
+    scores = []
+    for index, (_, _, _, duration) in enumerate(fields):
+        weighted = [(WEIGHTS['title'], title_scores[index])]
+        if query.artist:
+            weighted.append((WEIGHTS['artist'], artist_scores[index]))
+        if query.album:
+            weighted.append((WEIGHTS['album'], album_scores[index]))
+        if query.duration and duration:
+            difference = abs(query.duration - duration)
+            weighted.append((WEIGHTS['duration'], max(0.0, 100 * (1 - difference / DURATION_TOLERANCE))))
+        total_weight = sum(weight for weight, _ in weighted)
+        scores.append(sum(weight * score for weight, score in weighted) / total_weight)
+    return scores
+
+
+def best_match(query, tracks, threshold=DEFAULT_THRESHOLD):
+    """
+    Find the candidate that best matches a song, skipping the candidates of a very different length and stopping
+    early on an exact match.
+
+    :param query: a SongQuery tuple, see make_query
+    :param tracks: a list of dictionaries representing tracks returned by the Spotify API
+    :param threshold: a number from 0 to 100 representing the lowest score a match is accepted with
+    :return: a tuple of the best matching track, or None if no candidate reached the threshold, and its score
+    """
+    fields = [_candidate_fields(track) for track in tracks]
+    if query.duration:
+        kept = [(track, candidate) for track, candidate in zip(tracks, fields)
+                if not candidate[3] or abs(query.duration - candidate[3]) <= MAX_DURATION_DIFFERENCE]
+        tracks = [track for track, _ in kept]
+        fields = [candidate for _, candidate in kept]
+    for track, (title, artists, _, duration) in zip(tracks, fields):
+        duration_agrees = not (query.duration and duration) or abs(query.duration - duration) < 3
+        if title == query.title and (not query.artist or query.artist in artists) and duration_agrees:
+            return track, 100.0
+    scores = _score_fields(query, fields)
+    if not scores:
+        return None, 0.0
+    best_score = max(scores)
+    if best_score < threshold:
+        return None, best_score
+    return tracks[scores.index(best_score)], best_score
+
+
+def best_matches(queries, candidate_lists, threshold=DEFAULT_THRESHOLD):
+    """
+    Find the best match of many songs, calling best_match for each of them in turn. Each song only has its own
+    candidates, so every call already scores all of them at once.
+
+    :param queries: a list of SongQuery tuples
+    :param candidate_lists: a list of lists of candidate tracks, one for each query
+    :param threshold: a number from 0 to 100 representing the lowest score a match is accepted with
+    :return: a list of tuples of the best matching track or None and its score, one for each query
+    """
+    return [best_match(query, tracks, threshold) for query, tracks in zip(queries, candidate_lists)]
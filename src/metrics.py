@@ -0,0 +1,258 @@
+"""
+This file contains the lightweight metrics collected during a harvest.
+
+    1. Counters, such as retries, 429 responses, cache hits and failures
+    2. Histograms of durations, such as the latency of each external call and the time spent in each stage
+    3. An end-of-run report and the Prometheus text exposition format
+
+Metrics are off until enable() is called, and while they are off every function returns straight away so that
+instrumented code runs as fast as it did without them.
+"""
+import bisect
+import contextlib
+import functools
+import os
+import threading
+import time
+
+PREFIX = "audioreaper_"
+# The upper bounds in seconds of the histogram buckets, the last bucket holds everything slower
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_NO_TIMER = contextlib.nullcontext()
+
+
+def enable(enabled=True):
+    """
+    Turn the collection of metrics on or off.
+
+    :param enabled: a boolean, whether to collect metrics
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    """
+    Check if metrics are being collected.
+
+    :return: a boolean value, True if metrics are being collected, False otherwise
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Forget every metric collected so far.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add to a counter.
+
+    :param name: a string representing the name of the counter, such as 'retries_total'
+    :param amount: a number to add to the counter
+    :param labels: strings that tell apart the series of the counter, such as endpoint='spotify.search'
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration in a histogram.
+
+    :param name: a string representing the name of the histogram, such as 'api_call_seconds'
+    :param seconds: a number representing the duration in seconds
+    :param labels: strings that tell apart the series of the histogram
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * (len(BUCKETS) + 1), 'count': 0, 'sum': 0.0,
+                                            'max': 0.0}
+        histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+
+
+class _Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def timer(name, **labels):
+    """
+    Time a block of code into a histogram, for use in a with statement.
+
+    :param name: a string representing the name of the histogram
+    :param labels: strings that tell apart the series of the histogram
+    :return: a context manager that records how long its block took
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(name, labels)
+
+
+def stage(name):
+    """
+    Time a stage of a harvest, for use in a with statement.
+
+    :param name: a string representing the name of the stage, such as 'harvest'
+    :return: a context manager that records how long the stage took
+    """
+    return timer('stage_seconds', stage=name)
+
+
+def timed_stage(name):
+    """
+    Time every call of a function as a stage of a harvest, for use as a decorator.
+
+    :param name: a string representing the name of the stage
+    :return: a decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _quantile(histogram, fraction):
+    """
+    Estimate a quantile of a histogram as the upper bound of the bucket it falls in.
+    """
+    target = fraction * histogram['count']
+    seen = 0
+    for bound, count in zip(BUCKETS, histogram['buckets']):
+        seen += count
+        if seen >= target:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+
+def _series_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in labels) + "}"
+
+
+def report():
+    """
+    Build a structured report of every metric collected so far.
+
+    :return: a dictionary with a 'counters' dictionary mapping each series to its value, and a 'histograms'
+             dictionary mapping each series to its count, total, mean, estimated 50th and 95th percentile and
+             maximum in seconds
+    """
+    with _lock:
+        counters = {_series_name(name, labels): value for (name, labels), value in sorted(_counters.items())}
+        histograms = {}
+        for (name, labels), histogram in sorted(_histograms.items()):
+            count = histogram['count']
+            histograms[_series_name(name, labels)] = {
+                'count': count, 'total': round(histogram['sum'], 4),
+                'mean': round(histogram['sum'] / count, 4) if count else 0.0,
+                'p50': round(_quantile(histogram, 0.5), 4), 'p95': round(_quantile(histogram, 0.95), 4),
+                'max': round(histogram['max'], 4)}
+    return {'counters': counters, 'histograms': histograms}
+
+
+def format_report(metrics_report=None):
+    """
+    Format a report as text to print at the end of a run.
+
+    :param metrics_report: a dictionary returned by report(), defaults to the current metrics
+    :return: a string with a line for each series
+    """
+    metrics_report = metrics_report or report()
+    lines = ["Counters:"]
+    lines += [f"  {name}: {value}" for name, value in metrics_report['counters'].items()]
+    lines.append("Timings (seconds):")
+    for name, histogram in metrics_report['histograms'].items():
+        lines.append(f"  {name}: count={histogram['count']} total={histogram['total']} mean={histogram['mean']} "
+                     f"p50<={histogram['p50']} p95<={histogram['p95']} max={histogram['max']}")
+    return "\n".join(lines)
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+
+def prometheus_text():
+    """
+    Export every metric collected so far in the Prometheus text exposition format.
+
+    :return: a string that a Prometheus server or a node exporter's textfile collector can read
+    """
+    lines = []
+    with _lock:
+        counter_names = sorted({name for name, _ in _counters})
+        for counter_name in counter_names:
+            lines.append(f"# TYPE {PREFIX}{counter_name} counter")
+            for (name, labels), value in sorted(_counters.items()):
+                if name == counter_name:
+                    lines.append(f"{PREFIX}{name}{_labels_text(labels)} {value}")
+        histogram_names = sorted({name for name, _ in _histograms})
+        for histogram_name in histogram_names:
+            lines.append(f"# TYPE {PREFIX}{histogram_name} histogram")
+            for (name, labels), histogram in sorted(_histograms.items()):
+                if name != histogram_name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket{_labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{_labels_text(labels)} {histogram['sum']}")
+                lines.append(f"{PREFIX}{name}_count{_labels_text(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """
+    Write every metric collected so far to a file in the Prometheus text exposition format.
+
+    The file is replaced in one step, so a node exporter's textfile collector never reads it half written.
+
+    :param path: a string representing the path of the file, which should end in '.prom'
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        file.write(prometheus_text())
+    os.replace(temporary_path, path)
@@ -0,0 +1,135 @@
+"""
+This file contains the batch normalizer for song metadata.
+
+It does what clean_metadata does for one song, with every pattern compiled once and repeated inputs memoized,
+and adds a Unicode normalized, case-folded search key that dedupe, caching and matching can share.
+"""
+import gc
+import re
+import unicodedata
+from collections import namedtuple
+from functools import lru_cache
+
+NormalizedSong = namedtuple('NormalizedSong', ['title', 'artist', 'artists', 'key'])
+
+TITLE_EXTRAS = re.compile(r' - Copy| \(HD\)| \(Official Video\)')
+# The lookaheads list the first character of every alternative, which lets the regex engine skip the positions no
+# alternative can start at instead of trying each of them there
+TITLE_NOISE = re.compile(r'(?=[-(\[{fov\d])(?:\(.*\)|\[.*]|{.*}|(?:-|ft\.|feat\.|official|video|\d+kbps).*)',
+                         flags=re.I)
+ARTIST_NOISE = re.compile(r'(?=[(\[{ov])(?:\(.*\)|\[.*]|{.*}|(?:official|video).*)', flags=re.I)
+# A slash only separates artists with spaces around it, so that names such as AC/DC stay whole
+ARTIST_SEPARATORS = re.compile(r'(?=[\s,;])\s*(?:[,;]|\s(?:/|feat\.?|ft\.?|featuring|x|×|vs\.?)\s)\s*', flags=re.I)
+NON_WORD = re.compile(r'[\W_]+')
+COMBINING_MARKS = re.compile(r'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]+')
+# Lowercases the ASCII letters and maps every other character that NON_WORD matches to a space, which folds ASCII
+# text in one pass without a regex
+ASCII_FOLD = bytes(ord(chr(code).lower()) if chr(code).isascii() and chr(code).isalnum() else 32
+                   for code in range(256))
+
+
+def normalize_batch(songs):
+    """
+    Normalize the title and artist of every song in one call.
+
+    :param songs: an iterable of dictionaries containing songs' metadata, with Title and Artist keys
+    :return: a list of NormalizedSong tuples of the cleaned title, the cleaned first artist, a tuple of every
+             artist and the search key, one for each song in the same order
+    """
+    normalized = {}
+    results = []
+    # Every tuple the batch makes outlives it, so the collections they would set off scan ever more of them without
+    # freeing any
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for song in songs:
+            pair = (song.get('Title') or "", song.get('Artist') or "")
+            # The batch's own dictionary memoizes the repeats within it, which spares the songs seen only once the
+            # bookkeeping of the shared cache
+            result = normalized.get(pair)
+            if result is None:
+                result = normalized[pair] = _normalize_song(*pair)
+            results.append(result)
+    finally:
+        if collecting:
+            gc.enable()
+    return results
+
+
+@lru_cache(maxsize=1 << 18)
+def normalize_song(title, artist):
+    """
+    Normalize a song's title and artist, memoizing repeated inputs.
+
+    :param title: a string representing the song's title
+    :param artist: a string representing the song's artist, or None
+    :return: a NormalizedSong tuple of the cleaned title, the cleaned first artist, a tuple of every artist and
+             the search key
+    """
+    return _normalize_song(title, artist)
+
+
+def _normalize_song(title, artist):
+    artist = artist or ""
+    if not title.isascii():
+        title = unicodedata.normalize('NFC', title)
+    if not artist.isascii():
+        artist = unicodedata.normalize('NFC', artist)
+    # Every one of the extras starts with one of these, and most titles have neither
+    if " - Copy" in title or " (" in title:
+        title = TITLE_EXTRAS.sub("", title)
+    title = title.strip()
+
+    # Handle case where artist and title are combined in 'Title' field
+    if " - " in title and not artist:
+        artist, title = title.split(" - ", 1)
+
+    title = TITLE_NOISE.sub("", title).strip()
+    primary_artist, artists, folded_artist = _normalize_artist(artist)
+    return NormalizedSong(title, primary_artist, artists, f"{_fold(title)}|{folded_artist}")
+
+
+@lru_cache(maxsize=1 << 16)
+def _normalize_artist(artist):
+    # A library holds far fewer artists than songs, so even songs that are all distinct mostly share their artist
+    artists = tuple(filter(None, ARTIST_SEPARATORS.split(ARTIST_NOISE.sub("", artist).strip())))
+    primary_artist = artists[0] if artists else ""
+    return primary_artist, artists, _fold(primary_artist)
+
+
+def dedupe_songs(normalized_songs):
+    """
+    Group songs that share a search key so that each one only has to be searched once. Songs without a title have
+    nothing to tell them apart, so each of them is kept in a group of its own.
+
+    :param normalized_songs: a list of NormalizedSong tuples
+    :return: a tuple of a list of the indexes of the first song of each group, a list of lists of the indexes of
+             every song in each group, and a dictionary with the number of songs, unique songs and duplicates
+    """
+    groups = {}
+    for index, song in enumerate(normalized_songs):
+        groups.setdefault(song.key if song.title else index, []).append(index)
+    members = list(groups.values())
+    stats = {'songs': len(normalized_songs), 'unique': len(members),
+             'duplicates': len(normalized_songs) - len(members)}
+    return [indexes[0] for indexes in members], members, stats
+
+
+def search_key(title, artist):
+    """
+    Build the key that identifies a song regardless of case, accents, punctuation and spacing.
+
+    :param title: a string representing the song's cleaned title
+    :param artist: a string representing the song's cleaned artist
+    :return: a string in the format 'title|artist'
+    """
+    return f"{_fold(title)}|{_fold(artist)}"
+
+
+def _fold(text):
+    if not text.isascii():
+        text = COMBINING_MARKS.sub("", unicodedata.normalize('NFKD', text)).casefold()
+        if not text.isascii():
+            return NON_WORD.sub(" ", text).strip()
+    return b" ".join(text.encode('ascii').translate(ASCII_FOLD).split()).decode('ascii')
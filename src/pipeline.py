@@ -0,0 +1,373 @@
+"""
+This file contains the streaming pipeline that runs every stage of a harvest at the same time.
+
+    1. Scan the folder for audio files
+    2. Harvest the tags of each file
+    3. Extract the metadata of files without tags from their filenames
+    4. Search Spotify for each song
+    5. Add the found tracks to the playlist in batches of 100 as soon as a batch fills up
+
+The stages are connected by bounded queues so memory use stays flat however big the library is, and each stage
+has its own number of worker threads. A song that fails in a stage is reported as failed without stopping the
+others, and a stage that stops on an unexpected error aborts the whole run instead of leaving the other stages
+waiting on it.
+"""
+import ntpath
+import queue
+import threading
+import time
+
+from src import metrics
+from src.ai_filename_process import extract_filename_metadata
+from src.fileIO import media_file_finder, read_song_tags
+from src.normalizer import normalize_song
+from src.playlist_writer import write_tracks
+from src.run_journal import ADDED, DUPLICATE, EXTRACTED, FAILED, HARVESTED, IN_PLAYLIST, MATCHED, is_finished
+from src.spotify_api_handler import get_playlist_track_ids, search_song
+
+PLAYLIST_BATCH_SIZE = 100
+# How often a stage waiting on a queue checks whether the run was aborted
+ABORT_POLL_SECONDS = 0.1
+_DONE = object()
+
+
+class PipelineError(Exception):
+    """
+    Raised when a stage of the pipeline stopped on an unexpected error and the run was aborted.
+    """
+
+
+class _Aborted(Exception):
+    """
+    Raised in a stage waiting on a queue once the run is aborted.
+    """
+
+
+class _Channel:
+    """
+    A bounded queue between two stages that is closed once every producer is done, or as soon as the run is
+    aborted.
+    """
+
+    def __init__(self, maxsize, producers, consumers, abort):
+        self._queue = queue.Queue(maxsize)
+        self._producers = producers
+        self._consumers = consumers
+        self._abort = abort
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        """
+        Put an item in the queue, waiting for room.
+
+        :raise _Aborted: if the run is aborted while waiting
+        """
+        while True:
+            try:
+                self._queue.put(item, timeout=ABORT_POLL_SECONDS)
+                return
+            except queue.Full:
+                if self._abort.is_set():
+                    raise _Aborted
+
+    def producer_done(self):
+        with self._lock:
+            self._producers -= 1
+            if self._producers == 0:
+                for _ in range(self._consumers):
+                    self.put(_DONE)
+
+    def _get(self, timeout=None):
+        """
+        Get the next item, waiting for one.
+
+        :param timeout: the most seconds to wait, or None to wait until an item arrives
+        :raise queue.Empty: if no item arrives in time
+        :raise _Aborted: if the run is aborted while waiting
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._abort.is_set():
+                raise _Aborted
+            wait = ABORT_POLL_SECONDS
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise queue.Empty
+            try:
+                return self._queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def __iter__(self):
+        while True:
+            item = self._get()
+            if item is _DONE:
+                return
+            yield item
+
+    def batches(self, size, wait):
+        """
+        Get the items in batches, handing out a partial batch when no new item arrives for a while.
+
+        :param size: an integer representing the most items in a batch
+        :param wait: the number of seconds to wait for the next item before handing out a partial batch
+        :return: a generator of lists of items
+        """
+        batch = []
+        while True:
+            try:
+                item = self._get(timeout=wait if batch else None)
+            except queue.Empty:
+                yield batch
+                batch = []
+                continue
+            if item is _DONE:
+                if batch:
+                    yield batch
+                return
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+
+
+def run_pipeline(sp, playlist_id, target_directory, index=None, harvest_workers=8, extract_workers=2,
+                 search_workers=8, queue_size=1000, ai_batch_size=20, ai_options=None, search_options=None,
+                 playlist_cache=None, spotify_limiter=None, dry_run=False, journal=None, resume=False, fast_tags=False):
+    """
+    Harvest a folder into a Spotify playlist with every stage running at the same time.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id, or None for a dry run of a playlist that does
+                        not exist yet
+    :param target_directory: a string representing the path of the folder to harvest
+    :param index: an optional TagIndex used by the harvest stage
+    :param harvest_workers: an integer representing how many files are read at the same time
+    :param extract_workers: an integer representing how many batches of filenames are extracted at the same time
+    :param search_workers: an integer representing how many songs are searched at the same time
+    :param queue_size: an integer representing the most items waiting between two stages
+    :param ai_batch_size: an integer representing the most filenames handed to the extraction at once
+    :param ai_options: an optional dictionary of keyword arguments for extract_filename_metadata
+    :param search_options: an optional dictionary of keyword arguments for search_song, such as the cache
+    :param playlist_cache: an optional SqliteCache of playlist members, see get_playlist_track_ids
+    :param spotify_limiter: an optional TokenBucket shared by every Spotify request
+    :param dry_run: a boolean, whether to skip adding the tracks to the playlist
+    :param journal: an optional RunJournal that the outcome of every file is recorded in as it happens
+    :param resume: a boolean, whether to skip the files the journal says are finished and pick the others up
+                   from the last stage they got through
+    :param fast_tags: a boolean, whether the harvest stage reads the tags with the header-only parser, see
+                      metadata_harvester
+    :return: a tuple of a list of the track ids added to the playlist, a list of the songs that failed, and a
+             list with a dictionary for each file holding its 'File', 'Track' id and 'Status', which is 'resumed'
+             for the files finished by an earlier run
+    :raise PipelineError: if a stage stopped on an unexpected error, which aborts the other stages
+    """
+    ai_options = ai_options or {}
+    search_options = dict(search_options or {}, limiter=spotify_limiter)
+    previous = journal.load() if journal is not None and resume else {}
+    abort = threading.Event()
+    # The scan stage also feeds the songs and tracks a resumed run already got to
+    files = _Channel(queue_size, producers=1, consumers=harvest_workers, abort=abort)
+    untagged = _Channel(queue_size, producers=harvest_workers, consumers=extract_workers, abort=abort)
+    songs = _Channel(queue_size, producers=1 + harvest_workers + extract_workers, consumers=search_workers,
+                     abort=abort)
+    tracks = _Channel(queue_size, producers=1 + search_workers, consumers=1, abort=abort)
+
+    existing_track_ids = set()
+    if playlist_id is not None:
+        existing_track_ids = get_playlist_track_ids(sp, playlist_id, cache=playlist_cache, limiter=spotify_limiter)
+    lock = threading.Lock()
+    # The first song searched for with each key, with its track once it is known and the report entries of its
+    # duplicates waiting for that track
+    searched = {}
+    queued_track_ids = set(existing_track_ids)
+    added_tracks = []
+    failed_tracks = []
+    report = []
+    errors = []
+
+    def record(file, track_id, status):
+        with lock:
+            report.append({'File': file, 'Track': track_id, 'Status': status})
+
+    def resolve(key, track_id):
+        with lock:
+            original = searched[key]
+            original['Resolved'] = True
+            original['Track'] = track_id
+            for entry in original.pop('Duplicates'):
+                entry['Track'] = track_id
+
+    def log(file, stage, **details):
+        if journal is not None:
+            journal.record(file, stage, **details)
+
+    def fail(file, name, reason):
+        with lock:
+            failed_tracks.append(name)
+        record(file, None, 'failed')
+        log(file, FAILED, reason=reason)
+
+    def queue_track(file, track_id):
+        with lock:
+            is_new = track_id not in queued_track_ids
+            queued_track_ids.add(track_id)
+        record(file, track_id, 'added' if is_new else 'in playlist')
+        if is_new:
+            log(file, MATCHED, track=track_id)
+            tracks.put((file, track_id))
+        else:
+            log(file, IN_PLAYLIST, track=track_id)
+
+    def scan():
+        try:
+            for path in media_file_finder(target_directory):
+                state = previous.get(path)
+                if state is None:
+                    files.put(path)
+                elif is_finished(state, previous):
+                    # A duplicate has the track of the file it repeats
+                    record(path, previous.get(state.get('Original'), state).get('Track'), 'resumed')
+                elif 'Track' in state:
+                    queue_track(path, state['Track'])
+                elif 'Song' in state:
+                    songs.put(dict(state['Song'], File=path))
+                else:
+                    files.put(path)
+        finally:
+            files.producer_done()
+            songs.producer_done()
+            tracks.producer_done()
+
+    # Only passed when asked for, so that a plain run calls read_song_tags the way it always has
+    tag_options = {'fast_tags': True} if fast_tags else {}
+
+    def harvest():
+        try:
+            for path in files:
+                try:
+                    with metrics.timer('pipeline_item_seconds', stage='harvest'):
+                        tags, error = read_song_tags(path, index, **tag_options)
+                    if error is not None:
+                        print(f"Could not read tags from {path}: {error}")
+                    if tags:
+                        log(path, HARVESTED, song=tags)
+                except Exception as e:
+                    print(f"Could not harvest {path}: {e}")
+                    fail(path, ntpath.basename(path), f"harvest failed: {e}")
+                    continue
+                if tags:
+                    songs.put(dict(tags, File=path))
+                else:
+                    untagged.put(path)
+        finally:
+            untagged.producer_done()
+            songs.producer_done()
+
+    def extract():
+        try:
+            for paths in untagged.batches(ai_batch_size, wait=1.0):
+                names = [ntpath.basename(path) for path in paths]
+                try:
+                    extracted = extract_filename_metadata(names, **ai_options)
+                except Exception as e:
+                    print(f"Could not extract the metadata of {len(names)} filename(s): {e}")
+                    for path, name in zip(paths, names):
+                        fail(path, name, f"extraction failed: {e}")
+                    continue
+                for path, metadata in zip(paths, extracted):
+                    log(path, EXTRACTED, song=metadata)
+                    songs.put(dict(metadata, File=path))
+        finally:
+            songs.producer_done()
+
+    def search():
+        try:
+            for song in songs:
+                key = None
+                try:
+                    normalized = normalize_song(song.get('Title') or "", song.get('Artist') or "")
+                    # Songs without a title have nothing to tell them apart, so they are not deduplicated and their
+                    # search fails
+                    original = None
+                    if normalized.title:
+                        with lock:
+                            original = searched.get(normalized.key)
+                            if original is None:
+                                searched[normalized.key] = {'File': song['File'], 'Resolved': False, 'Track': None,
+                                                            'Duplicates': []}
+                                key = normalized.key
+                            else:
+                                # A duplicate gets the track of the first file once its search is done
+                                entry = {'File': song['File'], 'Track': original['Track'], 'Status': 'duplicate'}
+                                report.append(entry)
+                                if not original['Resolved']:
+                                    original['Duplicates'].append(entry)
+                    if original is not None:
+                        log(song['File'], DUPLICATE, original=original['File'])
+                        continue
+                    with metrics.timer('pipeline_item_seconds', stage='search'):
+                        track_id, failure = search_song(sp, song, **search_options)
+                    reason = "no match on Spotify" if normalized.title else "no title"
+                except Exception as e:
+                    print(f"Could not search Spotify for {song.get('Title')}: {e}")
+                    track_id, failure = None, f"{song.get('Title')}, {song.get('Artist')}"
+                    reason = f"search failed: {e}"
+                if key is not None:
+                    resolve(key, None if failure is not None else track_id)
+                if failure is not None:
+                    fail(song['File'], failure, reason)
+                    continue
+                queue_track(song['File'], track_id)
+        finally:
+            tracks.producer_done()
+
+    def add():
+        snapshot_id = None
+        for batch in tracks.batches(PLAYLIST_BATCH_SIZE, wait=2.0):
+            track_ids = [track_id for _, track_id in batch]
+            if not dry_run:
+                try:
+                    result = write_tracks(sp, playlist_id, track_ids, snapshot_id=snapshot_id,
+                                          limiter=spotify_limiter)
+                except Exception as e:
+                    print(f"Could not add a batch of {len(track_ids)} track(s) to the playlist: {e}")
+                    result = {'added': [], 'failed': track_ids, 'snapshot_id': None}
+                snapshot_id = result['snapshot_id']
+                failed = set(result['failed'])
+                for file, track_id in batch:
+                    if track_id in failed:
+                        log(file, FAILED, track=track_id, reason="adding to the playlist failed")
+                    else:
+                        log(file, ADDED, track=track_id)
+                track_ids = result['added']
+            added_tracks.extend(track_ids)
+            print(f"Added a batch of {len(track_ids)} track(s), {len(added_tracks)} so far.")
+
+    def run_stage(stage):
+        try:
+            stage()
+        except _Aborted:
+            pass
+        except Exception as e:
+            print(f"The {stage.__name__} stage stopped on an error, aborting the run: {e}")
+            with lock:
+                errors.append((stage.__name__, e))
+            abort.set()
+
+    stages = [(scan, 1), (harvest, harvest_workers), (extract, extract_workers), (search, search_workers),
+              (add, 1)]
+    threads = [threading.Thread(target=run_stage, args=(stage,), name=f"{stage.__name__}-{number}", daemon=True)
+               for stage, count in stages for number in range(count)]
+    start = time.perf_counter()
+    with metrics.stage('pipeline'):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        name, error = errors[0]
+        raise PipelineError(f"The {name} stage stopped on an error: {error}") from error
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s.")
+    return added_tracks, failed_tracks, report
@@ -0,0 +1,275 @@
+"""
+This file contains the incremental sync of a folder into a Spotify playlist.
+
+    1. Compare the folder with the state of the last sync, by each file's size and modification time
+    2. Harvest, extract and search only the files that were added or changed since then
+    3. Work out the tracks to add to and remove from the playlist, against its snapshot
+    4. Remove them in batches of 100, add the new ones with the playlist writer, and save the new state
+
+The state remembers the track every file was matched to, so a sync of a folder that did not change only asks
+Spotify for the playlist's snapshot_id.
+"""
+import ntpath
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from src import metrics
+from src.ai_filename_process import extract_filename_metadata
+from src.cache import default_cache_path, make_key
+from src.fileIO import media_file_finder, read_song_tags
+from src.rate_limit import call_with_retries
+from src.playlist_writer import write_tracks
+from src.spotify_api_handler import get_playlist_snapshot, remember_playlist_track_ids, search_songs_not_in_playlist
+
+BATCH_SIZE = 100
+
+
+def default_state_path(playlist_id, target_directory):
+    """
+    Get the default location of the sync state of a folder and a playlist, inside the 'cache' directory at the
+    project's root.
+
+    :param playlist_id: a string representing the id of the playlist the folder is synced to
+    :param target_directory: a string representing the path of the synced folder
+    :return: a string representing the path of the state file
+    """
+    return default_cache_path(f"sync_{make_key(playlist_id, os.path.abspath(target_directory))[:16]}.sqlite3")
+
+
+class SyncState:
+    """
+    A SQLite backed record of the track every file of a folder was matched to in the last sync.
+    """
+
+    def __init__(self, state_path):
+        """
+        Open the sync state, creating it if it does not exist.
+
+        :param state_path: a string representing the path of the state file, or ":memory:"
+        """
+        self.state_path = state_path
+        if self.state_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.state_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                 "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, track_id TEXT)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load(self):
+        """
+        Load the state of every file.
+
+        :return: a dictionary mapping each file's path to a tuple of its size, its modification time in nanoseconds
+                 and the id of the track it was matched to
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT path, size, mtime_ns, track_id FROM files").fetchall()
+        return {path: (size, mtime_ns, track_id) for path, size, mtime_ns, track_id in rows}
+
+    def store(self, entries):
+        """
+        Store the state of files, replacing what was stored for them before.
+
+        :param entries: an iterable of tuples of a file's path, size, modification time in nanoseconds and track id
+        """
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", entries)
+            self._connection.commit()
+
+    def forget(self, paths):
+        """
+        Remove files from the state.
+
+        :param paths: an iterable of strings representing the paths of the files
+        """
+        with self._lock:
+            self._connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+            self._connection.commit()
+
+    def close(self):
+        """
+        Close the sync state.
+        """
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+def scan_folder(target_directory):
+    """
+    Find the audio files in a folder along with their size and modification time.
+
+    :param target_directory: a string representing the path of the folder
+    :return: a dictionary mapping each file's path to a tuple of its size and modification time in nanoseconds
+    """
+    files = {}
+    for file in media_file_finder(target_directory):
+        try:
+            file_stat = os.stat(file)
+        except OSError as e:
+            print(f"Could not access {file}: {e}")
+            continue
+        files[file] = (file_stat.st_size, file_stat.st_mtime_ns)
+    return files
+
+
+def diff_files(previous, current):
+    """
+    Compare the files of a folder with the state of the last sync.
+
+    :param previous: a dictionary returned by SyncState.load
+    :param current: a dictionary returned by scan_folder
+    :return: a tuple of lists of the paths of the added, changed and removed files
+    """
+    added = [path for path in current if path not in previous]
+    changed = [path for path in current if path in previous and previous[path][:2] != current[path]]
+    removed = [path for path in previous if path not in current]
+    return added, changed, removed
+
+
+def resolve_files(sp, playlist_id, files, index=None, workers=8, ai_options=None, search_options=None,
+                  fast_tags=False):
+    """
+    Find the track matching each of a list of files, reading their tags or extracting their filenames and
+    searching Spotify for them.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id
+    :param files: a list of strings representing the paths of the files
+    :param index: an optional TagIndex of the files' tags
+    :param workers: an integer representing how many files are read and songs searched at the same time
+    :param ai_options: an optional dictionary of keyword arguments for extract_filename_metadata
+    :param search_options: an optional dictionary of keyword arguments for search_songs_not_in_playlist
+    :param fast_tags: a boolean, whether to read the tags with the header-only parser, see metadata_harvester
+    :return: a tuple of a dictionary mapping the path of each file that was matched to its track id, and a list of
+             the songs that failed
+    """
+    if not files:
+        return {}, []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        harvested = list(executor.map(partial(read_song_tags, index=index, fast_tags=fast_tags), files))
+    songs = [dict(tags, File=file) for file, (tags, _) in zip(files, harvested) if tags]
+    untagged = [file for file, (tags, _) in zip(files, harvested) if not tags]
+    failed_tracks = []
+    if untagged:
+        names = [ntpath.basename(file) for file in untagged]
+        try:
+            extracted = extract_filename_metadata(names, **(ai_options or {}))
+            songs += [dict(song, File=file) for file, song in zip(untagged, extracted)]
+        except Exception as e:
+            print(f"Could not extract the metadata of {len(names)} filename(s): {e}")
+            failed_tracks += names
+
+    report = []
+    _, failed = search_songs_not_in_playlist(sp, playlist_id, songs, workers=workers, report=report,
+                                             **(search_options or {}))
+    failed_tracks += failed
+    return {entry['File']: entry['Track'] for entry in report if entry['Track'] is not None}, failed_tracks
+
+
+@metrics.timed_stage('sync')
+def sync_playlist(sp, playlist_id, target_directory, state, index=None, workers=8, ai_options=None,
+                  search_options=None, playlist_cache=None, limiter=None, dry_run=False, fast_tags=False):
+    """
+    Bring a playlist in line with a folder, only handling the files that changed since the last sync.
+
+    Tracks are added for new files and removed when no file is matched to them anymore, tracks added to the
+    playlist by hand are left alone. The removals are sent with the playlist's snapshot_id. Files that were not
+    matched are searched again by every sync, which costs no API calls when the search cache is given.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id
+    :param target_directory: a string representing the path of the folder
+    :param state: a SyncState of the last sync of the folder into the playlist
+    :param index: an optional TagIndex of the files' tags
+    :param workers: an integer representing how many files are read and songs searched at the same time
+    :param ai_options: an optional dictionary of keyword arguments for extract_filename_metadata
+    :param search_options: an optional dictionary of keyword arguments for search_songs_not_in_playlist, such as
+                           the cache
+    :param playlist_cache: an optional SqliteCache of playlist members, which is updated with the new snapshot
+    :param limiter: an optional TokenBucket shared by every Spotify request
+    :param dry_run: a boolean, whether to work out the changes without applying them or saving the state
+    :param fast_tags: a boolean, whether to read the tags with the header-only parser, see metadata_harvester
+    :precondition: the playlist must exist
+    :postcondition: the state holds every file whose track is in the playlist
+    :return: a dictionary with the number of 'added_files', 'changed_files', 'removed_files' and 'unchanged_files',
+             and the lists of track ids 'added' to and 'removed' from the playlist and of the songs that 'failed'
+    """
+    previous = state.load()
+    current = scan_folder(target_directory)
+    added_files, changed_files, removed_files = diff_files(previous, current)
+    metrics.increment('sync_files_total', len(added_files), change='added')
+    metrics.increment('sync_files_total', len(changed_files), change='changed')
+    metrics.increment('sync_files_total', len(removed_files), change='removed')
+    print(f"{len(added_files)} new, {len(changed_files)} changed and {len(removed_files)} removed file(s) since the "
+          f"last sync.")
+
+    search_options = dict(search_options or {}, limiter=limiter, playlist_cache=playlist_cache)
+    snapshot_id, playlist_tracks = get_playlist_snapshot(sp, playlist_id, cache=playlist_cache, workers=workers,
+                                                         limiter=limiter)
+    resolved, failed_tracks = resolve_files(sp, playlist_id, added_files + changed_files, index, workers,
+                                            ai_options, search_options, fast_tags)
+
+    # The track each file should be matched to after this sync
+    changed = set(changed_files)
+    tracks = {path: previous[path][2] for path in current if path in previous and path not in changed}
+    tracks.update(resolved)
+    stale = set(previous[path][2] for path in removed_files + changed_files)
+    to_remove = sorted((stale - set(tracks.values())) & playlist_tracks)
+    to_add = list(dict.fromkeys(track_id for track_id in tracks.values() if track_id not in playlist_tracks))
+    summary = {'added_files': len(added_files), 'changed_files': len(changed_files),
+               'removed_files': len(removed_files),
+               'unchanged_files': len(current) - len(added_files) - len(changed_files),
+               'added': to_add, 'removed': to_remove, 'failed': failed_tracks}
+    if dry_run:
+        return summary
+
+    removed_tracks = []
+    for i in range(0, len(to_remove), BATCH_SIZE):
+        batch = to_remove[i:i + BATCH_SIZE]
+        try:
+            result = call_with_retries(partial(sp.playlist_remove_all_occurrences_of_items, playlist_id, batch,
+                                               snapshot_id=snapshot_id), limiter,
+                                       endpoint='spotify.playlist_remove_items')
+        except Exception as e:
+            print(f"Spotify API error occurred while removing songs from playlist: {e}")
+            metrics.increment('failures_total', len(to_remove) - len(removed_tracks), stage='playlist_remove',
+                              reason='api_error')
+            break
+        snapshot_id = result['snapshot_id']
+        removed_tracks.extend(batch)
+    added_tracks = []
+    if to_add:
+        written = write_tracks(sp, playlist_id, to_add, snapshot_id=snapshot_id, limiter=limiter)
+        added_tracks, snapshot_id = written['added'], written['snapshot_id']
+
+    in_playlist = (playlist_tracks - set(removed_tracks)) | set(added_tracks)
+    if playlist_cache is not None and (removed_tracks or added_tracks):
+        # The snapshot after the last change, so that the next sync finds the playlist in the cache
+        if snapshot_id is None:
+            snapshot_id = call_with_retries(partial(sp.playlist, playlist_id, fields='snapshot_id'), limiter,
+                                            endpoint='spotify.playlist')['snapshot_id']
+        remember_playlist_track_ids(playlist_cache, playlist_id, snapshot_id, in_playlist)
+
+    # Files whose track is not in the playlist yet, or whose old track could not be removed, are left as they were
+    # so that the next sync tries again
+    removals_done = len(removed_tracks) == len(to_remove)
+    stored = [path for path, track_id in resolved.items()
+              if track_id in in_playlist and (removals_done or path not in changed)]
+    state.store((path, *current[path], tracks[path]) for path in stored)
+    if removals_done:
+        state.forget(removed_files + [path for path in changed_files if path not in tracks])
+    summary.update(added=added_tracks, removed=removed_tracks)
+    return summary
@@ -0,0 +1,158 @@
+"""
+This file contains the playlist writer, which adds tracks to a playlist in batches without losing the rest of them
+to one failed request.
+
+    1. Tracks that are already in the playlist, or repeated, are skipped
+    2. The tracks are sent in batches of 100, several batches at a time if asked to
+    3. A 429 response holds back every request sharing the rate limiter for as long as its Retry-After header says,
+       then the batch is sent again
+    4. After a 5xx response or a timeout the batch may or may not have been added, so the playlist is checked before
+       the batch is sent again, which keeps a retry from adding the same tracks twice. The snapshot_id of the last
+       write tells if the playlist changed at all, so its tracks are only read when it did
+    5. A batch rejected with 400 Bad Request is split in halves until the bad track ids are found, and the others
+       are added
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from src import metrics
+from src.rate_limit import backoff_delay, call_with_retries, is_rate_limited, is_transient, status_code
+from src.spotify_api_handler import get_playlist_snapshot
+
+BATCH_SIZE = 100
+
+
+def write_tracks(sp, playlist_id, track_ids, existing=None, snapshot_id=None, limiter=None, max_retries=3,
+                 workers=1):
+    """
+    Add tracks to a playlist, retrying and splitting the batches that fail so that as many tracks as possible are
+    added, and each of them only once.
+
+    With one worker the tracks are added in the order given. With more, up to that many batches are sent at the same
+    time and the batches may land in any order.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id
+    :param track_ids: a list of strings representing the ids of the tracks to add
+    :param existing: an optional set of strings representing the ids of the tracks already in the playlist
+    :param snapshot_id: an optional string representing the playlist's current snapshot_id, which saves reading the
+                        playlist when the first batch fails
+    :param limiter: an optional TokenBucket shared by every Spotify request
+    :param max_retries: an integer representing how many times a batch is sent again after a transient error
+    :param workers: an integer representing how many batches are sent at the same time
+    :return: a dictionary of the lists of track ids that were 'added', 'skipped' because they were already in the
+             playlist or repeated, and 'failed', and the playlist's 'snapshot_id' after the last write or None if
+             it is not known
+    """
+    known = set(existing or ())
+    skipped, to_add = [], []
+    for track_id in track_ids:
+        if track_id in known:
+            skipped.append(track_id)
+        else:
+            known.add(track_id)
+            to_add.append(track_id)
+
+    batches = [to_add[i:i + BATCH_SIZE] for i in range(0, len(to_add), BATCH_SIZE)]
+    writer = _BatchWriter(sp, playlist_id, snapshot_id, limiter, max_retries,
+                          concurrent=workers > 1 and len(batches) > 1)
+    if writer.concurrent:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(writer.write, batches))
+    else:
+        results = [writer.write(batch) for batch in batches]
+    added = [track_id for batch_added, _ in results for track_id in batch_added]
+    failed = [track_id for _, batch_failed in results for track_id in batch_failed]
+
+    metrics.increment('playlist_tracks_total', len(added), result='added')
+    metrics.increment('playlist_tracks_total', len(skipped), result='skipped')
+    metrics.increment('playlist_tracks_total', len(failed), result='failed')
+    if failed:
+        metrics.increment('failures_total', len(failed), stage='playlist_add', reason='api_error')
+    # Responses to batches sent at the same time can arrive in any order, so the last one may not be the newest
+    snapshot_id = None if writer.concurrent else writer.snapshot_id
+    return {'added': added, 'skipped': skipped, 'failed': failed, 'snapshot_id': snapshot_id}
+
+
+class _BatchWriter:
+    """
+    Sends the batches of one write_tracks call and keeps track of the playlist's snapshot_id between them.
+    """
+
+    def __init__(self, sp, playlist_id, snapshot_id, limiter, max_retries, concurrent):
+        self.sp = sp
+        self.playlist_id = playlist_id
+        self.snapshot_id = snapshot_id
+        self.limiter = limiter
+        self.max_retries = max_retries
+        # The snapshot_id only shows that a batch was not added when no other batch can land in the meantime
+        self.concurrent = concurrent
+        self._lock = threading.Lock()
+
+    def write(self, batch):
+        """
+        Add a batch of tracks to the playlist.
+
+        :param batch: a list of at most 100 strings representing track ids
+        :return: a tuple of the lists of the track ids that were added and that failed
+        """
+        added = []
+        pending = list(batch)
+        attempt = 0
+        while pending:
+            with self._lock:
+                snapshot_before = self.snapshot_id
+            try:
+                # Only a 429 is certain not to have added anything, so it is the only error retried right away
+                result = call_with_retries(partial(self.sp.playlist_add_items, self.playlist_id, pending),
+                                           self.limiter, self.max_retries, should_retry=is_rate_limited,
+                                           endpoint='spotify.playlist_add_items')
+            except Exception as e:
+                if is_transient(e) and not is_rate_limited(e) and attempt < self.max_retries:
+                    time.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    metrics.increment('playlist_write_retries_total', reason='unknown_outcome')
+                    landed = self._tracks_in_playlist(snapshot_before)
+                    if landed is not None:
+                        added.extend(track_id for track_id in pending if track_id in landed)
+                        pending = [track_id for track_id in pending if track_id not in landed]
+                        continue
+                elif status_code(e) == 400 and len(pending) > 1:
+                    metrics.increment('playlist_write_retries_total', reason='split')
+                    middle = len(pending) // 2
+                    first_added, first_failed = self.write(pending[:middle])
+                    second_added, second_failed = self.write(pending[middle:])
+                    return added + first_added + second_added, first_failed + second_failed
+                print(f"Spotify API error occurred while adding {len(pending)} song(s) to playlist: {e}")
+                return added, pending
+            with self._lock:
+                self.snapshot_id = result.get('snapshot_id', self.snapshot_id)
+            added.extend(pending)
+            pending = []
+        return added, []
+
+    def _tracks_in_playlist(self, snapshot_before):
+        """
+        Find out which tracks are in the playlist after a write whose outcome is not known.
+
+        :param snapshot_before: a string representing the playlist's snapshot_id before the write, or None
+        :return: a set of strings representing the ids of the tracks in the playlist, an empty set if the playlist
+                 did not change since before the write, or None if the playlist could not be read
+        """
+        try:
+            if snapshot_before is not None and not self.concurrent:
+                playlist = call_with_retries(partial(self.sp.playlist, self.playlist_id, fields='snapshot_id'),
+                                             self.limiter, self.max_retries, endpoint='spotify.playlist')
+                if playlist['snapshot_id'] == snapshot_before:
+                    return set()
+            snapshot_id, track_ids = get_playlist_snapshot(self.sp, self.playlist_id, limiter=self.limiter,
+                                                           max_retries=self.max_retries)
+        except Exception as e:
+            print(f"Could not check which songs were added to the playlist: {e}")
+            return None
+        if not self.concurrent:
+            with self._lock:
+                self.snapshot_id = snapshot_id
+        return track_ids
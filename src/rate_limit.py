@@ -0,0 +1,262 @@
+"""
+This file contains the helpers shared by the API handlers to stay within rate limits.
+
+    1. A thread-safe token bucket that limits how many requests are sent per second, and a chain of them
+    2. Exponential backoff with jitter for retrying failed requests
+    3. Reading the status code and Retry-After header from an API error
+    4. Calling an API with all of the above
+"""
+import random
+import threading
+import time
+
+from src import metrics
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a request could not be sent before its deadline.
+    """
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, refilled at a steady rate up to its capacity.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Create a full token bucket.
+
+        :param rate: a positive number representing how many tokens are added per second
+        :param capacity: a positive number representing the most tokens the bucket holds, which is the largest
+                         burst of requests allowed, defaults to rate
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens from the bucket if there are enough of them, without waiting.
+
+        :param tokens: a number representing how many tokens to take
+        :return: a boolean value, True if the tokens were taken, False otherwise
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Wait until there are enough tokens in the bucket and take them.
+
+        :param tokens: a number representing how many tokens to take
+        :param timeout: the most seconds to wait, or None to wait as long as needed
+        :return: a boolean value, True if the tokens were taken, False if the timeout ran out first
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if give_up_at is not None:
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Empty the bucket so that no tokens are handed out for a while, such as after the API asked to back off.
+
+        :param seconds: a number representing how long to hold back new requests
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class LimiterChain:
+    """
+    Several token buckets acting as one, such as a user's own limit within the limit of the whole app.
+    """
+
+    def __init__(self, *limiters):
+        """
+        :param limiters: the TokenBucket objects that every request takes a token from, in order
+        """
+        self.limiters = limiters
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens from every bucket if there are enough of them, without waiting.
+
+        :param tokens: a number representing how many tokens to take
+        :return: a boolean value, True if the tokens were taken from every bucket, False otherwise
+        """
+        return all(limiter.try_acquire(tokens) for limiter in self.limiters)
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Wait until every bucket has enough tokens and take them.
+
+        :param tokens: a number representing how many tokens to take
+        :param timeout: the most seconds to wait in all, or None to wait as long as needed
+        :return: a boolean value, True if the tokens were taken, False if the timeout ran out first
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        for limiter in self.limiters:
+            remaining = None if give_up_at is None else max(0.0, give_up_at - time.monotonic())
+            if not limiter.acquire(tokens, timeout=remaining):
+                return False
+        return True
+
+    def pause(self, seconds):
+        """
+        Hold back new requests in every bucket for a while.
+
+        :param seconds: a number representing how long to hold back new requests
+        """
+        for limiter in self.limiters:
+            limiter.pause(seconds)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """
+    Calculate how long to wait before retrying a request, growing exponentially with full jitter.
+
+    :param attempt: an integer representing how many times the request was already retried, starting at 0
+    :param base: a number representing the delay in seconds of the first retry
+    :param cap: a number representing the longest delay in seconds
+    :return: a float representing the number of seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def status_code(error):
+    """
+    Get the HTTP status code of an API error, for the OpenAI, Spotipy and requests exceptions.
+
+    :param error: an exception raised by an API call
+    :return: an integer representing the HTTP status code, or None if the error has none
+    """
+    for attribute in ('status_code', 'http_status'):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int):
+            return code
+    response = getattr(error, 'response', None)
+    code = getattr(response, 'status_code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_rate_limited(error):
+    """
+    Check if an API error is a 429 Too Many Requests response.
+
+    :param error: an exception raised by an API call
+    :return: a boolean value, True if the API is rate limiting the requests, False otherwise
+    """
+    return status_code(error) == 429
+
+
+def is_transient(error):
+    """
+    Check if an API error is likely to go away when the request is retried.
+
+    :param error: an exception raised by an API call
+    :return: a boolean value, True for 429 and 5xx responses, timeouts and connection errors, False otherwise
+    """
+    code = status_code(error)
+    if code is not None:
+        return code == 429 or code >= 500
+    # The requests library's timeouts and connection errors are OSErrors too
+    return isinstance(error, OSError)
+
+
+def retry_after_seconds(error):
+    """
+    Read the Retry-After header of an API error.
+
+    :param error: an exception raised by an API call
+    :return: a float representing the number of seconds the API asked to wait, or None if it did not say
+    """
+    headers = getattr(error, 'headers', None)
+    if headers is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return max(0.0, float(value))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def call_with_retries(call, limiter=None, max_retries=3, deadline=None, should_retry=is_transient,
+                      endpoint="api"):
+    """
+    Call an API, waiting for the rate limiter before every attempt and retrying the errors that may go away.
+
+    A 429 response is retried after the delay in its Retry-After header, and holds back every other request
+    sharing the limiter for as long. Other errors are retried after exponential backoff with jitter.
+
+    :param call: a function without parameters that sends the request
+    :param limiter: an optional TokenBucket that every attempt takes a token from
+    :param max_retries: an integer representing how many times the request is retried
+    :param deadline: the time.monotonic() value after which no more attempts are made, or None
+    :param should_retry: a function that takes the raised exception and returns whether to retry
+    :param endpoint: a string naming the API call in the metrics, such as 'spotify.search'
+    :raise DeadlineExceeded: if the deadline passes before the request could be sent
+    :return: the value returned by call
+    """
+    attempt = 0
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            metrics.increment('deadline_exceeded_total', endpoint=endpoint)
+            raise DeadlineExceeded("the deadline for the request has passed")
+        if limiter is not None:
+            with metrics.timer('rate_limiter_wait_seconds', endpoint=endpoint):
+                acquired = limiter.acquire(timeout=remaining)
+            if not acquired:
+                metrics.increment('deadline_exceeded_total', endpoint=endpoint)
+                raise DeadlineExceeded("the deadline for the request passed while waiting for the rate limiter")
+        metrics.increment('api_calls_total', endpoint=endpoint)
+        try:
+            with metrics.timer('api_call_seconds', endpoint=endpoint):
+                return call()
+        except Exception as e:
+            rate_limited = is_rate_limited(e)
+            if rate_limited:
+                metrics.increment('api_rate_limited_total', endpoint=endpoint)
+            if attempt >= max_retries or not should_retry(e):
+                metrics.increment('api_errors_total', endpoint=endpoint)
+                raise
+            delay = retry_after_seconds(e) if rate_limited else None
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif limiter is not None:
+                limiter.pause(delay)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                metrics.increment('api_errors_total', endpoint=endpoint)
+                raise
+            metrics.increment('api_retries_total', endpoint=endpoint)
+            time.sleep(delay)
+            attempt += 1
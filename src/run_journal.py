@@ -0,0 +1,178 @@
+"""
+This file contains the run journal that lets an interrupted harvest pick up where it left off.
+
+Every outcome of every file is appended to a JSON Lines file as soon as it happens: its tags were harvested, its
+metadata was extracted from its filename, it was matched to a Spotify track, it was added to the playlist, or it
+failed and why. Nothing is ever rewritten, so a crash loses at most the line being written, and reading the
+journal back gives the latest outcome of each file.
+"""
+import json
+import os
+import threading
+import time
+
+from src.cache import make_key
+
+HARVESTED = 'harvested'
+EXTRACTED = 'extracted'
+MATCHED = 'matched'
+ADDED = 'added'
+IN_PLAYLIST = 'in playlist'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+# Files whose latest outcome is one of these are skipped when a run is resumed, and so are the duplicates of
+# these files, see is_finished
+FINISHED = (ADDED, IN_PLAYLIST)
+
+
+def default_journal_path(playlist_id, target_directory):
+    """
+    Get the default location of the journal of a harvest, inside the 'journal' directory at the project's root.
+
+    :param playlist_id: a string representing the id of the playlist the songs are added to
+    :param target_directory: a string representing the path of the harvested folder
+    :return: a string representing the path of the journal file
+    """
+    current_directory_path = os.path.dirname(os.path.abspath(__file__))
+    parent_directory_path = os.path.dirname(current_directory_path)
+    file_name = f"{make_key(playlist_id, os.path.abspath(target_directory))[:16]}.jsonl"
+    return os.path.join(parent_directory_path, 'journal', file_name)
+
+
+class RunJournal:
+    """
+    A thread-safe, append-only journal of the outcome of each file in a harvest.
+    """
+
+    def __init__(self, journal_path, fsync=False):
+        """
+        Open the journal, creating it if it does not exist.
+
+        :param journal_path: a string representing the path of the journal file
+        :param fsync: a boolean, whether to force every entry onto the disk, which also survives a power cut but
+                      is much slower
+        """
+        self.journal_path = journal_path
+        self.fsync = fsync
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(journal_path, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, file, stage, song=None, track=None, reason=None, original=None):
+        """
+        Append the outcome of a file to the journal.
+
+        :param file: a string representing the path of the song file
+        :param stage: a string representing the outcome, one of the stage constants of this module
+        :param song: an optional dictionary of the song's metadata
+        :param track: an optional string representing the id of the matched Spotify track
+        :param reason: an optional string explaining why the file failed
+        :param original: an optional string representing the path of the file that a duplicate repeats
+        """
+        entry = {'File': file, 'Stage': stage, 'Time': time.time()}
+        if song is not None:
+            entry['Song'] = {key: value for key, value in song.items() if key != 'File'}
+        if track is not None:
+            entry['Track'] = track
+        if reason is not None:
+            entry['Reason'] = reason
+        if original is not None:
+            entry['Original'] = original
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            # Flushed on every entry so that a crash of the program loses nothing already recorded
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def load(self):
+        """
+        Read the latest state of every file recorded in the journal.
+
+        :return: a dictionary mapping the path of each file to a dictionary with its latest 'Stage', the last
+                 'Song' metadata and 'Track' id recorded for it, the 'Reason' it failed if it did, and the
+                 'Original' file it repeats if it is a duplicate
+        """
+        with self._lock:
+            self._file.flush()
+        return read_journal(self.journal_path)
+
+    def close(self):
+        """
+        Close the journal file.
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+
+
+def read_journal(journal_path):
+    """
+    Read the latest state of every file recorded in a journal file.
+
+    :param journal_path: a string representing the path of the journal file
+    :return: a dictionary mapping the path of each file to its latest state, see RunJournal.load
+    """
+    states = {}
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line is cut short if the program crashed while writing it
+                    continue
+                state = states.setdefault(entry['File'], {})
+                state['Stage'] = entry['Stage']
+                for key in ('Song', 'Track'):
+                    if key in entry:
+                        state[key] = entry[key]
+                if entry['Stage'] == FAILED:
+                    state['Reason'] = entry.get('Reason')
+                else:
+                    state.pop('Reason', None)
+                if entry['Stage'] == DUPLICATE and 'Original' in entry:
+                    state['Original'] = entry['Original']
+                else:
+                    state.pop('Original', None)
+    except FileNotFoundError:
+        pass
+    return states
+
+
+def is_finished(state, states):
+    """
+    Tell whether a file needs no more work when its harvest is resumed.
+
+    A duplicate is only as finished as the file it repeats, so that it is picked up again when that file failed.
+
+    :param state: a dictionary of the file's latest state, see RunJournal.load
+    :param states: a dictionary returned by read_journal
+    :return: a boolean, whether the file's latest outcome is final
+    """
+    if state['Stage'] == DUPLICATE:
+        original = states.get(state.get('Original'))
+        return original is not None and original['Stage'] in FINISHED
+    return state['Stage'] in FINISHED
+
+
+def summarize(states):
+    """
+    Count the files of a journal by their latest stage.
+
+    :param states: a dictionary returned by read_journal
+    :return: a dictionary mapping each stage to the number of files whose latest outcome it is
+    """
+    counts = {}
+    for state in states.values():
+        counts[state['Stage']] = counts.get(state['Stage'], 0) + 1
+    return counts
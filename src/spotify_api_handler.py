@@ -10,12 +10,21 @@
 
     """
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-import requests
-from fuzzywuzzy import fuzz
-import Levenshtein
+from src import metrics
+from src.cache import MISSING, make_key, normalize_text
+from src.match_scoring import DEFAULT_THRESHOLD, best_match, best_matches, make_query
+from src.normalizer import dedupe_songs, normalize_batch, normalize_song
+from src.rate_limit import DeadlineExceeded, call_with_retries
 
-from src.fileIO import clean_metadata
+# Bump this whenever the cached search results change shape so that old entries are not reused
+SEARCH_CACHE_VERSION = 3
+# Queries that found nothing are searched again after a week, in case the track was added to Spotify since
+NEGATIVE_TTL = 7 * 24 * 60 * 60
+PLAYLIST_PAGE_SIZE = 100
 
 
 def get_or_create_playlist(sp, user_id, playlist_name):
@@ -30,10 +39,9 @@ def get_or_create_playlist(sp, user_id, playlist_name):
     :return: the playlist's id
     """
     try:
-        playlists = sp.current_user_playlists()
-        for playlist in playlists['items']:
-            if playlist['name'] == playlist_name:
-                return playlist['id']
+        playlist_id = find_playlist(sp, playlist_name)
+        if playlist_id is not None:
+            return playlist_id
 
         new_playlist = sp.user_playlist_create(user_id, playlist_name, public=True)
         return new_playlist['id']
@@ -42,6 +50,105 @@ def get_or_create_playlist(sp, user_id, playlist_name):
         return None
 
 
+def find_playlist(sp, playlist_name):
+    """
+    Find one of the user's Spotify playlists by its name.
+
+    :param sp: authenticated Spotify object
+    :param playlist_name: the name of the playlist
+    :return: the playlist's id, or None if the user has no playlist with that name
+    """
+    playlists = sp.current_user_playlists()
+    for playlist in playlists['items']:
+        if playlist['name'] == playlist_name:
+            return playlist['id']
+    return None
+
+
+def get_playlist_track_ids(sp, playlist_id, cache=None, workers=1, limiter=None, max_retries=3):
+    """
+    Get the ids of every track in a playlist, however many pages it has.
+
+    Only the track ids are requested, and the pages are fetched at the same time by their offsets. When a cache is
+    given the ids are stored against the playlist's snapshot_id, so an unchanged playlist is not downloaded again.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id
+    :param cache: an optional SqliteCache of playlist members
+    :param workers: an integer representing how many pages are fetched at the same time
+    :param limiter: an optional TokenBucket shared by every request
+    :param max_retries: an integer representing how many times a request is retried after a transient error
+    :return: a set of strings representing the ids of the tracks in the playlist
+    """
+    _, track_ids = get_playlist_snapshot(sp, playlist_id, cache, workers, limiter, max_retries)
+    return track_ids
+
+
+def get_playlist_snapshot(sp, playlist_id, cache=None, workers=1, limiter=None, max_retries=3):
+    """
+    Get the snapshot_id of a playlist along with the ids of every track in it, see get_playlist_track_ids for the
+    parameters.
+
+    :return: a tuple of a string representing the playlist's snapshot_id and a set of strings representing the ids
+             of the tracks in the playlist
+    """
+    playlist = call_with_retries(partial(sp.playlist, playlist_id, fields='snapshot_id,tracks.total'), limiter,
+                                 max_retries, endpoint='spotify.playlist')
+    cache_key = make_key('playlist', playlist_id)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        fresh = cached is not MISSING and cached['snapshot_id'] == playlist['snapshot_id']
+        metrics.increment('cache_requests_total', cache='playlist', result='hit' if fresh else 'miss')
+        if fresh:
+            return playlist['snapshot_id'], set(cached['track_ids'])
+
+    fetch_page = partial(_fetch_playlist_page, sp, playlist_id, limiter, max_retries)
+    offsets = range(0, playlist['tracks']['total'], PLAYLIST_PAGE_SIZE)
+    if workers > 1 and len(offsets) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = list(executor.map(fetch_page, offsets))
+    else:
+        pages = map(fetch_page, offsets)
+    track_ids = set()
+    for page in pages:
+        track_ids.update(page)
+
+    if cache is not None:
+        remember_playlist_track_ids(cache, playlist_id, playlist['snapshot_id'], track_ids)
+    return playlist['snapshot_id'], track_ids
+
+
+def remember_playlist_track_ids(cache, playlist_id, snapshot_id, track_ids):
+    """
+    Store the ids of the tracks in a playlist against its snapshot_id, such as after changing the playlist, so that
+    the next get_playlist_track_ids does not download it again.
+
+    :param cache: a SqliteCache of playlist members
+    :param playlist_id: a string representing the playlist's id
+    :param snapshot_id: a string representing the snapshot_id of the playlist holding exactly these tracks
+    :param track_ids: an iterable of strings representing the ids of the tracks in the playlist
+    """
+    cache.set(make_key('playlist', playlist_id), {'snapshot_id': snapshot_id, 'track_ids': sorted(track_ids)},
+              ttl=None)
+
+
+def _fetch_playlist_page(sp, playlist_id, limiter, max_retries, offset):
+    """
+    Fetch the track ids of one page of a playlist.
+
+    :param sp: authenticated Spotify object
+    :param playlist_id: a string representing the playlist's id
+    :param limiter: an optional TokenBucket that the request takes a token from
+    :param max_retries: an integer representing how many times the request is retried after a transient error
+    :param offset: an integer representing the position of the page's first track in the playlist
+    :return: a list of strings representing the ids of the page's tracks, local files and removed tracks excluded
+    """
+    results = call_with_retries(partial(sp.playlist_items, playlist_id, fields='items(track(id)),next',
+                                        limit=PLAYLIST_PAGE_SIZE, offset=offset), limiter, max_retries,
+                                endpoint='spotify.playlist_items')
+    return [item['track']['id'] for item in results['items'] if item.get('track') and item['track'].get('id')]
+
+
 def check_both_available(song_data) -> bool:
     """
     This function checks if a song's metadat includes both the title and artist.
@@ -55,7 +162,10 @@ def check_both_available(song_data) -> bool:
         return False
 
 
-def search_songs_not_in_playlist(sp, playlist_id, metadata_list):
+@metrics.timed_stage('search')
+def search_songs_not_in_playlist(sp, playlist_id, metadata_list, workers=1, limiter=None, max_retries=3,
+                                 latency_budget=None, cache=None, bypass_cache=False, negative_ttl=NEGATIVE_TTL,
+                                 playlist_cache=None, threshold=DEFAULT_THRESHOLD, report=None):
     """
     Search for songs in the list of song metadata dictionaries and return a list of songs not in the playlist
             and a list of songs not found on Spotify.
@@ -63,76 +173,277 @@ def search_songs_not_in_playlist(sp, playlist_id, metadata_list):
     :param sp: authenticated Spotify object
     :param playlist_id: a string representing the playlist's id
     :param metadata_list: a list of dictionaries containing songs' metadata
+    :param workers: an integer representing how many searches are sent at the same time
+    :param limiter: an optional TokenBucket shared by every search request, including retries
+    :param max_retries: an integer representing how many times a search is retried after a 429 response, a 5xx
+                        response, a timeout or a connection error
+    :param latency_budget: the most seconds a song's search may take including its retries, or None for no limit
+    :param cache: an optional SqliteCache of earlier search results, including the queries that found nothing
+    :param bypass_cache: a boolean, whether to search Spotify even for cached queries, the results still update
+                         the cache
+    :param negative_ttl: the number of seconds a query that found nothing stays cached for
+    :param playlist_cache: an optional SqliteCache of playlist members, see get_playlist_track_ids
+    :param threshold: a number from 0 to 100 representing the lowest score a match is accepted with, songs whose
+                      best match scores lower are added to the failed tracks
+    :param report: an optional list that a dictionary is appended to for each song, in order, with the song, its
+                   source 'File' if the metadata has one, the matched 'Track' id or None, its 'Status' of 'added',
+                   'in playlist', 'duplicate' or 'failed', and the index of the song it is a 'Duplicate Of'
     :precondition: playlist_id and csv_file_path are valid strings
     :return: a tuple of lists, the first list contains the track ids of songs not in the playlist, and the second list
     contains the titles of songs that could not be found on Spotify
     """
     not_in_playlist = []
-    existing_track_ids = set()
     failed_tracks = []
-    results = sp.playlist_items(playlist_id)
-    for item in results['items']:
-        track = item['track']
-        existing_track_ids.add(track['id'])
-
-    for song in metadata_list:
-        clean_title, clean_artist = clean_metadata(song['Title'], song['Artist'])
-        both_artist_and_title = check_both_available(song)
-        query = ""
-        if both_artist_and_title:
-            query = f"track:{clean_title} artist:{clean_artist}"
+    existing_track_ids = get_playlist_track_ids(sp, playlist_id, cache=playlist_cache, workers=workers,
+                                                limiter=limiter, max_retries=max_retries)
+
+    normalized_songs = normalize_batch(metadata_list)
+    # Songs sharing a search key are searched once and their result fanned back out to every copy
+    unique, groups, stats = dedupe_songs(normalized_songs)
+    if stats['duplicates']:
+        print(f"Collapsed {stats['duplicates']} duplicate song(s) into {stats['unique']} search(es).")
+    unique_songs = [metadata_list[index] for index in unique]
+    unique_normalized = [normalized_songs[index] for index in unique]
+    search = partial(_search_song, sp, limiter=limiter, max_retries=max_retries, latency_budget=latency_budget,
+                     cache=cache, bypass_cache=bypass_cache, negative_ttl=negative_ttl)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() keeps the results in the same order as the songs
+            found = list(executor.map(search, unique_songs, unique_normalized))
+    else:
+        found = list(map(search, unique_songs, unique_normalized))
+    exact = {position: isrc_match(unique_songs[position], candidates)
+             for position, (candidates, failure) in enumerate(found) if failure is None}
+    to_match = [position for position, track in exact.items() if track is None]
+    queries = [make_query(unique_normalized[position].title, unique_normalized[position].artist,
+                          unique_songs[position].get('Album'), unique_songs[position].get('Duration'))
+               for position in to_match]
+    matches = dict(zip(to_match, best_matches(queries, [found[position][0] for position in to_match], threshold)))
+    matches.update((position, (track, 100.0)) for position, track in exact.items() if track is not None)
+
+    statuses = [None] * len(metadata_list)
+    added = set()
+    for position, (_, failure) in enumerate(found):
+        track_id = None
+        if failure is not None:
+            failed_tracks.append(failure)
+            status = 'failed'
         else:
-            query = f"track:{clean_title}"
-        try:
-            result = sp.search(query, type='track', limit=5)
-            tracks = result['tracks']['items']
-            if tracks:
-                best_match = find_best_match(query, tracks)
-                if best_match['id'] not in existing_track_ids:
-                    not_in_playlist.append(best_match['id'])
-            else:
+            track, score = matches[position]
+            if track is None:
+                clean_title, clean_artist = unique_normalized[position].title, unique_normalized[position].artist
+                print(f"No close enough match on Spotify (best score {score:.0f}): {clean_title} by {clean_artist}")
+                metrics.increment('failures_total', stage='search', reason='no_close_match')
                 failed_tracks.append(f"{clean_title}, {clean_artist}")
-                print(f"Could not find track on Spotify: {clean_title} by {clean_artist}")
-        except requests.exceptions.ReadTimeout:
-            print(f"Spotify API timeout occurred for track: {query}")
-            failed_tracks.append(query)
-        except Exception as e:
-            print(f"Spotify API error occurred while searching for songs: {e}")
+                status = 'failed'
+            else:
+                track_id = track['id']
+                if track_id in existing_track_ids or track_id in added:
+                    status = 'in playlist'
+                else:
+                    not_in_playlist.append(track_id)
+                    added.add(track_id)
+                    status = 'added'
+        first, *copies = groups[position]
+        statuses[first] = (track_id, status, None)
+        for index in copies:
+            statuses[index] = (track_id, 'duplicate', first)
+
+    if report is not None:
+        for song, (track_id, status, duplicate_of) in zip(metadata_list, statuses):
+            report.append({'Song': song, 'File': song.get('File'), 'Track': track_id, 'Status': status,
+                           'Duplicate Of': duplicate_of})
     return not_in_playlist, failed_tracks
 
 
-def find_best_match(query, tracks):
+def search_song(sp, song, threshold=DEFAULT_THRESHOLD, **search_options):
     """
-    Find the best match for a query in a list of tracks.
-    :param query: A string representing the query containing the song's title and artist
+    Search Spotify for a single song and pick its best match.
+
+    :param sp: authenticated Spotify object
+    :param song: a dictionary containing the song's metadata
+    :param threshold: a number from 0 to 100 representing the lowest score a match is accepted with
+    :param search_options: the limiter, max_retries, latency_budget, cache, bypass_cache and negative_ttl keyword
+                           arguments of search_songs_not_in_playlist
+    :return: a tuple of the best matching track's id or None, and the entry for the failed tracks list or None
+    """
+    normalized_song = normalize_song(song.get('Title') or "", song.get('Artist') or "")
+    candidates, failure = _search_song(sp, song, normalized_song, **search_options)
+    if failure is not None:
+        return None, failure
+    track = isrc_match(song, candidates)
+    if track is not None:
+        return track['id'], None
+    query = make_query(normalized_song.title, normalized_song.artist, song.get('Album'), song.get('Duration'))
+    track, score = best_match(query, candidates, threshold)
+    if track is None:
+        print(f"No close enough match on Spotify (best score {score:.0f}): "
+              f"{normalized_song.title} by {normalized_song.artist}")
+        metrics.increment('failures_total', stage='search', reason='no_close_match')
+        return None, f"{normalized_song.title}, {normalized_song.artist}"
+    return track['id'], None
+
+
+def _search_song(sp, song, normalized_song, limiter=None, max_retries=3, latency_budget=None, cache=None,
+                 bypass_cache=False, negative_ttl=NEGATIVE_TTL):
+    """
+    Search Spotify for a single song, see search_songs_not_in_playlist for the parameters.
+
+    A song with an ISRC is looked up by it first, and only searched for by its title and artist when Spotify has no
+    track with that ISRC.
+
+    :param sp: authenticated Spotify object
+    :param song: a dictionary containing the song's metadata
+    :param normalized_song: the song's NormalizedSong tuple
+    :return: a tuple of the list of candidate tracks or None, and the entry for the failed tracks list or None
+    """
+    clean_title, clean_artist = normalized_song.title, normalized_song.artist
+    if not clean_title:
+        print(f"No title to search Spotify with for: {song}")
+        metrics.increment('failures_total', stage='search', reason='no_title')
+        return None, f"{clean_title}, {clean_artist}"
+    search = partial(_search_query, sp, limiter=limiter, max_retries=max_retries, latency_budget=latency_budget,
+                     cache=cache, bypass_cache=bypass_cache, negative_ttl=negative_ttl)
+    if song.get('ISRC'):
+        tracks, failure = search(f"isrc:{song['ISRC']}", limit=1)
+        if failure is not None:
+            return None, failure
+        metrics.increment('isrc_lookups_total', result='hit' if tracks else 'miss')
+        if tracks:
+            return tracks, None
+    both_artist_and_title = check_both_available(song)
+    query = ""
+    if both_artist_and_title:
+        query = f"track:{clean_title} artist:{clean_artist}"
+    else:
+        query = f"track:{clean_title}"
+    tracks, failure = search(query)
+    if failure is not None:
+        return None, failure
+    if tracks:
+        return tracks, None
+    print(f"Could not find track on Spotify: {clean_title} by {clean_artist}")
+    metrics.increment('failures_total', stage='search', reason='not_found')
+    return None, f"{clean_title}, {clean_artist}"
+
+
+def _search_query(sp, query, limit=5, limiter=None, max_retries=3, latency_budget=None, cache=None,
+                  bypass_cache=False, negative_ttl=NEGATIVE_TTL):
+    """
+    Send a single search query to Spotify, or answer it from the cache.
+
+    :param sp: authenticated Spotify object
+    :param query: a string representing the search query
+    :param limit: an integer representing the most tracks to ask for
+    :return: a tuple of the list of compacted tracks found, empty if none were, or None if the search failed, and
+             the entry for the failed tracks list or None
+    """
+    cache_key = search_cache_key(query)
+    if cache is not None and not bypass_cache:
+        cached = cache.get(cache_key)
+        metrics.increment('cache_requests_total', cache='spotify_search',
+                          result='miss' if cached is MISSING else 'negative_hit' if cached is None else 'hit')
+        if cached is not MISSING:
+            return [] if cached is None else cached['candidates'], None
+    deadline = None if latency_budget is None else time.monotonic() + latency_budget
+    try:
+        result = call_with_retries(partial(sp.search, query, type='track', limit=limit), limiter, max_retries,
+                                   deadline, endpoint='spotify.search')
+    except DeadlineExceeded:
+        print(f"Spotify search ran out of its latency budget for track: {query}")
+        metrics.increment('failures_total', stage='search', reason='deadline')
+        return None, query
+    except Exception as e:
+        # requests is already loaded by spotipy whenever a request could have timed out
+        from requests.exceptions import ReadTimeout
+        if isinstance(e, ReadTimeout):
+            print(f"Spotify API timeout occurred for track: {query}")
+            metrics.increment('failures_total', stage='search', reason='timeout')
+            return None, query
+        print(f"Spotify API error occurred while searching for songs: {e}")
+        metrics.increment('failures_total', stage='search', reason='api_error')
+        return None, query
+    candidates = [compact_track(track) for track in result['tracks']['items']]
+    if cache is not None:
+        if candidates:
+            cache.set(cache_key, {'candidates': candidates})
+        else:
+            cache.set(cache_key, None, ttl=negative_ttl)
+    return candidates, None
+
+
+def search_cache_key(query):
+    """
+    Build the cache key of a Spotify search query.
+
+    :param query: a string representing the search query
+    :return: a string representing the cache key
+    """
+    return make_key(normalize_text(query), SEARCH_CACHE_VERSION)
+
+
+def compact_track(track):
+    """
+    Keep only the fields of a Spotify track that are needed to match it again.
+
+    :param track: a dictionary representing a track returned by the Spotify API
+    :return: a dictionary with the track's id, name, artists, album, duration and ISRC
+    """
+    return {'id': track['id'], 'name': track['name'],
+            'artists': [{'name': artist['name']} for artist in track.get('artists', [])],
+            'album': {'name': (track.get('album') or {}).get('name', '')},
+            'duration_ms': track.get('duration_ms'), 'isrc': (track.get('external_ids') or {}).get('isrc')}
+
+
+def isrc_match(song, tracks):
+    """
+    Find the track with the same ISRC as a song, which needs no scoring.
+
+    :param song: a dictionary containing the song's metadata, the ISRC key is optional
+    :param tracks: a list of dictionaries returned by compact_track
+    :return: a dictionary representing the track with the song's ISRC, or None if the song has no ISRC or no track
+             has it
+    """
+    isrc = song.get('ISRC')
+    if not isrc:
+        return None
+    for track in tracks:
+        if (track.get('isrc') or "").replace("-", "").upper() == isrc:
+            return track
+    return None
+
+
+def find_best_match(song, tracks, threshold=DEFAULT_THRESHOLD):
+    """
+    Find the best match for a song in a list of tracks.
+    :param song: a dictionary containing the song's metadata, the Album and Duration keys are optional
     :param tracks: a list of dictionaries containing song metadata
-    :return: a dictionary representing the best match for the query
+    :param threshold: a number from 0 to 100 representing the lowest score a match is accepted with
+    :return: a dictionary representing the best match for the song, or None if no track is close enough
     """
-    similarities = [fuzz.ratio(f"{track['name']} {track['artists'][0]['name']}", query) for track in tracks]
-    best_match_index = similarities.index(max(similarities))
-    best_match = tracks[best_match_index]
-    return best_match
+    query = make_query(song['Title'], song['Artist'], song.get('Album'), song.get('Duration'))
+    track, _ = best_match(query, tracks, threshold)
+    return track
 
 
-def add_songs_to_playlist(sp, playlist_id, track_ids):
+@metrics.timed_stage('playlist_add')
+def add_songs_to_playlist(sp, playlist_id, track_ids, limiter=None, workers=1):
     """
     Add songs to the Spotify playlist in batches of 100 songs at a time.
 
+    Failed batches are retried and split by the playlist writer, so one bad request does not lose the songs after
+    it, see write_tracks for the breakdown of what was skipped and what failed.
+
     :param sp: an authenticated Spotify object
     :param playlist_id: a string representing the playlist's IDs
     :param track_ids: a list of strings representing song IDs
+    :param limiter: an optional TokenBucket shared by every Spotify request
+    :param workers: an integer representing how many batches are sent at the same time
     :precondition: playlist_id is a valid string
     :precondition: track_id is a valid non-empty list of strings
     :return: a list of songs added to the playlist
     """
-    added_tracks = []
-    batch_size = 100
-    try:
-        for i in range(0, len(track_ids), batch_size):
-            batch = track_ids[i:i + batch_size]
-            sp.playlist_add_items(playlist_id, batch)
-            added_tracks.extend(batch)
-    except Exception as e:
-        print(f"Spotify API error occurred while adding songs to playlist: {e}")
-    return added_tracks
+    # Imported here because the playlist writer reads playlists with this module's functions
+    from src.playlist_writer import write_tracks
 
+    return write_tracks(sp, playlist_id, track_ids, limiter=limiter, workers=workers)['added']
@@ -0,0 +1,147 @@
+"""
+This file contains the on-disk index of harvested song tags.
+
+The index remembers the title, artist, album, duration and ISRC of every song file (or that it has no metadata)
+along with the file's size and modification time, so that a rescan only has to open the files that are new or have
+changed.
+"""
+import os
+import sqlite3
+import threading
+
+from src.cache import default_cache_path
+
+
+def default_index_path():
+    """
+    Get the default location of the tag index, inside the 'cache' directory at the project's root.
+
+    :return: a string representing the path of the index file
+    """
+    return default_cache_path('tag_index.sqlite3')
+
+
+class TagIndex:
+    """
+    A SQLite backed index of song tags keyed by the file's path, size and modification time.
+    """
+
+    def __init__(self, index_path=None, rebuild=False):
+        """
+        Open the tag index, creating it if it does not exist.
+
+        :param index_path: a string representing the path of the index file, defaults to default_index_path()
+        :param rebuild: a boolean, whether to forget every indexed file so that all of them are read again
+        """
+        self.index_path = index_path or default_index_path()
+        if self.index_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(files)")]
+        if columns and 'isrc' not in columns:
+            # Indexes written before the duration and ISRC were harvested are read again from scratch
+            self._connection.execute("DROP TABLE files")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                 "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                                 "title TEXT, artist TEXT, album TEXT, has_metadata INTEGER, "
+                                 "duration REAL, isrc TEXT)")
+        if rebuild:
+            self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, path, size, mtime_ns):
+        """
+        Look up the indexed tags of a file.
+
+        :param path: a string representing the file's path
+        :param size: an integer representing the file's size in bytes
+        :param mtime_ns: an integer representing the file's modification time in nanoseconds
+        :return: a tuple of a boolean, True if the file is indexed and unchanged, and a dictionary of its metadata
+                 or None if the file has no metadata
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT title, artist, album, has_metadata, duration, isrc FROM files "
+                                           "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                           (path, size, mtime_ns)).fetchone()
+        if row is None:
+            return False, None
+        title, artist, album, has_metadata, duration, isrc = row
+        if not has_metadata:
+            return True, None
+        tags = {'Title': title, 'Artist': artist, 'Album': album}
+        if duration is not None:
+            tags['Duration'] = duration
+        if isrc is not None:
+            tags['ISRC'] = isrc
+        return True, tags
+
+    def store(self, path, size, mtime_ns, tags):
+        """
+        Store the tags of a file, replacing what was indexed for it before.
+
+        :param path: a string representing the file's path
+        :param size: an integer representing the file's size in bytes
+        :param mtime_ns: an integer representing the file's modification time in nanoseconds
+        :param tags: a dictionary of the song's metadata, or None if the file has no metadata
+        """
+        tags = tags or {}
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (path, size, mtime_ns, tags.get('Title'), tags.get('Artist'),
+                                      tags.get('Album'), 1 if tags else 0, tags.get('Duration'), tags.get('ISRC')))
+
+    def prune(self, existing_paths, root=None):
+        """
+        Remove the files that no longer exist from the index.
+
+        :param existing_paths: an iterable of strings representing the paths of every file that still exists
+        :param root: an optional string representing the path of the scanned folder, only the files inside it are
+                     removed so that the other folders sharing the index keep theirs
+        :return: an integer representing the number of files removed from the index
+        """
+        # Compared as a prefix rather than with LIKE, which ignores case and treats '%' and '_' in the folder's
+        # name as wildcards
+        prefix = "" if root is None else os.path.join(root, "")
+        with self._lock:
+            self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS existing (path TEXT PRIMARY KEY)")
+            self._connection.execute("DELETE FROM existing")
+            self._connection.executemany("INSERT OR IGNORE INTO existing VALUES (?)",
+                                         ((path,) for path in existing_paths))
+            removed = self._connection.execute("DELETE FROM files WHERE substr(path, 1, length(?)) = ? AND "
+                                               "path NOT IN (SELECT path FROM existing)", (prefix, prefix)).rowcount
+            self._connection.execute("DELETE FROM existing")
+            self._connection.commit()
+        return removed
+
+    def clear(self):
+        """
+        Forget every indexed file.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM files")
+            self._connection.commit()
+
+    def commit(self):
+        """
+        Save the stored tags to disk.
+        """
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        """
+        Save the stored tags and close the index.
+        """
+        self.commit()
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
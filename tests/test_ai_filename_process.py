@@ -1,13 +1,20 @@
+import io
+import json
 import unittest
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
 from src import ai_filename_process
+from src.cache import SqliteCache
+from src.rate_limit import TokenBucket
 
 
 class TestInvokePromptToAI(unittest.TestCase):
-    @patch('src.ai_filename_process.client.chat.completions.create')
-    def test_invoke_prompt_to_ai(self, mock_create):
+    def setUp(self):
+        self.client = MagicMock()
+
+    def test_invoke_prompt_to_ai(self):
+        mock_create = self.client.chat.completions.create
         # Mock the API response
         mock_response = MagicMock()
         mock_response.choices = [MagicMock()]
@@ -15,7 +22,7 @@ class TestInvokePromptToAI(unittest.TestCase):
         mock_create.return_value = mock_response
 
         file_names = ['test_file.mp3']
-        result = ai_filename_process.invoke_prompt_to_ai(file_names)
+        result = ai_filename_process.invoke_prompt_to_ai(file_names, client=self.client)
         self.assertEqual(result, ['Test Title, Test Artist, Test Album'])
 
         # Assert the mock was called with the correct arguments
@@ -33,6 +40,132 @@ class TestInvokePromptToAI(unittest.TestCase):
         )
 
 
+    def test_invoke_prompt_to_ai_failure_keeps_alignment(self):
+        mock_create = self.client.chat.completions.create
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = 'Test Title, Test Artist, Test Album'
+        mock_create.side_effect = [Exception("timeout"), mock_response]
+
+        with patch('sys.stdout', new_callable=io.StringIO):
+            result = ai_filename_process.invoke_prompt_to_ai(['bad_file.mp3', 'test_file.mp3'], client=self.client)
+        self.assertEqual(result, ['', 'Test Title, Test Artist, Test Album'])
+
+
+def make_reply(content):
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = content
+    return mock_response
+
+
+class TestBatchedInvokePromptToAI(TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.mock_create = self.client.chat.completions.create
+
+    def test_batch_mapped_by_index(self):
+        mock_create = self.mock_create
+        mock_create.return_value = make_reply(json.dumps({"songs": [
+            {"index": 1, "Title": "Second", "Artist": "B", "Album": ""},
+            {"index": 0, "Title": "First", "Artist": "A", "Album": "X"},
+        ]}))
+
+        result = ai_filename_process.invoke_prompt_to_ai(['first.mp3', 'second.mp3'], batch_size=10, client=self.client)
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertEqual(ai_filename_process.process_response(result),
+                         [{'Title': 'First', 'Artist': 'A', 'Album': 'X'},
+                          {'Title': 'Second', 'Artist': 'B', 'Album': ''}])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_malformed_batch_is_split(self, mock_output):
+        mock_create = self.mock_create
+        def fake_create(**kwargs):
+            if kwargs.get('response_format'):
+                return make_reply('{"songs": [{"index": 0, "Title": "Only one"}]}')
+            return make_reply('Solo, Artist, Album')
+
+        mock_create.side_effect = fake_create
+        result = ai_filename_process.invoke_prompt_to_ai(['a.mp3', 'b.mp3', 'c.mp3'], batch_size=3, client=self.client)
+        self.assertEqual(result, ['Solo, Artist, Album'] * 3)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_failed_batch_keeps_alignment(self, mock_output):
+        mock_create = self.mock_create
+        mock_create.side_effect = [Exception("server error"), make_reply(json.dumps({"songs": [
+            {"index": 0, "Title": "Third", "Artist": "C", "Album": ""},
+            {"index": 1, "Title": "Fourth", "Artist": "D", "Album": ""},
+        ]}))]
+
+        result = ai_filename_process.invoke_prompt_to_ai(['a.mp3', 'b.mp3', 'c.mp3', 'd.mp3'], batch_size=2,
+                                                         client=self.client)
+        self.assertEqual([song['Title'] for song in ai_filename_process.process_response(result)],
+                         ['', '', 'Third', 'Fourth'])
+
+
+class RateLimitedError(Exception):
+    status_code = 429
+    headers = {'retry-after': '0'}
+
+
+class TestConcurrentInvokePromptToAI(TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.mock_create = self.client.chat.completions.create
+
+    def test_concurrent_requests_keep_order(self):
+        self.mock_create.side_effect = lambda **kwargs: make_reply(kwargs['messages'][1]['content'].split("'")[1])
+        file_names = [f"song {number}.mp3" for number in range(20)]
+
+        result = ai_filename_process.invoke_prompt_to_ai(file_names, client=self.client, max_in_flight=5,
+                                                         limiter=TokenBucket(rate=1000))
+        self.assertEqual(result, file_names)
+
+    def test_rate_limited_request_is_retried(self):
+        self.mock_create.side_effect = [RateLimitedError(), make_reply('Test Title, Test Artist, Test Album')]
+
+        result = ai_filename_process.invoke_prompt_to_ai(['test_file.mp3'], client=self.client)
+        self.assertEqual(result, ['Test Title, Test Artist, Test Album'])
+        self.assertEqual(self.mock_create.call_count, 2)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_deadline_passed(self, mock_output):
+        result = ai_filename_process.invoke_prompt_to_ai(['a.mp3', 'b.mp3'], client=self.client, timeout=0)
+        self.assertEqual(result, ['', ''])
+        self.mock_create.assert_not_called()
+
+    def test_empty_list_needs_no_client(self):
+        with patch('src.ai_filename_process.get_client') as mock_get_client:
+            self.assertEqual(ai_filename_process.invoke_prompt_to_ai([]), [])
+            mock_get_client.assert_not_called()
+
+
+class TestCachedInvokePromptToAI(TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.chat.completions.create.return_value = make_reply('Test Title, Test Artist, Test Album')
+        self.cache = SqliteCache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_warm_cache_skips_prompt(self):
+        file_names = ['test_file.mp3', 'Test_File.mp3', 'test_file.mp3']
+        first = ai_filename_process.invoke_prompt_to_ai(file_names, client=self.client, cache=self.cache)
+        self.assertEqual(self.client.chat.completions.create.call_count, 1)
+
+        second = ai_filename_process.invoke_prompt_to_ai(file_names, client=self.client, cache=self.cache)
+        self.assertEqual(self.client.chat.completions.create.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_failures_are_not_cached(self, mock_output):
+        self.client.chat.completions.create.side_effect = Exception("timeout")
+        ai_filename_process.invoke_prompt_to_ai(['test_file.mp3'], client=self.client, cache=self.cache)
+        self.assertEqual(len(self.cache), 0)
+
+
 class TestProcessResponse(TestCase):
     def test_process_response(self):
         real_songs = ['Come my way,BOB,Emerald Lake',
@@ -0,0 +1,83 @@
+import io
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeAPIError, FakeSpotify
+from src.app import create_app
+from src.cache import SqliteCache
+from src.job_service import JobService
+
+CATALOG = [{'Title': f"Song {i}", 'Artist': f"Artist {i}", 'Album': "Album"} for i in range(10)]
+
+
+@patch('sys.stdout', new_callable=io.StringIO)
+class AppTest(TestCase):
+    def setUp(self):
+        self.clients = {'token-a': FakeSpotify(CATALOG, user_id='alice'),
+                        'token-b': FakeSpotify(CATALOG, user_id='bob')}
+        self.cache = SqliteCache(":memory:")
+        self.service = JobService(workers=2, spotify_client=self.spotify_client, user_rate=1000, app_rate=1000,
+                                  search_options={'cache': self.cache})
+        self.client = create_app(self.service).test_client()
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.cache.close()
+
+    def spotify_client(self, token):
+        if token not in self.clients:
+            raise FakeAPIError(401, "invalid access token")
+        return self.clients[token]
+
+    def poll(self, location, token='token-a'):
+        for _ in range(500):
+            response = self.client.get(location, headers={'Authorization': f"Bearer {token}"})
+            if response.get_json()['status'] in ('finished', 'failed'):
+                return response.get_json()
+            time.sleep(0.01)
+        raise AssertionError(f"{location} did not finish")
+
+    def test_submit_manifest_and_poll(self, mock_output):
+        manifest = "Title,Artist\n" + "".join(f"{song['Title']},{song['Artist']}\n" for song in CATALOG[:4])
+        response = self.client.post('/jobs', headers={'Authorization': "Bearer token-a"},
+                                    data={'playlist': 'Harvest', 'manifest': (io.BytesIO(manifest.encode()), 'a.csv')})
+        self.assertEqual(202, response.status_code)
+
+        job = self.poll(response.headers['Location'])
+        self.assertEqual('finished', job['status'])
+        self.assertEqual(4, job['progress']['added'])
+        listed = self.client.get('/jobs', headers={'Authorization': "Bearer token-a"}).get_json()['jobs']
+        self.assertEqual([job['id']], [entry['id'] for entry in listed])
+
+    def test_submit_json_manifest(self, mock_output):
+        response = self.client.post('/jobs', headers={'Authorization': "Bearer token-b"},
+                                    json={'playlist': 'Harvest', 'manifest': CATALOG[:2]})
+        self.assertEqual(2, self.poll(response.headers['Location'], 'token-b')['progress']['added'])
+
+    def test_errors(self, mock_output):
+        body = {'playlist': 'Harvest', 'manifest': CATALOG[:1]}
+        self.assertEqual(401, self.client.post('/jobs', json=body).status_code)
+        self.assertEqual(401, self.client.get('/jobs', headers={'Authorization': "Bearer token-c"}).status_code)
+        self.assertEqual(400, self.client.post('/jobs', headers={'Authorization': "Bearer token-a"},
+                                               json={'playlist': 'Harvest'}).status_code)
+        self.assertEqual(400, self.client.post('/jobs', headers={'Authorization': "Bearer token-a"},
+                                               json={'playlist': 'Harvest', 'filenames': "a.mp3"}).status_code)
+
+        location = self.client.post('/jobs', headers={'Authorization': "Bearer token-a"},
+                                    json=body).headers['Location']
+        self.assertEqual(404, self.client.get(location, headers={'Authorization': "Bearer token-b"}).status_code)
+        self.assertEqual(404, self.client.get('/jobs/999', headers={'Authorization': "Bearer token-a"}).status_code)
+
+    def test_full_queue(self, mock_output):
+        service = JobService(workers=0, spotify_client=self.spotify_client, max_jobs_per_user=2)
+        self.client = create_app(service).test_client()
+        body = {'playlist': 'Harvest', 'manifest': CATALOG[:1]}
+        statuses = [self.client.post('/jobs', headers={'Authorization': "Bearer token-a"}, json=body).status_code
+                    for _ in range(3)]
+        self.assertEqual([202, 202, 429], statuses)
+
+
+if __name__ == '__main__':
+    unittest.main()
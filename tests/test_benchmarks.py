@@ -0,0 +1,68 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeAPIError, FakeOpenAI, FakeSpotify
+from benchmarks.library import generate_library
+from src.ai_filename_process import invoke_prompt_to_ai, process_response
+from src.fileIO import media_file_finder, metadata_harvester
+from src.rate_limit import call_with_retries, is_rate_limited, retry_after_seconds
+
+
+class GenerateLibraryTest(TestCase):
+    def test_tags_are_read_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            library = generate_library(directory, 40, untagged_ratio=0.5, wav_ratio=0.5)
+            files = list(media_file_finder(directory))
+            metadata, untagged = metadata_harvester(files, include_paths=True)
+
+        tagged = {path: song for path, song, is_tagged in library if is_tagged}
+        self.assertEqual(40, len(files))
+        self.assertEqual(len(tagged), len(metadata))
+        self.assertEqual(40 - len(tagged), len(untagged))
+        for song in metadata:
+            expected = tagged[song['File']]
+            self.assertEqual((expected['Title'], expected['Artist'], expected['Album']),
+                             (song['Title'], song['Artist'], song['Album']))
+            self.assertAlmostEqual(expected['Duration'], song['Duration'], delta=0.05)
+            self.assertIn(song.get('ISRC'), (None, expected['ISRC']))
+        self.assertTrue(any('ISRC' in song for song in metadata))
+        self.assertEqual(sorted(os.path.basename(path) for path, _, is_tagged in library if not is_tagged),
+                         sorted(untagged))
+
+
+class FakesTest(TestCase):
+    def test_spotify_search_and_rate_limit(self):
+        sp = FakeSpotify([{'Title': 'Song', 'Artist': 'Artist', 'Album': 'Album', 'Duration': 200}], rate_limit=20)
+        for _ in range(20):
+            items = sp.search("track:Song artist:Artist", type='track', limit=5)['tracks']['items']
+        self.assertEqual(['Song'], [track['name'] for track in items])
+
+        with self.assertRaises(FakeAPIError) as context:
+            sp.search("track:Song", type='track', limit=5)
+        self.assertTrue(is_rate_limited(context.exception))
+        self.assertEqual(0.05, retry_after_seconds(context.exception))
+        result = call_with_retries(lambda: sp.search("track:Missing"))
+        self.assertEqual([], result['tracks']['items'])
+        self.assertEqual(2, sp.calls['rate limited'])
+
+    def test_spotify_isrc_search(self):
+        sp = FakeSpotify([{'Title': 'Song', 'Artist': 'Artist', 'ISRC': 'QZABC2400001'}])
+        self.assertEqual(['Song'], [track['name'] for track in sp.search("isrc:qzabc2400001")['tracks']['items']])
+        self.assertEqual([], sp.search("isrc:QZABC2400002")['tracks']['items'])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_openai_answers_batches_and_splits_malformed_ones(self, mock_output):
+        answers = {f"file {number}.mp3": {'Title': f"Title {number}", 'Artist': 'Artist'} for number in range(4)}
+        client = FakeOpenAI(answers, malformed_rate=1.0)
+
+        metadata = process_response(invoke_prompt_to_ai(list(answers), batch_size=4, client=client))
+        self.assertEqual([f"Title {number}" for number in range(4)], [song['Title'] for song in metadata])
+        self.assertEqual(['Artist'] * 4, [song['Artist'] for song in metadata])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+
+from src import cache
+
+
+class SqliteCacheTest(TestCase):
+    def setUp(self):
+        self.cache = cache.SqliteCache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_and_set(self):
+        self.cache.set('key', {'Title': 'Test Title'})
+        self.assertEqual({'Title': 'Test Title'}, self.cache.get('key'))
+        self.assertIs(cache.MISSING, self.cache.get('other'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1}, self.cache.stats())
+
+    def test_none_is_cached(self):
+        self.cache.set('key', None)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_ttl_expiry(self):
+        self.cache.set('key', 'value', ttl=-1)
+        self.assertIs(cache.MISSING, self.cache.get('key'))
+
+    def test_lru_eviction(self):
+        small_cache = cache.SqliteCache(":memory:", max_entries=10)
+        for number in range(10):
+            small_cache.set(str(number), number)
+        time.sleep(0.01)
+        small_cache.get('0')
+        small_cache.set('10', 10)
+        self.assertLessEqual(len(small_cache), 10)
+        self.assertEqual(0, small_cache.get('0'))
+        self.assertIs(cache.MISSING, small_cache.get('1'))
+        small_cache.close()
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, 'cache.sqlite3')
+            with cache.SqliteCache(cache_path) as first_cache:
+                first_cache.set('key', 'value')
+            with cache.SqliteCache(cache_path) as second_cache:
+                self.assertEqual('value', second_cache.get('key'))
+                self.assertEqual(1, len(second_cache))
+
+
+class KeyTest(TestCase):
+    def test_normalized_text_shares_key(self):
+        self.assertEqual(cache.make_key(cache.normalize_text("ＡＣＤＣ  -  Song.mp3"), 1),
+                         cache.make_key(cache.normalize_text("acdc - song.mp3"), 1))
+        self.assertNotEqual(cache.make_key("acdc - song.mp3", 1), cache.make_key("acdc - song.mp3", 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import TestCase
+
+from tinytag import TinyTag
+
+from benchmarks.library import MP3_FRAME, _id3_tag, _info_frame, _riff_chunk, generate_library
+from src.fast_tags import read_fast_tags
+
+SONG = {'Title': "Like a Stone", 'Artist': "Audioslave", 'Album': "Audioslave", 'ISRC': "USIR10211559"}
+
+
+class ReadFastTagsTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def assertSameTags(self, path):
+        tag, reference = read_fast_tags(path), TinyTag.get(path)
+        self.assertIsNotNone(tag, path)
+        for field in ('title', 'artist', 'album', 'duration'):
+            self.assertEqual(getattr(reference, field), getattr(tag, field), f"{field} of {path}")
+        self.assertEqual(reference.other.get('isrc'), tag.other.get('isrc'), path)
+
+    def test_same_tags_as_tinytag(self):
+        for path, _, _ in generate_library(self.root, 200, wav_ratio=0.3):
+            self.assertSameTags(path)
+
+    def test_id3v23_utf16_and_id3v1(self):
+        frames = b""
+        for frame_id, text in ((b"TIT2", SONG['Title']), (b"TPE1", SONG['Artist'])):
+            body = b"\x01" + text.encode('utf-16') + b"\x00\x00"
+            frames += frame_id + struct.pack('>I', len(body)) + b"\x00\x00" + body
+        id3v2 = b"ID3\x03\x00\x00" + bytes([0, 0, len(frames) >> 7, len(frames) & 0x7f]) + frames
+        id3v1 = b"TAG" + b"Other title".ljust(30, b"\x00") + bytes(30) + b"Album".ljust(30, b"\x00") + bytes(35)
+        path = self.write('v23.mp3', id3v2 + _info_frame(200) + MP3_FRAME * 10 + id3v1)
+        self.assertSameTags(path)
+        self.assertEqual((SONG['Title'], "Album"), (read_fast_tags(path).title, read_fast_tags(path).album))
+
+    def test_unsynchronised_id3_falls_back(self):
+        tag = bytearray(_id3_tag(SONG))
+        tag[5] = 0x80
+        self.assertIsNone(read_fast_tags(self.write('unsync.mp3', bytes(tag) + _info_frame(200) + MP3_FRAME * 10)))
+
+    def test_id3_chunk_in_wav_falls_back(self):
+        fmt = struct.pack('<HHIIHH', 1, 1, 44100, 88200, 2, 16)
+        chunks = _riff_chunk(b"fmt ", fmt) + _riff_chunk(b"data", bytes(88200)) + _riff_chunk(b"id3 ", _id3_tag(SONG))
+        path = self.write('id3.wav', b"RIFF" + struct.pack('<I', 4 + len(chunks)) + b"WAVE" + chunks)
+        self.assertIsNone(read_fast_tags(path))
+
+    def test_empty_file_falls_back(self):
+        self.assertIsNone(read_fast_tags(self.write('empty.mp3', b"")))
+
+    def test_other_formats_fall_back(self):
+        self.assertIsNone(read_fast_tags(self.write('song.flac', b"fLaC" + bytes(100))))
+        self.assertIsNone(read_fast_tags(self.write('song.ogg', b"OggS" + bytes(100))))
+
+
+if __name__ == '__main__':
+    unittest.main()
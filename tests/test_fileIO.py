@@ -1,4 +1,6 @@
 import io
+import os
+import tempfile
 import unittest
 from unittest import TestCase
 from unittest.mock import patch, MagicMock, call
@@ -20,6 +22,42 @@ class FolderTest(TestCase):
             fileIO.select_folder()
 
 
+class MediaFileFinderTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for relative_path in ['a.mp3', 'b.MP3', 'notes.txt', os.path.join('Artist', 'Album', 'c.flac'),
+                              os.path.join('Artist', 'Album', 'd.m4a'), os.path.join('Live', 'e.ogg')]:
+            full_path = os.path.join(self.root, relative_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'w').close()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def found_names(self, **kwargs):
+        return sorted(os.path.basename(path) for path in fileIO.media_file_finder(self.root, **kwargs))
+
+    def test_media_file_finder_recursive_and_case_insensitive(self):
+        self.assertEqual(['a.mp3', 'b.MP3', 'c.flac', 'd.m4a', 'e.ogg'], self.found_names())
+
+    def test_media_file_finder_is_lazy(self):
+        finder = fileIO.media_file_finder(self.root)
+        self.assertTrue(next(finder).startswith(self.root))
+
+    def test_media_file_finder_custom_extensions(self):
+        self.assertEqual(['c.flac'], self.found_names(extensions={'.FLAC'}))
+
+    def test_media_file_finder_include_and_exclude(self):
+        self.assertEqual(['a.mp3', 'b.MP3'], self.found_names(include=['*.mp3', '*.MP3']))
+        self.assertEqual(['a.mp3', 'b.MP3', 'e.ogg'], self.found_names(exclude=['Artist']))
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), "symlinks are not supported")
+    def test_media_file_finder_symlink_loop(self):
+        os.symlink(self.root, os.path.join(self.root, 'Artist', 'loop'))
+        self.assertEqual(['a.mp3', 'b.MP3', 'c.flac', 'd.m4a', 'e.ogg'], self.found_names())
+
+
 class MetadataHarvestTest(TestCase):
     @patch('tinytag.TinyTag.get')
     def test_metadata_harvester_files_found_harvested(self, mock_get):
@@ -33,6 +71,35 @@ class MetadataHarvestTest(TestCase):
         self.assertEqual(metadata, [{'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': 'Test Album'}])
         self.assertEqual(filenames, [])
 
+    @patch('tinytag.TinyTag.get')
+    def test_metadata_harvester_include_paths(self, mock_get):
+        mock_audio_file = MagicMock()
+        mock_audio_file.title = 'Test Title'
+        mock_audio_file.artist = 'Test Artist'
+        mock_audio_file.album = 'Test Album'
+        mock_get.return_value = mock_audio_file
+
+        metadata, filenames = fileIO.metadata_harvester(['test_file.mp3'], include_paths=True)
+        self.assertEqual(metadata, [{'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': 'Test Album',
+                                     'File': 'test_file.mp3'}])
+
+    @patch('tinytag.TinyTag.get')
+    def test_metadata_harvester_duration_and_isrc(self, mock_get):
+        mock_audio_file = MagicMock()
+        mock_audio_file.title = 'Test Title'
+        mock_audio_file.artist = 'Test Artist'
+        mock_audio_file.album = 'Test Album'
+        mock_audio_file.duration = 215.4321
+        mock_audio_file.other = {'isrc': ['us-um7-17-03861']}
+        invalid_isrc = MagicMock(title='Test Title', artist='Test Artist', album=None, duration=None,
+                                 other={'isrc': ['not an isrc']})
+        mock_get.side_effect = [mock_audio_file, invalid_isrc]
+
+        metadata, filenames = fileIO.metadata_harvester(['a.mp3', 'b.mp3'])
+        self.assertEqual({'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': 'Test Album', 'Duration': 215.43,
+                          'ISRC': 'USUM71703861'}, metadata[0])
+        self.assertEqual({'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': None}, metadata[1])
+
     @patch('tinytag.TinyTag.get')
     def test_metadata_harvester_no_metadata(self, mock_get):
         mock_audio_file = MagicMock()
@@ -60,6 +127,35 @@ class MetadataHarvestTest(TestCase):
         self.assertEqual(mock_output.getvalue, "No audio files found in directory.")
 
 
+    @patch('tinytag.TinyTag.get')
+    def test_metadata_harvester_unreadable_file(self, mock_get):
+        mock_audio_file = MagicMock()
+        mock_audio_file.title = 'Test Title'
+        mock_audio_file.artist = 'Test Artist'
+        mock_audio_file.album = 'Test Album'
+        mock_get.side_effect = [mock_audio_file, Exception("corrupt header"), mock_audio_file]
+
+        with patch('sys.stdout', new_callable=io.StringIO):
+            metadata, filenames = fileIO.metadata_harvester(['a.mp3', os.path.join('folder', 'b.mp3'), 'c.mp3'])
+        self.assertEqual(len(metadata), 2)
+        self.assertEqual(filenames, ['b.mp3'])
+
+    @patch('tinytag.TinyTag.get')
+    def test_metadata_harvester_parallel_keeps_order(self, mock_get):
+        def fake_get(file):
+            audio_file = MagicMock()
+            audio_file.title = file if int(file[:-4]) % 3 else None
+            audio_file.artist = 'Test Artist'
+            audio_file.album = 'Test Album'
+            return audio_file
+
+        mock_get.side_effect = fake_get
+        files = [f"{number}.mp3" for number in range(50)]
+        metadata, filenames = fileIO.metadata_harvester(files, workers=8)
+        self.assertEqual([song['Title'] for song in metadata], [file for file in files if int(file[:-4]) % 3])
+        self.assertEqual(filenames, [file for file in files if not int(file[:-4]) % 3])
+
+
 class TestCleanMetadata(TestCase):
     def test_clean_metadata_clean_title(self):
         dummy_title = "Super Duper -**_/ Official Video ft. BOB"
@@ -77,6 +173,10 @@ class TestCleanMetadata(TestCase):
         clean_title, clean_artist = fileIO.clean_metadata(dummy_title, dummy_artist)
         self.assertEqual(expected_artist, clean_artist)
 
+    def test_clean_metadata_keeps_slash_in_artist(self):
+        self.assertEqual(('Highway to Hell', 'AC/DC'), fileIO.clean_metadata('Highway to Hell', 'AC/DC'))
+        self.assertEqual(('Under Pressure', 'Queen'), fileIO.clean_metadata('Under Pressure', 'Queen / David Bowie'))
+
 
 class TestFailedCSVWriter(unittest.TestCase):
 
@@ -103,5 +203,22 @@ class TestFailedCSVWriter(unittest.TestCase):
         mock_open().write.assert_has_calls(calls)
 
 
+class TestReadFailedTracks(unittest.TestCase):
+
+    @patch('builtins.open', new_callable=unittest.mock.mock_open,
+           read_data='Song\\, Artist\r\nTitle\\, With Comma\\, Other Artist\r\n\r\nNo Artist\r\n')
+    def test_reads_what_the_writer_wrote(self, mock_open):
+        self.assertEqual([{'Title': 'Song', 'Artist': 'Artist'},
+                          {'Title': 'Title, With Comma', 'Artist': 'Other Artist'},
+                          {'Title': 'No Artist', 'Artist': ''}], fileIO.read_failed_tracks())
+        self.assertTrue(mock_open.call_args.args[0].endswith('failures.csv'))
+
+    @patch('builtins.open', side_effect=FileNotFoundError)
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_missing_file(self, mock_output, mock_open):
+        self.assertEqual([], fileIO.read_failed_tracks())
+        self.assertEqual("No failures.csv file found.\n", mock_output.getvalue())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from src import ai_filename_process, filename_parser
+
+
+class ParseFilenameTest(TestCase):
+    def test_artist_title(self):
+        metadata, confidence = filename_parser.parse_filename('Artist - Title.mp3')
+        self.assertEqual({'Title': 'Title', 'Artist': 'Artist', 'Album': ''}, metadata)
+        self.assertGreaterEqual(confidence, 0.8)
+
+    def test_track_number_and_noise(self):
+        metadata, confidence = filename_parser.parse_filename('01 - Artist - Title (Official Video).mp3')
+        self.assertEqual({'Title': 'Title', 'Artist': 'Artist', 'Album': ''}, metadata)
+        self.assertGreaterEqual(confidence, 0.8)
+
+    def test_underscores_and_video_id(self):
+        metadata, confidence = filename_parser.parse_filename('Artist_-_Title-[dQw4w9WgXcQ].mp3')
+        self.assertEqual({'Title': 'Title', 'Artist': 'Artist', 'Album': ''}, metadata)
+        self.assertGreaterEqual(confidence, 0.8)
+
+    def test_numbers_in_names_are_kept(self):
+        metadata, _ = filename_parser.parse_filename('50 Cent - In Da Club.mp3')
+        self.assertEqual('50 Cent', metadata['Artist'])
+        metadata, _ = filename_parser.parse_filename('Blink-182 - All The Small Things.mp3')
+        self.assertEqual('Blink-182', metadata['Artist'])
+
+    def test_unstructured_name_is_unsure(self):
+        _, confidence = filename_parser.parse_filename('track01.mp3')
+        self.assertLess(confidence, 0.8)
+
+
+class ExtractFilenameMetadataTest(TestCase):
+    def test_only_unsure_names_go_to_ai(self):
+        client = MagicMock()
+        client.chat.completions.create.return_value.choices = [MagicMock()]
+        client.chat.completions.create.return_value.choices[0].message.content = 'AI Title,AI Artist,'
+
+        result = ai_filename_process.extract_filename_metadata(['Artist - Title.mp3', 'track01.mp3'],
+                                                               client=client)
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        self.assertEqual([{'Title': 'Title', 'Artist': 'Artist', 'Album': ''},
+                          {'Title': 'AI Title', 'Artist': 'AI Artist', 'Album': ''}], result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeAPIError, FakeOpenAI, FakeSpotify
+from src.cache import SqliteCache
+from src.job_service import FINISHED, InvalidToken, JobService, QueueFull, parse_manifest
+
+CATALOG = [{'Title': f"Song {i}", 'Artist': f"Artist {i}", 'Album': "Album"} for i in range(60)]
+
+
+def wait_for(service, job_id, timeout=10):
+    give_up_at = time.monotonic() + timeout
+    while time.monotonic() < give_up_at:
+        job = service.get(job_id)
+        if job['status'] in ('finished', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+class ParseManifestTest(TestCase):
+    def test_csv(self):
+        songs = parse_manifest("Title,Artist,Album,Duration,ISRC\nSong,Artist,,201.5,us-abc-12-34567\n")
+        self.assertEqual([{'Title': "Song", 'Artist': "Artist", 'Album': "", 'Duration': 201.5,
+                           'ISRC': "USABC1234567"}], songs)
+
+    def test_json(self):
+        self.assertEqual([{'Title': "Song", 'Artist': "", 'Album': ""}], parse_manifest('[{"Title": "Song"}]'))
+
+    def test_song_without_title(self):
+        with self.assertRaises(ValueError):
+            parse_manifest("Title,Artist\n,Artist\n")
+        with self.assertRaises(ValueError):
+            parse_manifest('[{"Title": "Song"')
+
+
+@patch('sys.stdout', new_callable=io.StringIO)
+class JobServiceTest(TestCase):
+    def setUp(self):
+        self.clients = {'token-a': FakeSpotify(CATALOG, user_id='alice'),
+                        'token-b': FakeSpotify(CATALOG, user_id='bob')}
+        self.cache = SqliteCache(":memory:")
+        self.addCleanup(self.cache.close)
+
+    def client(self, token):
+        if token not in self.clients:
+            raise FakeAPIError(401, "invalid access token")
+        return self.clients[token]
+
+    def service(self, **options):
+        options = dict({'workers': 2, 'spotify_client': self.client, 'user_rate': 1000, 'app_rate': 1000,
+                        'search_options': {'cache': self.cache}}, **options)
+        service = JobService(**options)
+        self.addCleanup(service.shutdown)
+        return service
+
+    def test_job_adds_songs_to_the_users_playlist(self, mock_output):
+        service = self.service(slice_size=7)
+        songs = CATALOG[:20] + CATALOG[:2] + [{'Title': "Missing", 'Artist': "Nobody", 'Album': ""}]
+
+        job = wait_for(service, service.submit('token-a', 'Harvest', songs=songs).id)
+        self.assertEqual(FINISHED, job['status'])
+        self.assertEqual({'total': 23, 'processed': 23, 'matched': 20, 'duplicates': 2, 'added': 20, 'failed': 1},
+                         job['progress'])
+        self.assertEqual(set(job['added']), set(self.clients['token-a'].playlists[job['playlist_id']]['tracks']))
+        self.assertEqual({}, self.clients['token-b'].playlists)
+        self.assertNotIn('token', job)
+
+    @patch('src.ai_filename_process.get_client', return_value=FakeOpenAI())
+    def test_filenames_are_extracted(self, mock_get_client, mock_output):
+        service = self.service(ai_options={'cache': SqliteCache(":memory:")})
+        file_names = [f"{song['Artist']} - {song['Title']}.mp3" for song in CATALOG[:5]]
+
+        job = wait_for(service, service.submit('token-b', 'Harvest', file_names=file_names).id)
+        self.assertEqual(5, job['progress']['added'])
+
+    @patch('src.job_service.extract_filename_metadata')
+    def test_songs_without_title_are_not_duplicates(self, mock_extract, mock_output):
+        mock_extract.side_effect = lambda names, **ai_options: [{'Title': "", 'Artist': ""} for _ in names]
+        service = self.service()
+
+        job = wait_for(service, service.submit('token-a', 'Harvest', file_names=['01.mp3', '02.mp3']).id)
+        self.assertEqual(0, job['progress']['duplicates'])
+        self.assertEqual(2, job['progress']['failed'])
+
+    def test_users_take_turns(self, mock_output):
+        self.clients['token-a'].latency = 0.005
+        service = self.service(workers=1, slice_size=5)
+        big = service.submit('token-a', 'Big', songs=CATALOG)
+        small = service.submit('token-b', 'Small', songs=CATALOG[:5])
+
+        small = wait_for(service, small.id)
+        self.assertLess(service.get(big.id)['progress']['processed'], len(CATALOG))
+        self.assertLess(small['finished'], wait_for(service, big.id)['finished'])
+
+    def test_jobs_are_only_visible_to_their_user(self, mock_output):
+        service = self.service()
+        job = service.submit('token-a', 'Harvest', songs=CATALOG[:1])
+        self.assertIsNone(service.get(job.id, 'bob'))
+        self.assertEqual([job.id], [entry['id'] for entry in service.list_jobs('alice')])
+        self.assertEqual([], service.list_jobs('bob'))
+
+    def test_limits(self, mock_output):
+        service = self.service(workers=0, max_jobs_per_user=1)
+        service.submit('token-a', 'Harvest', songs=CATALOG[:1])
+        with self.assertRaises(QueueFull):
+            service.submit('token-a', 'Harvest', songs=CATALOG[:1])
+        service.submit('token-b', 'Harvest', songs=CATALOG[:1])
+        with self.assertRaises(ValueError):
+            service.submit('token-b', 'Harvest')
+        with self.assertRaises(InvalidToken):
+            service.submit('token-c', 'Harvest', songs=CATALOG[:1])
+
+
+    def test_tokens_are_checked_again(self, mock_output):
+        service = self.service(workers=0, max_tokens=1, token_ttl=60)
+        self.assertEqual('alice', service.identify('token-a'))
+        self.assertEqual('alice', service.identify('token-a'))
+        self.assertEqual(1, self.clients['token-a'].calls['current_user'])
+
+        # Only the most recent token is remembered
+        self.assertEqual('bob', service.identify('token-b'))
+        service.identify('token-a')
+        self.assertEqual(2, self.clients['token-a'].calls['current_user'])
+
+        # A revoked token stops working once it has to be checked again
+        service = self.service(workers=0, token_ttl=0)
+        service.identify('token-a')
+        del self.clients['token-a']
+        with self.assertRaises(InvalidToken):
+            service.identify('token-a')
+
+
+if __name__ == '__main__':
+    unittest.main()
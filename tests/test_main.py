@@ -0,0 +1,84 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from benchmarks.fakes import FakeOpenAI, FakeSpotify
+from benchmarks.library import generate_library
+from src import main
+
+
+class MainTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.library = os.path.join(self.directory.name, 'library')
+        self.cache = os.path.join(self.directory.name, 'cache')
+        self.songs = generate_library(self.library, 20, untagged_ratio=0.5)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_heavy_modules_are_not_imported(self):
+        script = ("import sys\nimport src.main\n"
+                  "print(','.join(m for m in ('tkinter', 'spotipy', 'openai', 'requests') if m in sys.modules))")
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual("", output.stdout.strip())
+
+    @patch('src.main.interactive', return_value=False)
+    @patch('sys.stderr', new_callable=io.StringIO)
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_headless_run_needs_folder_and_playlist(self, mock_output, mock_error, mock_interactive):
+        self.assertEqual(2, main.main([]))
+        self.assertEqual(2, main.main([self.library]))
+        self.assertIn("--playlist", mock_error.getvalue())
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_scan_only_report(self, mock_output):
+        report_path = os.path.join(self.directory.name, 'report.json')
+
+        self.assertEqual(0, main.main([self.library, '--scan-only', '--cache-dir', self.cache, '-o', report_path]))
+        with open(report_path, encoding='utf-8') as file:
+            report = json.load(file)
+        self.assertEqual(20, len(report['files']))
+        self.assertTrue({'tagged', 'parsed', 'needs ai'} >= {entry['Status'] for entry in report['files']})
+
+    @patch('src.main.run_pipeline', return_value=(['id-1'], [], [{'File': 'a.mp3', 'Status': 'added'}]))
+    @patch('src.main.create_spotify_client')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_dry_run_does_not_create_the_playlist(self, mock_output, mock_client, mock_pipeline):
+        sp = mock_client.return_value = MagicMock()
+        sp.current_user_playlists.return_value = {'items': []}
+
+        self.assertEqual(0, main.main([self.library, '--playlist', 'New', '--dry-run', '--cache-dir', self.cache]))
+        sp.user_playlist_create.assert_not_called()
+        self.assertIsNone(mock_pipeline.call_args.args[1])
+        self.assertTrue(mock_pipeline.call_args.kwargs['dry_run'])
+        self.assertIn("Would add 1 song(s)", mock_output.getvalue())
+
+    @patch('src.ai_filename_process.get_client', return_value=FakeOpenAI())
+    @patch('src.main.create_spotify_client')
+    @patch('sys.stderr', new_callable=io.StringIO)
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_sync(self, mock_output, mock_error, mock_client, mock_get_client):
+        sp = mock_client.return_value = FakeSpotify([song for _, song, _ in self.songs])
+        arguments = [self.library, '--playlist', 'Synced', '--sync', '--cache-dir', self.cache]
+
+        self.assertEqual(1, main.main(arguments + ['--dry-run']))
+        self.assertEqual({}, sp.playlists)
+        self.assertIn("No playlist named Synced", mock_error.getvalue())
+        self.assertEqual(0, main.main(arguments))
+        first = list(sp.playlists.values())[0]['tracks']
+        self.assertTrue(first)
+        self.assertEqual(0, main.main(arguments))
+        self.assertEqual(first, list(sp.playlists.values())[0]['tracks'])
+        self.assertIn("Added 0 and removed 0 song(s).", mock_output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from src import match_scoring
+
+
+def make_track(track_id, name, artists, album="", duration_ms=None):
+    return {'id': track_id, 'name': name, 'artists': [{'name': artist} for artist in artists],
+            'album': {'name': album}, 'duration_ms': duration_ms}
+
+
+class BestMatchTest(TestCase):
+    def setUp(self):
+        self.tracks = [make_track('live', 'Like a Stone - Live', ['Chris Cornell'], 'Live', 320000),
+                       make_track('studio', 'Like A Stone', ['Audioslave'], 'Audioslave', 294000),
+                       make_track('other', 'Rock and Roll', ['Led Zeppelin'], 'IV', 220000)]
+
+    def test_exact_match(self):
+        track, score = match_scoring.best_match(match_scoring.make_query('Like a Stone', 'Audioslave'), self.tracks)
+        self.assertEqual('studio', track['id'])
+        self.assertEqual(100.0, score)
+
+    def test_low_score_is_rejected(self):
+        track, score = match_scoring.best_match(match_scoring.make_query('Yellow', 'Coldplay'), self.tracks)
+        self.assertIsNone(track)
+        self.assertLess(score, match_scoring.DEFAULT_THRESHOLD)
+
+    def test_duration_breaks_ties(self):
+        tracks = [make_track('radio', 'Song', ['Band'], duration_ms=180000),
+                  make_track('extended', 'Song', ['Band'], duration_ms=420000)]
+        scores = match_scoring.score_candidates(match_scoring.make_query('Song', 'Band', duration=418), tracks)
+        self.assertGreater(scores[1], scores[0])
+
+    def test_duration_filters_candidates(self):
+        tracks = [make_track('extended', 'Song', ['Band'], duration_ms=420000),
+                  make_track('unknown', 'Songs', ['Band'])]
+        with patch.object(match_scoring, '_score_fields', wraps=match_scoring._score_fields) as mock_score:
+            track, _ = match_scoring.best_match(match_scoring.make_query('Song', 'Band', duration=180), tracks)
+        self.assertEqual('unknown', track['id'])
+        self.assertEqual(1, len(mock_score.call_args.args[1]))
+
+        track, score = match_scoring.best_match(match_scoring.make_query('Song', 'Band', duration=180), tracks[:1])
+        self.assertIsNone(track)
+        self.assertEqual(0.0, score)
+
+    def test_featured_artist_counts(self):
+        tracks = [make_track('feature', 'Under Pressure', ['Queen', 'David Bowie'])]
+        scores = match_scoring.score_candidates(match_scoring.make_query('Under Pressure!', 'David Bowie'), tracks)
+        self.assertGreater(scores[0], 95)
+
+    def test_best_matches(self):
+        queries = [match_scoring.make_query('Like a Stone', 'Audioslave'),
+                   match_scoring.make_query('Yellow', 'Coldplay')]
+        results = match_scoring.best_matches(queries, [self.tracks, self.tracks])
+        self.assertEqual(['studio', None], [track and track['id'] for track, _ in results])
+
+    def test_fuzzywuzzy_fallback(self):
+        with patch.object(match_scoring, '_ratio_scores', None), patch.dict('sys.modules', {'rapidfuzz': None}):
+            scores = match_scoring.score_candidates(match_scoring.make_query('Rock n Roll', 'Led Zeppelin'),
+                                                    self.tracks)
+        self.assertEqual(2, scores.index(max(scores)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from src import metrics
+from src.rate_limit import call_with_retries
+
+
+class RateLimitedError(Exception):
+    http_status = 429
+    headers = {'Retry-After': '0'}
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.enable(False)
+        metrics.reset()
+
+    def test_disabled_metrics_are_not_collected(self):
+        metrics.enable(False)
+        metrics.increment('retries_total')
+        metrics.observe('api_call_seconds', 0.2)
+        with metrics.timer('api_call_seconds'):
+            pass
+        self.assertEqual({'counters': {}, 'histograms': {}}, metrics.report())
+
+    def test_counters_and_histograms_by_label(self):
+        metrics.increment('failures_total', stage='search', reason='not_found')
+        metrics.increment('failures_total', 2, stage='search', reason='not_found')
+        metrics.increment('failures_total', stage='ai_extraction', reason='api_error')
+        for seconds in (0.002, 0.003, 0.004, 0.2):
+            metrics.observe('api_call_seconds', seconds, endpoint='spotify.search')
+
+        report = metrics.report()
+        self.assertEqual({'failures_total{reason=api_error,stage=ai_extraction}': 1,
+                          'failures_total{reason=not_found,stage=search}': 3}, report['counters'])
+        histogram = report['histograms']['api_call_seconds{endpoint=spotify.search}']
+        self.assertEqual(4, histogram['count'])
+        self.assertEqual(0.005, histogram['p50'])
+        self.assertEqual(0.2, histogram['p95'])
+        self.assertEqual(0.2, histogram['max'])
+
+    def test_timed_stage(self):
+        @metrics.timed_stage('harvest')
+        def harvest(files):
+            return len(files)
+
+        self.assertEqual(2, harvest(['a.mp3', 'b.mp3']))
+        self.assertEqual(1, metrics.report()['histograms']['stage_seconds{stage=harvest}']['count'])
+
+    def test_prometheus_text(self):
+        metrics.increment('api_retries_total', endpoint='spotify.search')
+        metrics.observe('api_call_seconds', 0.02, endpoint='spotify.search')
+
+        lines = metrics.prometheus_text().splitlines()
+        self.assertIn('# TYPE audioreaper_api_retries_total counter', lines)
+        self.assertIn('audioreaper_api_retries_total{endpoint="spotify.search"} 1', lines)
+        self.assertIn('# TYPE audioreaper_api_call_seconds histogram', lines)
+        self.assertIn('audioreaper_api_call_seconds_bucket{endpoint="spotify.search",le="0.01"} 0', lines)
+        self.assertIn('audioreaper_api_call_seconds_bucket{endpoint="spotify.search",le="0.025"} 1', lines)
+        self.assertIn('audioreaper_api_call_seconds_bucket{endpoint="spotify.search",le="+Inf"} 1', lines)
+        self.assertIn('audioreaper_api_call_seconds_count{endpoint="spotify.search"} 1', lines)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics', 'audioreaper.prom')
+            metrics.write_prometheus(path)
+            with open(path, encoding='utf-8') as file:
+                self.assertEqual(metrics.prometheus_text(), file.read())
+
+    @patch('time.sleep')
+    def test_retries_and_rate_limits_are_counted(self, mock_sleep):
+        responses = [RateLimitedError(), RateLimitedError(), 'result']
+
+        def call():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual('result', call_with_retries(call, endpoint='spotify.search'))
+        counters = metrics.report()['counters']
+        self.assertEqual(3, counters['api_calls_total{endpoint=spotify.search}'])
+        self.assertEqual(2, counters['api_rate_limited_total{endpoint=spotify.search}'])
+        self.assertEqual(2, counters['api_retries_total{endpoint=spotify.search}'])
+        self.assertNotIn('api_errors_total{endpoint=spotify.search}', counters)
+
+
+if __name__ == '__main__':
+    unittest.main()
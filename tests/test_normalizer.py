@@ -0,0 +1,60 @@
+import unittest
+from unittest import TestCase
+
+from src import normalizer
+
+
+class NormalizeSongTest(TestCase):
+    def test_matches_clean_metadata_rules(self):
+        song = normalizer.normalize_song("Super Duper -**_/ Official Video ft. BOB", "Best 3vr Singer (video)")
+        self.assertEqual("Super Duper", song.title)
+        self.assertEqual("Best 3vr Singer", song.artist)
+
+    def test_artist_in_title(self):
+        song = normalizer.normalize_song("Audioslave - Like a Stone - Copy", "")
+        self.assertEqual(("Like a Stone", "Audioslave"), (song.title, song.artist))
+
+    def test_every_artist_is_split(self):
+        song = normalizer.normalize_song("Under Pressure", "Queen feat. David Bowie, Someone; Else")
+        self.assertEqual(("Queen", "David Bowie", "Someone", "Else"), song.artists)
+        self.assertEqual("Queen", song.artist)
+
+    def test_key_ignores_case_accents_and_punctuation(self):
+        self.assertEqual(normalizer.normalize_song("Café del Mar", "Energy 52").key,
+                         normalizer.normalize_song("CAFE DEL MAR!", "energy  52").key)
+        self.assertEqual(normalizer.normalize_song("Ｙｅｌｌｏｗ", "Coldplay").key,
+                         normalizer.normalize_song("yellow", "COLDPLAY").key)
+
+    def test_non_latin_text_is_kept(self):
+        self.assertEqual("夜に駆ける|yoasobi", normalizer.normalize_song("夜に駆ける", "YOASOBI").key)
+
+
+class NormalizeBatchTest(TestCase):
+    def test_batch_keeps_order(self):
+        songs = [{'Title': 'Yellow', 'Artist': 'Coldplay'}, {'Title': 'Like a Stone', 'Artist': None},
+                 {'Title': 'Yellow', 'Artist': 'Coldplay'}]
+        results = normalizer.normalize_batch(songs)
+        self.assertEqual(['yellow|coldplay', 'like a stone|', 'yellow|coldplay'], [song.key for song in results])
+
+
+class DedupeSongsTest(TestCase):
+    def test_copies_are_grouped(self):
+        songs = normalizer.normalize_batch([{'Title': 'Yellow', 'Artist': 'Coldplay'},
+                                            {'Title': 'Yellow - Copy', 'Artist': 'COLDPLAY'},
+                                            {'Title': 'Fix You', 'Artist': 'Coldplay'},
+                                            {'Title': 'Yellow (HD)', 'Artist': 'Coldplay'}])
+        unique, groups, stats = normalizer.dedupe_songs(songs)
+        self.assertEqual([0, 2], unique)
+        self.assertEqual([[0, 1, 3], [2]], groups)
+        self.assertEqual({'songs': 4, 'unique': 2, 'duplicates': 2}, stats)
+
+    def test_songs_without_title_are_not_grouped(self):
+        songs = normalizer.normalize_batch([{'Title': '', 'Artist': ''}, {'Title': '(HD)', 'Artist': ''},
+                                            {'Title': '', 'Artist': ''}])
+        unique, groups, stats = normalizer.dedupe_songs(songs)
+        self.assertEqual([0, 1, 2], unique)
+        self.assertEqual(0, stats['duplicates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from src import pipeline
+from src.cache import SqliteCache
+from src.run_journal import RunJournal
+
+
+def make_track(track_id, name, artist):
+    return {'id': track_id, 'name': name, 'artists': [{'name': artist}]}
+
+
+def fake_search(query, type='track', limit=5):
+    title = query.split('track:')[1].split(' artist:')[0]
+    if title == 'Missing':
+        return {'tracks': {'items': []}}
+    return {'tracks': {'items': [make_track(f"id-{title}", title, 'Test Artist')]}}
+
+
+def fake_read_song_tags(file, index=None):
+    if file.startswith('untagged'):
+        return None, None
+    if file == 'copy.mp3':
+        return {'Title': 'Song 0', 'Artist': 'Test Artist', 'Album': ''}, None
+    if file == 'missing.mp3':
+        return {'Title': 'Missing', 'Artist': 'Test Artist', 'Album': ''}, None
+    return {'Title': f"Song {file[:-4]}", 'Artist': 'Test Artist', 'Album': ''}, None
+
+
+def fake_extract(file_names, **ai_options):
+    return [{'Title': f"Untagged {name[9:-4]}", 'Artist': 'Test Artist', 'Album': ''} for name in file_names]
+
+
+class RunPipelineTest(TestCase):
+    def setUp(self):
+        self.sp = MagicMock()
+        self.sp.playlist.return_value = {'snapshot_id': 'snapshot', 'tracks': {'total': 1}}
+        self.sp.playlist_items.return_value = {'items': [{'track': {'id': 'id-Song 1'}}]}
+        self.sp.search.side_effect = fake_search
+        self.files = [f"{number}.mp3" for number in range(230)]
+        self.files += [f"untagged-{number}.mp3" for number in range(5)] + ['copy.mp3', 'missing.mp3']
+
+    @patch('src.pipeline.extract_filename_metadata', side_effect=fake_extract)
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_every_stage_runs(self, mock_output, mock_finder, mock_read, mock_extract):
+        mock_finder.return_value = iter(self.files)
+
+        added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music', queue_size=10,
+                                                                    ai_batch_size=2)
+        expected = {f"id-Song {number}" for number in range(230) if number != 1}
+        expected |= {f"id-Untagged {number}" for number in range(5)}
+        self.assertEqual(expected, set(added_tracks))
+        self.assertEqual(len(expected), len(added_tracks))
+        self.assertEqual(['Missing, Test Artist'], failed_tracks)
+
+        batches = [call.args[1] for call in self.sp.playlist_add_items.call_args_list]
+        self.assertTrue(all(len(batch) <= pipeline.PLAYLIST_BATCH_SIZE for batch in batches))
+        self.assertEqual(sorted(added_tracks), sorted(track for batch in batches for track in batch))
+
+        statuses = {entry['File']: entry['Status'] for entry in report}
+        self.assertEqual(len(self.files), len(report))
+        self.assertEqual('in playlist', statuses['1.mp3'])
+        self.assertEqual('failed', statuses['missing.mp3'])
+        self.assertEqual(1, [statuses['0.mp3'], statuses['copy.mp3']].count('duplicate'))
+        tracks = {entry['File']: entry['Track'] for entry in report}
+        self.assertEqual(['id-Song 0', 'id-Song 0'], [tracks['0.mp3'], tracks['copy.mp3']])
+        self.assertTrue(all(len(call.args[0]) <= 2 for call in mock_extract.call_args_list))
+
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_dry_run_does_not_add(self, mock_output, mock_finder, mock_read):
+        mock_finder.return_value = iter(['2.mp3', '3.mp3'])
+
+        added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music', dry_run=True)
+        self.assertEqual({'id-Song 2', 'id-Song 3'}, set(added_tracks))
+        self.sp.playlist_add_items.assert_not_called()
+
+    @patch('src.pipeline.extract_filename_metadata', side_effect=fake_extract)
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_resume_only_redoes_unfinished_files(self, mock_output, mock_finder, mock_read, mock_extract):
+        with tempfile.TemporaryDirectory() as directory, \
+                RunJournal(os.path.join(directory, 'run.jsonl')) as journal:
+            journal.record('2.mp3', 'added', track='id-Song 2')
+            journal.record('3.mp3', 'matched', track='id-Song 3')
+            journal.record('untagged-1.mp3', 'extracted', song={'Title': 'Untagged 1', 'Artist': 'Test Artist'})
+            journal.record('4.mp3', 'failed', reason="no match on Spotify")
+            mock_finder.return_value = iter(['2.mp3', '3.mp3', 'untagged-1.mp3', '4.mp3'])
+
+            added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music',
+                                                                        journal=journal, resume=True)
+            states = journal.load()
+
+        self.assertEqual({'id-Song 3', 'id-Untagged 1', 'id-Song 4'}, set(added_tracks))
+        mock_read.assert_called_once_with('4.mp3', None)
+        mock_extract.assert_not_called()
+        self.assertEqual(2, self.sp.search.call_count)
+        self.assertEqual({'added'}, {state['Stage'] for state in states.values()})
+        self.assertEqual('resumed', [entry['Status'] for entry in report if entry['File'] == '2.mp3'][0])
+
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_resume_redoes_duplicates_of_failed_files(self, mock_output, mock_finder, mock_read):
+        with tempfile.TemporaryDirectory() as directory, \
+                RunJournal(os.path.join(directory, 'run.jsonl')) as journal:
+            song = {'Title': 'Song 0', 'Artist': 'Test Artist'}
+            journal.record('0.mp3', 'failed', song=song, reason="search failed: timeout")
+            journal.record('copy.mp3', 'duplicate', song=song, original='0.mp3')
+            journal.record('2.mp3', 'added', song={'Title': 'Song 2', 'Artist': 'Test Artist'}, track='id-Song 2')
+            journal.record('copy-2.mp3', 'duplicate', original='2.mp3')
+            mock_finder.return_value = iter(['0.mp3', 'copy.mp3', '2.mp3', 'copy-2.mp3'])
+
+            added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music',
+                                                                        journal=journal, resume=True)
+
+        self.assertEqual(['id-Song 0'], added_tracks)
+        entries = {entry['File']: (entry['Status'], entry['Track']) for entry in report}
+        self.assertEqual(('resumed', 'id-Song 2'), entries['copy-2.mp3'])
+        self.assertEqual({('added', 'id-Song 0'), ('duplicate', 'id-Song 0')},
+                         {entries['0.mp3'], entries['copy.mp3']})
+
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_playlist_snapshot_goes_in_the_playlist_cache(self, mock_output, mock_finder, mock_read):
+        with SqliteCache(":memory:") as search_cache, SqliteCache(":memory:") as playlist_cache:
+            for _ in range(2):
+                mock_finder.return_value = iter(['1.mp3'])
+                pipeline.run_pipeline(self.sp, 'playlist', 'music', search_options={'cache': search_cache},
+                                      playlist_cache=playlist_cache, dry_run=True)
+            self.assertEqual(1, len(playlist_cache))
+            self.assertEqual(1, len(search_cache))
+        self.sp.playlist_items.assert_called_once()
+
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_failed_file_does_not_stop_the_others(self, mock_output, mock_finder):
+        mock_finder.return_value = iter(['2.mp3', 'broken.mp3', '3.mp3'])
+
+        def read_song_tags(file, index=None):
+            if file == 'broken.mp3':
+                raise ValueError("corrupt file")
+            return fake_read_song_tags(file, index)
+
+        with patch('src.pipeline.read_song_tags', side_effect=read_song_tags):
+            added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music')
+        self.assertEqual({'id-Song 2', 'id-Song 3'}, set(added_tracks))
+        self.assertEqual(['broken.mp3'], failed_tracks)
+        self.assertEqual('failed', [entry['Status'] for entry in report if entry['File'] == 'broken.mp3'][0])
+
+    @patch('src.pipeline.extract_filename_metadata')
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_songs_without_title_fail(self, mock_output, mock_finder, mock_read, mock_extract):
+        mock_finder.return_value = iter(['untagged-1.mp3', 'untagged-2.mp3'])
+        mock_extract.side_effect = lambda names, **ai_options: [{'Title': '', 'Artist': ''} for _ in names]
+
+        added_tracks, failed_tracks, report = pipeline.run_pipeline(self.sp, 'playlist', 'music')
+        self.assertEqual([], added_tracks)
+        self.assertEqual(2, len(failed_tracks))
+        self.assertEqual(['failed', 'failed'], [entry['Status'] for entry in report])
+        self.sp.search.assert_not_called()
+
+    @patch('src.pipeline.read_song_tags', side_effect=fake_read_song_tags)
+    @patch('src.pipeline.media_file_finder')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_crashed_stage_aborts_the_run(self, mock_output, mock_finder, mock_read):
+        mock_finder.return_value = iter(self.files)
+        journal = MagicMock()
+        journal.record.side_effect = lambda file, stage, **details: 1 / (stage != 'added')
+
+        with self.assertRaises(pipeline.PipelineError):
+            pipeline.run_pipeline(self.sp, 'playlist', 'music', queue_size=2, journal=journal)
+
+
+if __name__ == '__main__':
+    unittest.main()
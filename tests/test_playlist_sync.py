@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeAPIError, FakeSpotify
+from benchmarks.library import generate_library
+from src.cache import SqliteCache
+from src.playlist_sync import SyncState, diff_files, sync_playlist
+
+
+class DiffFilesTest(TestCase):
+    def test_added_changed_and_removed(self):
+        previous = {'a.mp3': (10, 100, 'id-a'), 'b.mp3': (10, 100, 'id-b'), 'c.mp3': (10, 100, 'id-c')}
+        current = {'a.mp3': (10, 100), 'b.mp3': (12, 100), 'd.mp3': (10, 100)}
+        self.assertEqual((['d.mp3'], ['b.mp3'], ['c.mp3']), diff_files(previous, current))
+
+
+@patch('sys.stdout', new_callable=io.StringIO)
+class SyncPlaylistTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.library = generate_library(os.path.join(self.directory.name, 'library'), 30, untagged_ratio=0,
+                                        duplicate_ratio=0)
+        self.sp = FakeSpotify([song for _, song, _ in self.library])
+        self.playlist_id = self.sp.user_playlist_create('user', 'Synced')['id']
+        self.state = SyncState(":memory:")
+        self.cache = SqliteCache(":memory:")
+
+    def tearDown(self):
+        self.state.close()
+        self.cache.close()
+        self.directory.cleanup()
+
+    def sync(self, **options):
+        return sync_playlist(self.sp, self.playlist_id, os.path.join(self.directory.name, 'library'), self.state,
+                             workers=4, search_options={'cache': self.cache}, playlist_cache=self.cache, **options)
+
+    def playlist(self):
+        return set(self.sp.playlists[self.playlist_id]['tracks'])
+
+    def test_first_sync_adds_every_track(self, mock_output):
+        summary = self.sync()
+        self.assertEqual(30, summary['added_files'])
+        self.assertEqual(30, len(summary['added']))
+        self.assertEqual(set(summary['added']), self.playlist())
+        self.assertEqual(30, len(self.state))
+
+    def test_unchanged_folder_only_reads_the_snapshot(self, mock_output):
+        self.sync()
+        self.sp.calls.clear()
+
+        summary = self.sync()
+        self.assertEqual(30, summary['unchanged_files'])
+        self.assertEqual(([], []), (summary['added'], summary['removed']))
+        self.assertEqual({'playlist': 1}, dict(self.sp.calls))
+
+    def test_removed_and_changed_files(self, mock_output):
+        self.sync()
+        removed_path, removed_song, _ = self.library[0]
+        changed_path, _, _ = self.library[1]
+        replacement_path, replacement_song, _ = self.library[2]
+        os.remove(removed_path)
+        shutil.copyfile(replacement_path, changed_path)
+        self.sp.calls.clear()
+
+        summary = self.sync()
+        self.assertEqual((0, 1, 1), (summary['added_files'], summary['changed_files'], summary['removed_files']))
+        self.assertEqual(2, len(summary['removed']))
+        self.assertEqual([], summary['added'])
+        self.assertEqual(28, len(self.playlist()))
+        self.assertEqual(1, self.sp.calls['playlist_remove_all_occurrences_of_items'])
+        self.assertEqual(set(track_id for _, _, track_id in self.state.load().values()), self.playlist())
+
+        self.sp.calls.clear()
+        self.sync()
+        self.assertEqual({'playlist': 1}, dict(self.sp.calls))
+
+    def test_dry_run_changes_nothing(self, mock_output):
+        summary = self.sync(dry_run=True)
+        self.assertEqual(30, len(summary['added']))
+        self.assertEqual(set(), self.playlist())
+        self.assertEqual(0, len(self.state))
+
+    def test_failed_removal_is_tried_again(self, mock_output):
+        self.sync()
+        os.remove(self.library[0][0])
+        remove = self.sp.playlist_remove_all_occurrences_of_items
+        with patch.object(self.sp, 'playlist_remove_all_occurrences_of_items',
+                          side_effect=FakeAPIError(403, "forbidden")):
+            summary = self.sync()
+        self.assertEqual([], summary['removed'])
+        self.assertEqual(30, len(self.state))
+
+        with patch.object(self.sp, 'playlist_remove_all_occurrences_of_items', side_effect=remove):
+            summary = self.sync()
+        self.assertEqual(1, len(summary['removed']))
+        self.assertEqual(29, len(self.state))
+        self.assertEqual(29, len(self.playlist()))
+
+
+if __name__ == '__main__':
+    unittest.main()
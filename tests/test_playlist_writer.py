@@ -0,0 +1,112 @@
+import io
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmarks.fakes import FakeAPIError, FakeSpotify, FakeSpotifyServer
+from src.job_service import create_spotify_client
+from src.playlist_writer import write_tracks
+
+CATALOG = [{'Title': f"Song {i}", 'Artist': f"Artist {i}", 'Album': "Album"} for i in range(350)]
+
+
+@patch('src.playlist_writer.backoff_delay', return_value=0)
+@patch('sys.stdout', new_callable=io.StringIO)
+class WriteTracksTest(TestCase):
+    def setUp(self):
+        self.sp = FakeSpotify(CATALOG)
+        self.playlist_id = self.sp.user_playlist_create('user', 'Written')['id']
+        self.track_ids = sorted(self.sp.tracks)
+        self.add = self.sp.playlist_add_items
+
+    def playlist(self):
+        return self.sp.playlists[self.playlist_id]['tracks']
+
+    def fail_once(self, error, after_adding=False):
+        failures = [error]
+
+        def add(playlist_id, items, position=None):
+            if failures:
+                if after_adding:
+                    self.add(playlist_id, items, position)
+                raise failures.pop()
+            return self.add(playlist_id, items, position)
+        return add
+
+    def test_batches_in_order(self, mock_output, mock_delay):
+        result = write_tracks(self.sp, self.playlist_id, self.track_ids[:250] + self.track_ids[:3],
+                              existing={self.track_ids[0]})
+        self.assertEqual(self.track_ids[1:250], result['added'])
+        self.assertEqual(self.track_ids[:1] + self.track_ids[:3], result['skipped'])
+        self.assertEqual([], result['failed'])
+        self.assertEqual(self.track_ids[1:250], self.playlist())
+        self.assertEqual(3, self.sp.calls['playlist_add_items'])
+        self.assertEqual(self.sp.playlist(self.playlist_id)['snapshot_id'], result['snapshot_id'])
+
+    def test_pipelined_batches(self, mock_output, mock_delay):
+        result = write_tracks(self.sp, self.playlist_id, self.track_ids, workers=4)
+        self.assertEqual(self.track_ids, result['added'])
+        self.assertEqual(sorted(self.playlist()), self.track_ids)
+        self.assertIsNone(result['snapshot_id'])
+
+    def test_rate_limited_batch_is_sent_again(self, mock_output, mock_delay):
+        with patch.object(self.sp, 'playlist_add_items',
+                          side_effect=self.fail_once(FakeAPIError(429, "too many requests", retry_after=0.01))):
+            result = write_tracks(self.sp, self.playlist_id, self.track_ids[:10])
+        self.assertEqual(self.track_ids[:10], result['added'])
+        self.assertEqual(self.track_ids[:10], self.playlist())
+
+    def test_unknown_outcome_is_not_added_twice(self, mock_output, mock_delay):
+        with patch.object(self.sp, 'playlist_add_items',
+                          side_effect=self.fail_once(FakeAPIError(502, "bad gateway"), after_adding=True)):
+            result = write_tracks(self.sp, self.playlist_id, self.track_ids[:10])
+        self.assertEqual(self.track_ids[:10], result['added'])
+        self.assertEqual(self.track_ids[:10], self.playlist())
+        self.assertEqual(1, self.sp.calls['playlist_items'])
+
+    def test_unknown_outcome_checks_the_snapshot(self, mock_output, mock_delay):
+        snapshot_id = self.sp.playlist(self.playlist_id)['snapshot_id']
+        self.sp.calls.clear()
+        with patch.object(self.sp, 'playlist_add_items', side_effect=self.fail_once(FakeAPIError(500, "error"))):
+            result = write_tracks(self.sp, self.playlist_id, self.track_ids[:10], snapshot_id=snapshot_id)
+        self.assertEqual(self.track_ids[:10], self.playlist())
+        self.assertEqual(self.track_ids[:10], result['added'])
+        self.assertEqual({'playlist': 1, 'playlist_add_items': 1}, dict(self.sp.calls))
+
+    def test_bad_track_ids_are_isolated(self, mock_output, mock_delay):
+        track_ids = self.track_ids[:50] + ['bad-1'] + self.track_ids[50:100] + ['bad-2']
+        result = write_tracks(self.sp, self.playlist_id, track_ids)
+        self.assertEqual(['bad-1', 'bad-2'], result['failed'])
+        self.assertEqual(self.track_ids[:100], result['added'])
+        self.assertEqual(self.track_ids[:100], self.playlist())
+
+    def test_failed_batch_does_not_stop_the_others(self, mock_output, mock_delay):
+        with patch.object(self.sp, 'playlist_add_items', side_effect=self.fail_once(FakeAPIError(403, "forbidden"))):
+            result = write_tracks(self.sp, self.playlist_id, self.track_ids[:250])
+        self.assertEqual(self.track_ids[:100], result['failed'])
+        self.assertEqual(self.track_ids[100:250], result['added'])
+
+
+@patch('src.playlist_writer.backoff_delay', return_value=0)
+@patch('sys.stdout', new_callable=io.StringIO)
+class WriteTracksWithSpotipyTest(TestCase):
+    def setUp(self):
+        self.server = FakeSpotifyServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.sp = create_spotify_client('token')
+        self.sp.prefix = self.server.url
+
+    def test_server_error_is_not_taken_for_a_rate_limit(self, mock_output, mock_delay):
+        self.server.respond(502, {'error': {'status': 502, 'message': "Bad gateway"}})
+        self.server.respond(200, {'snapshot_id': 'before'})
+        self.server.respond(201, {'snapshot_id': 'after'})
+        result = write_tracks(self.sp, 'playlist', ['a', 'b'], snapshot_id='before')
+
+        self.assertEqual(['a', 'b'], result['added'])
+        self.assertEqual('after', result['snapshot_id'])
+        # The outcome of the 502 is not known, so the playlist is checked before the tracks are sent again
+        self.assertEqual(['POST', 'GET', 'POST'], [method for method, _, _ in self.server.requests])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from benchmarks.fakes import FakeSpotifyServer
+from src import rate_limit
+from src.job_service import create_spotify_client
+
+
+class TokenBucketTest(TestCase):
+    def test_burst_up_to_capacity(self):
+        bucket = rate_limit.TokenBucket(rate=1, capacity=3)
+        self.assertTrue(all(bucket.try_acquire() for _ in range(3)))
+        self.assertFalse(bucket.try_acquire())
+
+    def test_acquire_timeout(self):
+        bucket = rate_limit.TokenBucket(rate=1, capacity=1)
+        bucket.try_acquire()
+        start = time.monotonic()
+        self.assertFalse(bucket.acquire(timeout=0.05))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_pause(self):
+        bucket = rate_limit.TokenBucket(rate=100)
+        bucket.pause(10)
+        self.assertFalse(bucket.try_acquire())
+
+    def test_chain_takes_from_every_bucket(self):
+        app_bucket = rate_limit.TokenBucket(rate=1, capacity=3)
+        first = rate_limit.LimiterChain(rate_limit.TokenBucket(rate=1, capacity=2), app_bucket)
+        second = rate_limit.LimiterChain(rate_limit.TokenBucket(rate=1, capacity=2), app_bucket)
+        self.assertTrue(first.try_acquire() and first.try_acquire())
+        self.assertFalse(first.try_acquire())
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(second.acquire(timeout=0.05))
+
+
+class RetryAfterTest(TestCase):
+    def test_retry_after_from_headers(self):
+        error = Exception()
+        error.http_status = 429
+        error.headers = {'Retry-After': '7'}
+        self.assertTrue(rate_limit.is_rate_limited(error))
+        self.assertEqual(7.0, rate_limit.retry_after_seconds(error))
+
+    def test_retry_after_from_response(self):
+        error = Exception()
+        error.response = MagicMock(status_code=429, headers={'retry-after': '2'})
+        self.assertTrue(rate_limit.is_rate_limited(error))
+        self.assertEqual(2.0, rate_limit.retry_after_seconds(error))
+
+    def test_no_retry_after(self):
+        self.assertIsNone(rate_limit.retry_after_seconds(Exception()))
+        self.assertFalse(rate_limit.is_rate_limited(Exception()))
+
+    def test_backoff_delay_capped(self):
+        self.assertLessEqual(rate_limit.backoff_delay(20, base=1, cap=5), 5)
+
+
+class CallWithRetriesTest(TestCase):
+    @patch('src.rate_limit.time.sleep')
+    def test_spotify_retry_after_pauses_the_limiter(self, mock_sleep):
+        limiter = MagicMock()
+        limiter.acquire.return_value = True
+        with FakeSpotifyServer() as server:
+            sp = create_spotify_client('token')
+            sp.prefix = server.url
+            server.respond(429, {'error': {'status': 429, 'message': "API rate limit exceeded"}},
+                           headers={'Retry-After': '7'})
+            server.respond(200, {'id': 'alice'})
+            user = rate_limit.call_with_retries(sp.current_user, limiter, endpoint='spotify.current_user')
+
+        self.assertEqual({'id': 'alice'}, user)
+        limiter.pause.assert_called_once_with(7.0)
+        mock_sleep.assert_called_once_with(7.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
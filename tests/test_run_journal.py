@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+
+from src import run_journal
+
+
+class RunJournalTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'journal', 'run.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_latest_outcome_wins(self):
+        with run_journal.RunJournal(self.path) as journal:
+            journal.record('a.mp3', run_journal.HARVESTED, song={'Title': 'Song', 'Artist': 'Artist', 'File': 'a.mp3'})
+            journal.record('a.mp3', run_journal.FAILED, reason="no match on Spotify")
+            journal.record('b.mp3', run_journal.MATCHED, track='id-b')
+            journal.record('b.mp3', run_journal.ADDED, track='id-b')
+            states = journal.load()
+
+        self.assertEqual({'Stage': 'failed', 'Song': {'Title': 'Song', 'Artist': 'Artist'},
+                          'Reason': "no match on Spotify"}, states['a.mp3'])
+        self.assertEqual({'Stage': 'added', 'Track': 'id-b'}, states['b.mp3'])
+        self.assertEqual({'failed': 1, 'added': 1}, run_journal.summarize(states))
+
+    def test_entries_survive_reopening(self):
+        with run_journal.RunJournal(self.path) as journal:
+            journal.record('a.mp3', run_journal.MATCHED, track='id-a')
+        with run_journal.RunJournal(self.path) as journal:
+            journal.record('b.mp3', run_journal.DUPLICATE)
+        self.assertEqual({'a.mp3', 'b.mp3'}, set(run_journal.read_journal(self.path)))
+
+    def test_cut_short_line_is_skipped(self):
+        with run_journal.RunJournal(self.path) as journal:
+            journal.record('a.mp3', run_journal.ADDED, track='id-a')
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('{"File": "b.mp3", "Sta')
+
+        self.assertEqual({'a.mp3': {'Stage': 'added', 'Track': 'id-a'}}, run_journal.read_journal(self.path))
+
+    def test_duplicate_is_finished_with_its_original(self):
+        with run_journal.RunJournal(self.path) as journal:
+            journal.record('a.mp3', run_journal.ADDED, track='id-a')
+            journal.record('b.mp3', run_journal.FAILED, reason="no match on Spotify")
+            journal.record('a copy.mp3', run_journal.DUPLICATE, original='a.mp3')
+            journal.record('b copy.mp3', run_journal.DUPLICATE, original='b.mp3')
+            states = journal.load()
+
+        self.assertEqual('a.mp3', states['a copy.mp3']['Original'])
+        finished = {file for file, state in states.items() if run_journal.is_finished(state, states)}
+        self.assertEqual({'a.mp3', 'a copy.mp3'}, finished)
+
+    def test_missing_journal_is_empty(self):
+        self.assertEqual({}, run_journal.read_journal(os.path.join(self.directory.name, 'missing.jsonl')))
+
+    def test_default_path_depends_on_playlist_and_folder(self):
+        path = run_journal.default_journal_path('playlist', 'music')
+        self.assertTrue(path.endswith('.jsonl'))
+        self.assertEqual('journal', os.path.basename(os.path.dirname(path)))
+        self.assertNotEqual(path, run_journal.default_journal_path('other playlist', 'music'))
+
+
+if __name__ == '__main__':
+    unittest.main()
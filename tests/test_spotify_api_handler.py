@@ -0,0 +1,189 @@
+import io
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from src import spotify_api_handler
+from src.cache import SqliteCache
+from src.rate_limit import TokenBucket
+
+
+class RateLimitedError(Exception):
+    http_status = 429
+
+    def __init__(self, retry_after):
+        super().__init__("rate limited")
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+def make_track(track_id, name, artist):
+    return {'id': track_id, 'name': name, 'artists': [{'name': artist}]}
+
+
+def fake_search(query, type='track', limit=5):
+    if query.startswith('isrc:'):
+        isrc = query[len('isrc:'):]
+        if isrc == 'QZAAA2400000':
+            return {'tracks': {'items': []}}
+        return {'tracks': {'items': [dict(make_track(f"id-{isrc}", 'Other Title', 'Other Artist'),
+                                          external_ids={'isrc': isrc})]}}
+    title = query.split('track:')[1].split(' artist:')[0]
+    if title == 'Missing':
+        return {'tracks': {'items': []}}
+    return {'tracks': {'items': [make_track(f"id-{title}", title, 'Test Artist')]}}
+
+
+class SearchSongsTest(TestCase):
+    def setUp(self):
+        self.sp = MagicMock()
+        self.sp.playlist.return_value = {'snapshot_id': 'snapshot', 'tracks': {'total': 1}}
+        self.sp.playlist_items.return_value = {'items': [{'track': {'id': 'id-Existing'}}]}
+        self.sp.search.side_effect = fake_search
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_concurrent_search_keeps_order(self, mock_output):
+        songs = [{'Title': f"Song {number}", 'Artist': 'Test Artist'} for number in range(30)]
+        songs += [{'Title': 'Existing', 'Artist': 'Test Artist'}, {'Title': 'Missing', 'Artist': 'Test Artist'}]
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', songs, workers=8, limiter=TokenBucket(rate=1000))
+        self.assertEqual([f"id-Song {number}" for number in range(30)], not_in_playlist)
+        self.assertEqual(['Missing, Test Artist'], failed_tracks)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_duplicates_are_searched_once(self, mock_output):
+        songs = [{'Title': 'Song', 'Artist': 'Test Artist', 'File': 'a.mp3'},
+                 {'Title': 'Missing', 'Artist': 'Test Artist', 'File': 'b.mp3'},
+                 {'Title': 'Song - Copy', 'Artist': 'test artist', 'File': 'a - Copy.mp3'},
+                 {'Title': 'Missing', 'Artist': 'Test Artist', 'File': 'b.wav'}]
+        report = []
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', songs, report=report)
+        self.assertEqual(2, self.sp.search.call_count)
+        self.assertEqual(['id-Song'], not_in_playlist)
+        self.assertEqual(['Missing, Test Artist'], failed_tracks)
+        self.assertEqual([('a.mp3', 'id-Song', 'added', None), ('b.mp3', None, 'failed', None),
+                          ('a - Copy.mp3', 'id-Song', 'duplicate', 0), ('b.wav', None, 'duplicate', 1)],
+                         [(entry['File'], entry['Track'], entry['Status'], entry['Duplicate Of'])
+                          for entry in report])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_poor_match_is_rejected(self, mock_output):
+        self.sp.search.side_effect = lambda query, type, limit: {
+            'tracks': {'items': [make_track('id-other', 'Something Else Entirely', 'Another Band')]}}
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', [{'Title': 'Song', 'Artist': 'Test Artist'}])
+        self.assertEqual([], not_in_playlist)
+        self.assertEqual(['Song, Test Artist'], failed_tracks)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    @patch('src.spotify_api_handler.best_matches', wraps=spotify_api_handler.best_matches)
+    def test_isrc_is_looked_up_first(self, mock_best_matches, mock_output):
+        songs = [{'Title': 'Song', 'Artist': 'Test Artist', 'ISRC': 'USUM71703861'},
+                 {'Title': 'Other', 'Artist': 'Test Artist', 'ISRC': 'QZAAA2400000'}]
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', songs)
+        self.assertEqual(['id-USUM71703861', 'id-Other'], not_in_playlist)
+        self.assertEqual(['isrc:USUM71703861', 'isrc:QZAAA2400000', 'track:Other artist:Test Artist'],
+                         [call.args[0] for call in self.sp.search.call_args_list])
+        self.assertEqual(1, len(mock_best_matches.call_args.args[0]))
+        self.assertEqual(('id-USUM71703861', None), spotify_api_handler.search_song(self.sp, songs[0]))
+
+    @patch('time.sleep')
+    def test_retry_after_is_honored(self, mock_sleep):
+        self.sp.search.side_effect = [RateLimitedError(3), fake_search('track:Song artist:Test Artist')]
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', [{'Title': 'Song', 'Artist': 'Test Artist'}])
+        self.assertEqual(['id-Song'], not_in_playlist)
+        self.assertEqual([], failed_tracks)
+        mock_sleep.assert_called_once_with(3.0)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    @patch('time.sleep')
+    def test_retries_exhausted(self, mock_sleep, mock_output):
+        self.sp.search.side_effect = requests.exceptions.ReadTimeout("read timed out")
+
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', [{'Title': 'Song', 'Artist': 'Test Artist'}], max_retries=2)
+        self.assertEqual([], not_in_playlist)
+        self.assertIn("timeout", mock_output.getvalue())
+        self.assertEqual(['track:Song artist:Test Artist'], failed_tracks)
+        self.assertEqual(3, self.sp.search.call_count)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_latency_budget(self, mock_output):
+        not_in_playlist, failed_tracks = spotify_api_handler.search_songs_not_in_playlist(
+            self.sp, 'playlist', [{'Title': 'Song', 'Artist': 'Test Artist'}], latency_budget=0)
+        self.assertEqual(['track:Song artist:Test Artist'], failed_tracks)
+        self.assertIn("latency budget", mock_output.getvalue())
+        self.sp.search.assert_not_called()
+
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        self.sp = MagicMock()
+        self.sp.playlist.return_value = {'snapshot_id': 'snapshot', 'tracks': {'total': 0}}
+        self.sp.search.side_effect = fake_search
+        self.cache = SqliteCache(":memory:")
+        self.songs = [{'Title': 'Song', 'Artist': 'Test Artist'}, {'Title': 'Missing', 'Artist': 'Test Artist'}]
+
+    def tearDown(self):
+        self.cache.close()
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_hits_and_misses_are_cached(self, mock_output):
+        first = spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache)
+        second = spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache)
+        self.assertEqual((['id-Song'], ['Missing, Test Artist']), first)
+        self.assertEqual(first, second)
+        self.assertEqual(2, self.sp.search.call_count)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_bypass_cache(self, mock_output):
+        spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache)
+        spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache,
+                                                         bypass_cache=True)
+        self.assertEqual(4, self.sp.search.call_count)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_negative_entries_expire(self, mock_output):
+        spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache,
+                                                         negative_ttl=-1)
+        spotify_api_handler.search_songs_not_in_playlist(self.sp, 'playlist', self.songs, cache=self.cache)
+        self.assertEqual(3, self.sp.search.call_count)
+
+
+class PlaylistTrackIdsTest(TestCase):
+    def setUp(self):
+        self.sp = MagicMock()
+        self.sp.playlist.return_value = {'snapshot_id': 'first', 'tracks': {'total': 250}}
+        self.sp.playlist_items.side_effect = lambda playlist_id, fields, limit, offset: {
+            'items': [{'track': {'id': f"id-{position}"}} for position in range(offset, min(offset + limit, 250))]
+                     + [{'track': None}, {'track': {'id': None}}],
+            'next': None}
+
+    def test_every_page_is_fetched(self):
+        track_ids = spotify_api_handler.get_playlist_track_ids(self.sp, 'playlist', workers=3)
+        self.assertEqual({f"id-{position}" for position in range(250)}, track_ids)
+        self.assertEqual(3, self.sp.playlist_items.call_count)
+        self.assertEqual('items(track(id)),next', self.sp.playlist_items.call_args.kwargs['fields'])
+
+    def test_unchanged_snapshot_is_cached(self):
+        with SqliteCache(":memory:") as cache:
+            first = spotify_api_handler.get_playlist_track_ids(self.sp, 'playlist', cache=cache)
+            second = spotify_api_handler.get_playlist_track_ids(self.sp, 'playlist', cache=cache)
+            self.assertEqual(first, second)
+            self.assertEqual(3, self.sp.playlist_items.call_count)
+
+            self.sp.playlist.return_value = {'snapshot_id': 'second', 'tracks': {'total': 250}}
+            spotify_api_handler.get_playlist_track_ids(self.sp, 'playlist', cache=cache)
+            self.assertEqual(6, self.sp.playlist_items.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from src import fileIO
+from src.tag_index import TagIndex
+
+
+class TagIndexTest(TestCase):
+    def setUp(self):
+        self.index = TagIndex(":memory:")
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_lookup_unchanged_file(self):
+        self.index.store('a.mp3', 10, 100, {'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': None})
+        self.assertEqual((True, {'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': None}),
+                         self.index.lookup('a.mp3', 10, 100))
+
+    def test_lookup_changed_file(self):
+        self.index.store('a.mp3', 10, 100, {'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': None})
+        self.assertEqual((False, None), self.index.lookup('a.mp3', 10, 101))
+        self.assertEqual((False, None), self.index.lookup('a.mp3', 11, 100))
+
+    def test_lookup_duration_and_isrc(self):
+        tags = {'Title': 'Test Title', 'Artist': 'Test Artist', 'Album': None, 'Duration': 215.43,
+                'ISRC': 'USUM71703861'}
+        self.index.store('a.mp3', 10, 100, tags)
+        self.assertEqual((True, tags), self.index.lookup('a.mp3', 10, 100))
+
+    def test_lookup_no_metadata(self):
+        self.index.store('a.mp3', 10, 100, None)
+        self.assertEqual((True, None), self.index.lookup('a.mp3', 10, 100))
+
+    def test_prune(self):
+        self.index.store('a.mp3', 10, 100, None)
+        self.index.store('b.mp3', 10, 100, None)
+        self.assertEqual(1, self.index.prune(['b.mp3']))
+        self.assertEqual(1, len(self.index))
+
+    def test_prune_keeps_other_roots(self):
+        for path in ['music/a.mp3', 'music/b.mp3', 'music 2/a.mp3', 'Music/a.mp3', 'podcasts/a.mp3']:
+            self.index.store(os.path.join(*path.split('/')), 10, 100, None)
+        self.assertEqual(1, self.index.prune([os.path.join('music', 'b.mp3')], root='music'))
+        self.assertEqual(4, len(self.index))
+        self.assertEqual((False, None), self.index.lookup(os.path.join('music', 'a.mp3'), 10, 100))
+        self.assertEqual(1, self.index.prune([], root=os.path.join('podcasts', '')))
+        self.assertEqual(3, len(self.index))
+
+    def test_index_without_isrc_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, 'index.sqlite3')
+            connection = sqlite3.connect(index_path)
+            connection.execute("CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                               "title TEXT, artist TEXT, album TEXT, has_metadata INTEGER)")
+            connection.execute("INSERT INTO files VALUES ('a.mp3', 10, 100, 'Test Title', 'Test Artist', NULL, 1)")
+            connection.commit()
+            connection.close()
+            with TagIndex(index_path) as index:
+                self.assertEqual((False, None), index.lookup('a.mp3', 10, 100))
+                index.store('a.mp3', 10, 100, {'Title': 'Test Title', 'Artist': 'Test Artist', 'ISRC': 'USUM71703861'})
+                self.assertEqual('USUM71703861', index.lookup('a.mp3', 10, 100)[1]['ISRC'])
+
+    def test_rebuild(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, 'index.sqlite3')
+            with TagIndex(index_path) as index:
+                index.store('a.mp3', 10, 100, None)
+            with TagIndex(index_path) as index:
+                self.assertEqual(1, len(index))
+            with TagIndex(index_path, rebuild=True) as index:
+                self.assertEqual(0, len(index))
+
+
+class IndexedHarvestTest(TestCase):
+    @patch('tinytag.TinyTag.get')
+    def test_metadata_harvester_only_reads_new_files(self, mock_get):
+        mock_audio_file = MagicMock()
+        mock_audio_file.title = 'Test Title'
+        mock_audio_file.artist = 'Test Artist'
+        mock_audio_file.album = 'Test Album'
+        mock_get.return_value = mock_audio_file
+
+        with tempfile.TemporaryDirectory() as temp_dir, TagIndex(":memory:") as index:
+            files = [os.path.join(temp_dir, name) for name in ['a.mp3', 'b.mp3']]
+            for file in files:
+                open(file, 'w').close()
+            first_run = fileIO.metadata_harvester(files, index=index)
+            self.assertEqual(2, mock_get.call_count)
+
+            with open(files[1], 'w') as changed_file:
+                changed_file.write("new tags")
+            second_run = fileIO.metadata_harvester(files, workers=4, index=index)
+            self.assertEqual(3, mock_get.call_count)
+            self.assertEqual(first_run, second_run)
+
+
+if __name__ == '__main__':
+    unittest.main()